@@ -0,0 +1,131 @@
+#
+# Micro benchmark of the data type conversions
+#
+# Measures mb2py (polled registers -> value) and str2mb (MQTT payload -> registers) for every data type of the
+# shared correctness corpus. Each conversion is checked against the corpus before it is timed.
+# Reports the time per call and the memory allocated per call (peak, measured with tracemalloc in a separate run).
+# With --baseline, the result is compared with an earlier --output and the run fails, if a conversion got slower
+# than --threshold times the baseline.
+#
+# run with:  python -m benchmarks.bench_data_types [--output result.json] [--baseline result.json] [--threshold 1.25]
+#
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from modbus2mqtt_2.data_types import DataConverter
+from modbus2mqtt_2.data_types_corpus import ROUND_TRIP_CASES
+
+
+def cases_by_type() -> dict:
+    by_type = dict()
+    for (data_type, string, regs, value) in ROUND_TRIP_CASES:
+        by_type.setdefault(data_type, list()).append((string, regs if isinstance(regs, list) else [regs], value))
+    return by_type
+
+
+def check(conv:DataConverter, cases:list) -> None:
+    for (string, regs, value) in cases:
+        written = conv.str2mb(string)
+        written = [ reg & 0xffff for reg in written ] if isinstance(written, list) else [ written & 0xffff ]
+        result = conv.mb2py(regs)
+        if written != regs or (result != value and not (isinstance(value, float) and abs(result-value) < 1e-6)):
+            raise AssertionError(f'{conv.type}: "{string}" -> {written}, {regs} -> {result} does not match the corpus.')
+
+
+def time_per_call(function, args_list:list, min_time:float) -> float:
+    # Best of 5 runs, each calling function often enough to take about min_time
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            for args in args_list:
+                function(args)
+        elapsed = time.perf_counter()-start
+        if elapsed >= min_time/5:
+            break
+        loops *= 2
+    best = elapsed
+    for _ in range(4):
+        start = time.perf_counter()
+        for _ in range(loops):
+            for args in args_list:
+                function(args)
+        best = min(best, time.perf_counter()-start)
+    return best / (loops*len(args_list))
+
+
+def alloc_per_call(function, args_list:list) -> int:
+    tracemalloc.start()
+    try:
+        peak = 0
+        for args in args_list:
+            tracemalloc.reset_peak()
+            (current, _) = tracemalloc.get_traced_memory()
+            function(args)
+            peak = max(peak, tracemalloc.get_traced_memory()[1]-current)
+        return peak
+    finally:
+        tracemalloc.stop()
+
+
+def run(min_time:float) -> dict:
+    results = dict()
+    for (data_type, cases) in cases_by_type().items():
+        conv = DataConverter(data_type)
+        check(conv, cases)
+        strings = [ string for (string, regs, value) in cases ]
+        regs_list = [ regs for (string, regs, value) in cases ]
+        results[data_type] = {
+            'mb2py-ns': round(time_per_call(conv.mb2py, regs_list, min_time)*1e9, 1),
+            'str2mb-ns': round(time_per_call(conv.str2mb, strings, min_time)*1e9, 1),
+            'mb2py-alloc-bytes': alloc_per_call(conv.mb2py, regs_list),
+            'str2mb-alloc-bytes': alloc_per_call(conv.str2mb, strings),
+        }
+    return results
+
+
+def compare(results:dict, baseline:dict, threshold:float) -> list[str]:
+    regressions = list()
+    for (data_type, timings) in results.items():
+        base_timings = baseline.get(data_type)
+        if base_timings is None:
+            continue
+        for key in ('mb2py-ns', 'str2mb-ns'):
+            if timings[key] > base_timings[key]*threshold:
+                regressions.append(f'{data_type} {key}: {timings[key]} > {threshold} * {base_timings[key]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro benchmark of the modbus2mqtt_2 data type conversions.')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds to measure each conversion (default 0.2).')
+    parser.add_argument('--output', help='Write the JSON result to this file instead of stdout.')
+    parser.add_argument('--baseline', help='JSON result of an earlier run to compare with.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Allowed slowdown against the baseline (default 1.25).')
+    args = parser.parse_args()
+
+    results = run(args.min_time)
+    document = { 'benchmark': 'data_types', 'environment': { 'python': platform.python_version(), 'platform': platform.platform() },
+                 'results': results }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(document, output_file, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file)['results'], args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
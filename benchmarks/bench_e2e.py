@@ -0,0 +1,324 @@
+#
+# End-to-end throughput and latency of the bridge
+#
+# Starts simulated Modbus slaves in a subprocess, on TCP or as RTU over a pair of pseudo terminals, with configurable
+# response latency, error rate and register churn. The bridge runs in this process against an in-process stand-in for
+# the MQTT broker, which records the publishes. Set requests are injected from a separate thread, like paho does.
+# Reports polls/s, publishes/s, CPU time per value, memory and the end-to-end set latency as JSON.
+# With --event-loop compare, the benchmark runs once on asyncio's and once on uvloop's event loop, each in its own process.
+#
+# run with:  python -m benchmarks.bench_e2e [--slaves 4] [--transport tcp|rtu] [--latency-ms 5] [--event-loop asyncio|uvloop|compare] [--output result.json]
+#
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from modbus2mqtt_2 import config_reader, event_loop
+from modbus2mqtt_2.config_reader import ConfigYaml
+from modbus2mqtt_2.globals import deamon_opts, logger
+from modbus2mqtt_2.modbus_objects import ModbusMaster, ModbusWriter, Device, Poller
+from modbus2mqtt_2.mqtt_client import MqttClient
+
+
+###################################################################################################################
+#
+# Simulated slaves, running in their own process
+#
+
+def make_slave_context(args):
+    from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
+
+    class SimulatedSlave(ModbusSlaveContext):
+        # Every access takes latency seconds, fails with error_rate and changes each register with probability churn
+        def getValues(self, fc_as_hex, address, count=1):
+            time.sleep(args.latency_ms/1000)
+            if random.random() < args.error_rate:
+                raise RuntimeError('Simulated slave failure')
+            values = super().getValues(fc_as_hex, address, count)
+            if args.churn > 0:
+                values = [ (value+1) & 0xFFFF if random.random() < args.churn else value for value in values ]
+                super().setValues(fc_as_hex, address, values)
+            return values
+
+        def setValues(self, fc_as_hex, address, values):
+            time.sleep(args.latency_ms/1000)
+            super().setValues(fc_as_hex, address, values)
+
+    num_regs = args.pollers*100
+    slaves = { slaveid: SimulatedSlave(hr=ModbusSequentialDataBlock(0, [0]*num_regs), zero_mode=True) for slaveid in range(1, args.slaves+1) }
+    return ModbusServerContext(slaves=slaves, single=False)
+
+
+def make_pty_pair() -> tuple[str, str]:
+    # Two pseudo terminals with their master sides connected by a relay thread, like a null modem cable
+    import pty, select, tty
+    (master_a, slave_a) = pty.openpty()
+    (master_b, slave_b) = pty.openpty()
+    for fd in (slave_a, slave_b):
+        tty.setraw(fd)
+    #...........................................................................................
+    def relay():
+        while True:
+            (readable, _, _) = select.select([master_a, master_b], [], [])
+            for fd in readable:
+                os.write(master_b if fd == master_a else master_a, os.read(fd, 4096))
+    #...........................................................................................
+    threading.Thread(target=relay, daemon=True).start()
+    return (os.ttyname(slave_a), os.ttyname(slave_b))
+
+
+def serve_slaves(args) -> None:
+    from pymodbus.server import StartAsyncTcpServer, StartAsyncSerialServer
+    logging.getLogger('pymodbus').setLevel(logging.CRITICAL) # Simulated failures are expected
+    context = make_slave_context(args)
+    if args.transport == 'tcp':
+        print(args.port, flush=True)
+        asyncio.run(StartAsyncTcpServer(context=context, address=('127.0.0.1', args.port)))
+    else:
+        (server_port, client_port) = make_pty_pair()
+        print(client_port, flush=True)
+        asyncio.run(StartAsyncSerialServer(context=context, port=server_port, baudrate=args.rtu_baud, parity='N', stopbits=1, bytesize=8))
+
+
+def start_slaves(args) -> tuple[subprocess.Popen, str]:
+    cmd = [ sys.executable, '-m', 'benchmarks.bench_e2e', '--serve-slaves', '--transport', args.transport, '--port', str(args.port),
+            '--slaves', str(args.slaves), '--pollers', str(args.pollers), '--latency-ms', str(args.latency_ms),
+            '--error-rate', str(args.error_rate), '--churn', str(args.churn), '--rtu-baud', str(args.rtu_baud) ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    address = process.stdout.readline().strip()
+    if args.transport == 'tcp':
+        for attempt in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', args.port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+    else:
+        time.sleep(0.5)
+    return (process, address)
+
+
+###################################################################################################################
+#
+# The bridge, running in this process
+#
+
+class BrokerStandIn:
+    # Takes the place of paho's client: records publishes and timestamps the echo of injected set requests
+
+    def __init__(self) -> None:
+        self.publish_cnt = 0
+        self.pending_sets = dict() # value topic -> (payload, time of injection)
+        self.set_latencies = list()
+
+    def publish(self, topic, value, qos=0, retain=False, properties=None):
+        self.publish_cnt += 1
+        pending = self.pending_sets.get(topic)
+        if pending is not None and pending[0] == value:
+            self.set_latencies.append(time.perf_counter()-pending[1])
+            del self.pending_sets[topic]
+        return types.SimpleNamespace(rc=0)
+
+
+def generate_yaml(args) -> str:
+    lines = [ 'Devices:\n' ]
+    for slaveid in range(1, args.slaves+1):
+        lines.append(f'  - name: device-{slaveid}\n    slave-id: {slaveid}\n    Default-reg-type: holding_register\n    Pollers:\n')
+        for poller_idx in range(args.pollers):
+            start_reg = poller_idx*100
+            lines.append(f'      - start-reg: {start_reg}\n        len-regs: {args.refs_per_poller}\n        poll-rate: {args.poll_rate}\n        References:\n')
+            for ref_idx in range(args.refs_per_poller):
+                writeable = '\n            writeable: True' if ref_idx == 0 else ''
+                lines.append(f'          - topic: ref-{poller_idx}-{ref_idx}\n            start-reg: {start_reg+ref_idx}\n            data-type: uint16{writeable}\n')
+    return ''.join(lines)
+
+
+def quantiles_ms(samples:list[float]) -> dict:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples)-1, int(q*len(samples)))]*1000, 3)
+    return { 'count': len(samples), 'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(samples[-1]*1000, 3) }
+
+
+def poller_totals() -> tuple[int, int, int]:
+    return (sum(poller.stats.polls for poller in Poller.all_poller),
+            sum(poller.stats.polls_failed for poller in Poller.all_poller),
+            sum(poller.stats.values_polled for poller in Poller.all_poller))
+
+
+async def run_bridge(args, address:str) -> dict:
+    deamon_opts['publish-seconds'] = 0 if args.publish_always else deamon_opts['publish-seconds']
+    broker = BrokerStandIn()
+    mqttc = MqttClient('localhost', 1883, 'bench', None, '', None, False, None, 'modbus', 'homeassistant', False, 0)
+    mqttc.mqc = broker
+    if args.transport == 'tcp':
+        modbus_master = ModbusMaster.new_modbus_tcp_master('127.0.0.1', int(address))
+    else:
+        modbus_master = ModbusMaster.new_modbus_rtu_master(address, 'none', args.rtu_baud, deamon_opts['set-modbus-timeout'])
+    modbus_writer = ModbusWriter(mqttc)
+    mqttc.set_modbus_writer(modbus_writer)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as tmp_file:
+        tmp_file.write(generate_yaml(args))
+    try:
+        with open(tmp_file.name, 'r') as yaml_file:
+            ConfigYaml.read_daemon_config(yaml_file)
+            ConfigYaml.read_devices(yaml_file, mqttc, modbus_master)
+    finally:
+        os.unlink(tmp_file.name)
+    if config_reader.config_error_count > 0:
+        raise ValueError(f'{config_reader.config_error_count} config errors in the generated config.')
+
+    writeable = [ (dev.name, ref.topic) for dev in Device.all_devices.values() for ref in dev.references.values() if ref.is_writeable ]
+    stop_injecting = threading.Event()
+    #...........................................................................................
+    def inject_sets():
+        # Runs in its own thread, like paho's network loop
+        while not stop_injecting.wait(args.set_interval):
+            (device_name, ref_topic) = random.choice(writeable)
+            value = str(random.randrange(0x10000))
+            broker.pending_sets[mqttc.get_topic_reference_value(device_name, ref_topic)] = (value, time.perf_counter())
+            msg = types.SimpleNamespace(topic=mqttc.get_topic_reference_subsciption(device_name, ref_topic), payload=value.encode())
+            modbus_writer.add_set_request(None, msg)
+    #...........................................................................................
+
+    async with asyncio.TaskGroup() as tg:
+        modbus_master.run_workloop(tg)
+        modbus_writer.run_workloop(tg)
+        for poller in Poller.all_poller:
+            poller.run_workloop(tg)
+        await asyncio.sleep(args.warmup)
+
+        (polls_start, failed_start, values_start) = poller_totals()
+        publishes_start = broker.publish_cnt
+        broker.set_latencies.clear()
+        cpu_start = time.process_time()
+        time_start = time.perf_counter()
+        injector = None
+        if args.set_interval > 0:
+            injector = threading.Thread(target=inject_sets, daemon=True)
+            injector.start()
+        await asyncio.sleep(args.duration)
+        stop_injecting.set()
+        elapsed = time.perf_counter()-time_start
+        cpu_used = time.process_time()-cpu_start
+        (polls_end, failed_end, values_end) = poller_totals()
+        publishes = broker.publish_cnt-publishes_start
+
+        for task in [ modbus_master.runtask, modbus_writer.runtask ] + [ poller.runtask for poller in Poller.all_poller ]:
+            task.cancel()
+    modbus_master.master.close()
+
+    values = values_end-values_start
+    return {
+        'event-loop': event_loop.get_loop_name(asyncio.get_running_loop()),
+        'elapsed-s': round(elapsed, 3),
+        'polls': polls_end-polls_start,
+        'polls-failed': failed_end-failed_start,
+        'polls-per-s': round((polls_end-polls_start)/elapsed, 2),
+        'values-per-s': round(values/elapsed, 2),
+        'publishes-per-s': round(publishes/elapsed, 2),
+        'cpu-s': round(cpu_used, 3),
+        'cpu-us-per-value': round(cpu_used/values*1e6, 2) if values > 0 else None,
+        'max-rss-mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1),
+        'set-latency-ms': quantiles_ms(broker.set_latencies),
+        'sets-unanswered': len(broker.pending_sets),
+    }
+
+
+def environment() -> dict:
+    import pymodbus
+    try:
+        revision = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        revision = None
+    return { 'python': platform.python_version(), 'pymodbus': pymodbus.__version__, 'platform': platform.platform(),
+             'revision': revision, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z') }
+
+
+def compare_event_loops() -> dict:
+    # Run the benchmark with the same arguments for each event loop, in fresh processes
+    try:
+        import uvloop
+    except ImportError:
+        print('Comparing the event loops requires the python package uvloop.', file=sys.stderr)
+        sys.exit(1)
+    results = dict()
+    for loop_name in ('asyncio', 'uvloop'):
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp_file:
+            pass
+        try:
+            subprocess.run([ sys.executable, '-m', 'benchmarks.bench_e2e' ] + sys.argv[1:] + [ '--event-loop', loop_name, '--output', tmp_file.name ], check=True)
+            with open(tmp_file.name, 'r') as result_file:
+                results[loop_name] = json.load(result_file)['results']
+        finally:
+            os.unlink(tmp_file.name)
+    ratio = lambda key: round(results['uvloop'][key]/results['asyncio'][key], 3) if results['uvloop'][key] and results['asyncio'][key] else None
+    results['uvloop-vs-asyncio'] = { key: ratio(key) for key in ('values-per-s', 'publishes-per-s', 'cpu-us-per-value') }
+    if results['uvloop']['set-latency-ms'] and results['asyncio']['set-latency-ms']:
+        results['uvloop-vs-asyncio']['set-latency-p50'] = round(results['uvloop']['set-latency-ms']['p50']/results['asyncio']['set-latency-ms']['p50'], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of modbus2mqtt_2 against simulated Modbus slaves.')
+    parser.add_argument('--transport', choices=['tcp', 'rtu'], default='tcp', help='Modbus TCP or RTU over pseudo terminals (default tcp).')
+    parser.add_argument('--port', type=int, default=5021, help='TCP port of the simulated slaves (default 5021).')
+    parser.add_argument('--rtu-baud', type=int, default=115200, help='Baud rate for RTU (default 115200).')
+    parser.add_argument('--slaves', type=int, default=4, help='Number of simulated slaves (default 4).')
+    parser.add_argument('--pollers', type=int, default=4, help='Pollers per slave (default 4).')
+    parser.add_argument('--refs-per-poller', type=int, default=50, help='References per poller (default 50).')
+    parser.add_argument('--poll-rate', type=float, default=0.1, help='Poll rate of each poller in seconds (default 0.1).')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='Response latency of the slaves in ms (default 2).')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of failing requests (default 0).')
+    parser.add_argument('--churn', type=float, default=0.1, help='Probability of a register changing between reads (default 0.1).')
+    parser.add_argument('--publish-always', action='store_true', help='Publish every polled value, not only changed ones.')
+    parser.add_argument('--set-interval', type=float, default=0.1, help='Seconds between injected set requests (0=none, default 0.1).')
+    parser.add_argument('--warmup', type=float, default=2.0, help='Seconds before measuring (default 2).')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to measure (default 10).')
+    parser.add_argument('--event-loop', choices=['asyncio', 'uvloop', 'compare'], default='asyncio', help='Event loop of the bridge, or compare both (default asyncio).')
+    parser.add_argument('--output', help='Write the JSON result to this file instead of stdout.')
+    parser.add_argument('--verbosity', choices=['debug', 'info', 'warning', 'error', 'critical'], default='critical', help='Verbosity level of the bridge. Default: critical')
+    parser.add_argument('--serve-slaves', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_slaves:
+        serve_slaves(args)
+        return
+
+    logger.setLevel(args.verbosity.upper())
+    logging.getLogger('pymodbus').setLevel(args.verbosity.upper())
+    if args.event_loop == 'compare':
+        results = compare_event_loops()
+    else:
+        (slave_process, address) = start_slaves(args)
+        try:
+            results = event_loop.run(run_bridge(args, address), args.event_loop)
+        finally:
+            slave_process.terminate()
+            slave_process.wait()
+
+    document = { 'benchmark': 'e2e', 'parameters': { key: value for (key, value) in vars(args).items() if key not in ('output', 'serve_slaves', 'verbosity') },
+                 'environment': environment(), 'results': results }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(document, output_file, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+
+if __name__ == '__main__':
+    main()
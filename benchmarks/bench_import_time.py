@@ -0,0 +1,50 @@
+#
+# Startup import time
+#
+# Imports the daemon's main module in a fresh interpreter with -X importtime and reports the cumulative import
+# time of main and of its slowest imports. Optionally fails if main exceeds a budget, for use on the target
+# gateway where wall clock numbers are meaningful.
+#
+# run with:  python -m benchmarks.bench_import_time [--runs 5] [--top 10] [--budget-ms 500]
+#
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+
+def measure_importtime(module:str) -> dict:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            capture_output=True, text=True, check=True)
+    cumulative_us = dict()
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', line)
+        if match:
+            cumulative_us[match.group(2)] = int(match.group(1))
+    return cumulative_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark for the modbus2mqtt_2 daemon.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters to measure (default 5).')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list (default 10).')
+    parser.add_argument('--budget-ms', type=float, default=None, help='Exit with an error if the best run of main exceeds this time.')
+    args = parser.parse_args()
+
+    runs = [ measure_importtime('modbus2mqtt_2.main') for _ in range(args.runs) ]
+    best = min(runs, key=lambda cumulative_us: cumulative_us['modbus2mqtt_2.main'])
+    main_ms = best['modbus2mqtt_2.main']/1000
+    print(f'modbus2mqtt_2.main:   {main_ms:.1f} ms (best of {args.runs})')
+    for (module, time_us) in sorted(best.items(), key=lambda item: item[1], reverse=True)[1:args.top+1]:
+        print(f'  {module:40s} {time_us/1000:.1f} ms')
+
+    if args.budget_ms is not None and main_ms > args.budget_ms:
+        print(f'Import budget of {args.budget_ms} ms exceeded', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#
+# Memory footprint of a large configuration
+#
+# Builds a generated config with (by default) 50k references and reports the memory allocated for the
+# Device/Poller/Reference objects, measured with tracemalloc.
+#
+# run with:  python -m benchmarks.bench_memory [--refs 50000] [--profiles]
+#
+
+import argparse
+import gc
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from modbus2mqtt_2 import config_reader
+from modbus2mqtt_2.config_reader import ConfigYaml
+from modbus2mqtt_2.modbus_objects import ModbusMaster
+from modbus2mqtt_2.mqtt_client import MqttClient
+
+
+def generate_yaml(num_refs:int, refs_per_poller:int, pollers_per_device:int, use_profiles:bool) -> str:
+    pollers = []
+    for poller_idx in range(pollers_per_device):
+        start_reg = poller_idx*100
+        pollers.append(f'      - start-reg: {start_reg}\n        len-regs: {2*refs_per_poller}\n        References:\n')
+        for ref_idx in range(refs_per_poller):
+            pollers.append(f'          - topic: ref-{poller_idx}-{ref_idx}\n            start-reg: {start_reg+2*ref_idx}\n'
+                           f'            data-type: float32BE\n            scaling: 0.1\n')
+    pollers_yaml = ''.join(pollers)
+
+    num_devices = max(1, num_refs // (refs_per_poller*pollers_per_device))
+    lines = []
+    if use_profiles:
+        lines.append(f'Profiles:\n  - name: bench-profile\n    Default-reg-type: holding_register\n    Pollers:\n{pollers_yaml}')
+    lines.append('Devices:\n')
+    for dev_idx in range(num_devices):
+        lines.append(f'  - name: device-{dev_idx}\n    slave-id: {dev_idx%247+1}\n')
+        if use_profiles:
+            lines.append('    profile: bench-profile\n')
+        else:
+            lines.append(f'    Default-reg-type: holding_register\n    Pollers:\n{pollers_yaml}')
+    return ''.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark for large modbus2mqtt_2 configurations.')
+    parser.add_argument('--refs', type=int, default=50000, help='Number of references to create (default 50000).')
+    parser.add_argument('--refs-per-poller', type=int, default=25, help='References per poller (default 25).')
+    parser.add_argument('--pollers-per-device', type=int, default=4, help='Pollers per device (default 4).')
+    parser.add_argument('--profiles', action='store_true', help='Instantiate all devices from one device profile.')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as tmp_file:
+        tmp_file.write(generate_yaml(args.refs, args.refs_per_poller, args.pollers_per_device, args.profiles))
+    try:
+        mqttc = MqttClient('localhost', 1883, 'bench', None, '', None, False, None, 'modbus', 'homeassistant', False, 0)
+        modbus_master = ModbusMaster.new_modbus_tcp_master('localhost', 502)
+        with open(tmp_file.name, 'r') as yaml_file:
+            ConfigYaml.read_daemon_config(yaml_file)
+            gc.collect()
+            tracemalloc.start()
+            time_start = time.perf_counter()
+            ConfigYaml.read_devices(yaml_file, mqttc, modbus_master)
+            time_build = time.perf_counter()-time_start
+            gc.collect()
+            (mem_current, mem_peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        os.unlink(tmp_file.name)
+
+    if config_reader.config_error_count > 0:
+        print(f'Config errors: {config_reader.config_error_count}', file=sys.stderr)
+        sys.exit(1)
+
+    num_refs = sum(len(dev.references) for dev in modbus_master.devices)
+    print(f'devices:              {len(modbus_master.devices)}')
+    print(f'references:           {num_refs}')
+    print(f'build time:           {time_build:.2f} s')
+    print(f'allocated:            {mem_current/1024/1024:.1f} MiB (peak {mem_peak/1024/1024:.1f} MiB)')
+    print(f'bytes per reference:  {mem_current/max(1,num_refs):.0f}')
+    print(f'max resident size:    {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
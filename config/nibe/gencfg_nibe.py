@@ -6,6 +6,7 @@ import re
 from typing import Dict, List
 from enum import Enum
 import math
+import sys
 import yaml
 
 
@@ -310,6 +311,120 @@ class PollerEntry(CustomYamlDataclass):
     data_points: list[DataPointEntry] = field(metadata={'yaml_key': 'References'})
 
 
+def group_contiguous(data_points: list[DataPointEntry]) -> list[PollerEntry]:
+    # Simple grouping: one poller per run of exactly contiguous registers with same reg type and poll rate
+    current_poller = None
+    poller_list = []
+    for dp in data_points:
+        if  not current_poller \
+            or dp.reg_type != current_poller.reg_type \
+            or current_poller.start_reg + current_poller.len_regs != dp.start_reg \
+            or dp.poll_rate != current_poller.poll_rate:
+                current_poller = PollerEntry(start_reg=dp.start_reg, len_regs=dp.len_reg, reg_type=dp.reg_type, poll_rate=dp.poll_rate, data_points=[dp])
+                poller_list.append(current_poller)
+        else:
+            current_poller.len_regs += dp.len_reg
+            current_poller.data_points.append(dp)
+    return poller_list
+
+
+@dataclass
+class PollerOptimizer:
+    # Cost model of the bus: each request costs a fixed overhead (framing, turnaround, inter frame gap)
+    # plus the transfer time of every register read. Unused registers in gaps are read as well.
+    request_overhead_ms: float = 10.0
+    register_cost_ms: float = 2.3
+    max_regs: int = 123
+    max_gap: int = 16
+    rate_tiers: list[float] = field(default_factory=lambda: [5.0, 15.0, 60.0, 300.0, 900.0])
+    default_rate: float = 15.0 # Poll rate of pollers without own poll rate
+
+    _yaml_keys = {
+        'request-overhead-ms':  'request_overhead_ms',
+        'register-cost-ms':     'register_cost_ms',
+        'max-regs':             'max_regs',
+        'max-gap':              'max_gap',
+        'rate-tiers':           'rate_tiers',
+    }
+
+    @classmethod
+    def from_yaml_config(cls, yaml_config: dict) -> 'PollerOptimizer':
+        opt_config = yaml_config.get('Optimizer', None) or dict()
+        kwargs = dict()
+        for key, value in opt_config.items():
+            if key not in cls._yaml_keys:
+                raise ValueError(f'Unknown optimizer option: {key}')
+            kwargs[cls._yaml_keys[key]] = value
+        optimizer = cls(**kwargs)
+        optimizer.rate_tiers = sorted(float(t) for t in optimizer.rate_tiers)
+        optimizer.max_regs = min(optimizer.max_regs, 123)
+        optimizer.default_rate = yaml_config.get('Device', dict()).get('Default-poll-rate', optimizer.default_rate)
+        return optimizer
+
+    def rate_tier(self, poll_rate: float|None) -> float|None:
+        # Round down to the next tier, so no data point gets polled less often than requested
+        if poll_rate is None:
+            return None
+        faster_tiers = [t for t in self.rate_tiers if t <= poll_rate]
+        return faster_tiers[-1] if faster_tiers else poll_rate
+
+    def request_cost_ms(self, len_regs: int) -> float:
+        return self.request_overhead_ms + self.register_cost_ms*len_regs
+
+    def bus_load(self, poller_list: list[PollerEntry]) -> tuple[float, float]:
+        # Returns (requests per second, bus time in ms per second)
+        requests = 0.0
+        bus_time = 0.0
+        for poller in poller_list:
+            rate = poller.poll_rate if poller.poll_rate is not None else self.default_rate
+            requests += 1.0/rate
+            bus_time += self.request_cost_ms(poller.len_regs)/rate
+        return (requests, bus_time)
+
+    def optimize(self, data_points: list[DataPointEntry]) -> list[PollerEntry]:
+        groups: dict[tuple, list[DataPointEntry]] = dict()
+        for dp in data_points:
+            groups.setdefault((dp.reg_type, self.rate_tier(dp.poll_rate)), []).append(dp)
+        poller_list = []
+        for (reg_type, rate), group in groups.items():
+            group.sort(key=lambda dp: dp.start_reg)
+            poller_list += self._partition(group, reg_type, rate)
+        poller_list.sort(key=lambda poller: (poller.reg_type, poller.start_reg))
+        return poller_list
+
+    def _partition(self, points: list[DataPointEntry], reg_type: str, rate: float|None) -> list[PollerEntry]:
+        # Dynamic programming over the sorted data points: best[i] is the minimal cost of polling points[i:],
+        # cut[i] the end of the first poller in that solution. A poller spans consecutive points as long as the
+        # span fits into max_regs and no gap exceeds max_gap.
+        n = len(points)
+        rate_eff = rate if rate is not None else self.default_rate
+        best = [math.inf]*n + [0.0]
+        cut = [n]*(n+1)
+        for i in range(n-1, -1, -1):
+            end = points[i].start_reg
+            for j in range(i, n):
+                if points[j].start_reg - end > self.max_gap:
+                    break
+                end = max(end, points[j].start_reg + points[j].len_reg)
+                span = end - points[i].start_reg
+                if span > self.max_regs:
+                    break
+                cost = self.request_cost_ms(span)/rate_eff + best[j+1]
+                if cost < best[i]:
+                    best[i] = cost
+                    cut[i] = j+1
+
+        poller_list = []
+        i = 0
+        while i < n:
+            segment = points[i:cut[i]]
+            start_reg = segment[0].start_reg
+            len_regs = max(dp.start_reg + dp.len_reg for dp in segment) - start_reg
+            poller_list.append(PollerEntry(start_reg=start_reg, len_regs=len_regs, reg_type=reg_type, poll_rate=rate, data_points=segment))
+            i = cut[i]
+        return poller_list
+
+
 def create_yaml_config(daemon_config: dict, device_config: dict, poller_list: list[PollerEntry]):
     yaml_root = {
         'Daemon': daemon_config,
@@ -348,21 +463,13 @@ if __name__ == '__main__':
     nibe_registers = NibeModbusRegister.read_nibe_csv(csv_path)
 
     # Create poller entries based on the registers
-    current_poller = None
-    poller_list = []
-    for key, reg in sorted(nibe_registers.items()):
-        if not reg.relevant:
-            continue
-        dp = DataPointEntry(register=reg)
-        # Check if we can group this data point with the current poller
-        if  not current_poller \
-            or dp.reg_type != current_poller.reg_type \
-            or current_poller.start_reg + current_poller.len_regs != dp.start_reg \
-            or dp.poll_rate != current_poller.poll_rate:
-                current_poller = PollerEntry(start_reg=dp.start_reg, len_regs=dp.len_reg, reg_type=dp.reg_type, poll_rate=dp.poll_rate, data_points=[dp])
-                poller_list.append(current_poller)
-        else:
-            current_poller.len_regs += dp.len_reg
-            current_poller.data_points.append(dp)
-        
+    data_points = [DataPointEntry(register=reg) for key, reg in sorted(nibe_registers.items()) if reg.relevant]
+    optimizer = PollerOptimizer.from_yaml_config(yaml_config)
+    poller_list = optimizer.optimize(data_points)
+
+    # Report the estimated bus load, compared to the simple grouping of contiguous registers
+    for label, pollers in (('contiguous', group_contiguous(data_points)), ('optimized', poller_list)):
+        (requests, bus_time) = optimizer.bus_load(pollers)
+        print(f'{label:>10}: {len(pollers):4d} pollers, {requests:6.2f} requests/s, bus load {bus_time:7.1f} ms/s ({bus_time/10:.1f}%)', file=sys.stderr)
+
     create_yaml_config(daemon_config=yaml_config['Daemon'], device_config=yaml_config['Device'], poller_list=poller_list)
\ No newline at end of file
@@ -0,0 +1,198 @@
+import asyncio
+import struct
+import time
+
+from .globals import logger
+
+
+###################################################################################################################
+#
+# Capturing and replaying Modbus traffic
+#
+# A capture file starts with a header, followed by one record per Modbus request:
+#   timestamp (double, seconds since start of capture), duration (float, time on the wire), function code (byte),
+#   slave id (byte), address (ushort), count (ushort), status (byte, 0=ok, Modbus exception code or 0xFF for other
+#   errors like time-outs), length of the data (ushort) and the data: registers as ushorts, bits packed into bytes.
+# All little endian. Reads record the response, writes the values written.
+#
+# ReplayClient stands in for a pymodbus client and answers requests with the recorded responses of the same slave,
+# function code and register range, in recorded order.
+#
+
+CAPTURE_HEADER = b'MB2MQCAP\x01'
+_record_struct = struct.Struct('<dfBBHHBH')
+
+_bit_function_codes = (1, 2, 5, 15)
+
+STATUS_OK = 0
+STATUS_ERROR = 0xFF
+
+
+class CaptureRecord:
+
+    __slots__ = ('timestamp', 'duration', 'function_code', 'slaveid', 'address', 'count', 'status', 'values')
+
+    def __init__(self, timestamp:float, duration:float, function_code:int, slaveid:int, address:int, count:int, status:int, values:list):
+        self.timestamp = timestamp
+        self.duration = duration
+        self.function_code = function_code
+        self.slaveid = slaveid
+        self.address = address
+        self.count = count
+        self.status = status
+        self.values = values
+
+    def __str__(self):
+        return f'capture record: {self.timestamp:.3f}s fc:{self.function_code} slave:{self.slaveid} reg:{self.address} count:{self.count} status:{self.status}'
+
+
+def _pack_values(function_code:int, values:list) -> bytes:
+    if not values:
+        return b''
+    if function_code in _bit_function_codes:
+        packed = bytearray((len(values)+7)//8)
+        for (idx, bit) in enumerate(values):
+            if bit:
+                packed[idx//8] |= 1 << (idx%8)
+        return bytes(packed)
+    return struct.pack(f'<{len(values)}H', *[ int(value) & 0xFFFF for value in values ])
+
+
+def _unpack_values(function_code:int, count:int, data:bytes) -> list:
+    if not data:
+        return list()
+    if function_code in _bit_function_codes:
+        return [ bool(data[idx//8] & (1 << (idx%8))) for idx in range(min(count, len(data)*8)) ]
+    return list(struct.unpack(f'<{len(data)//2}H', data))
+
+
+class CaptureWriter:
+
+    flush_interval = 1.0
+
+    def __init__(self, file_name:str) -> None:
+        self.file_name = file_name
+        self.capture_file = open(file_name, 'wb')
+        self.capture_file.write(CAPTURE_HEADER)
+        self.start_time = time.monotonic()
+        self.last_flush = self.start_time
+        self.record_cnt = 0
+
+    def record(self, function_code:int, slaveid:int, address:int, count:int, status:int, duration:float, values) -> None:
+        if values is not None and not isinstance(values, list):
+            values = [ values ]
+        data = _pack_values(function_code, values)
+        now = time.monotonic()
+        self.capture_file.write(_record_struct.pack(now-self.start_time, duration, function_code, slaveid, address, count, status, len(data)))
+        self.capture_file.write(data)
+        self.record_cnt += 1
+        if now-self.last_flush >= self.flush_interval:
+            self.capture_file.flush()
+            self.last_flush = now
+
+    def close(self) -> None:
+        self.capture_file.close()
+        logger.info(f'Captured {self.record_cnt} Modbus requests to {self.file_name}.')
+
+    def __str__(self):
+        return f'capture: {self.file_name}'
+
+
+def read_capture(file_name:str):
+    # Generator of the CaptureRecords in a capture file
+    with open(file_name, 'rb') as capture_file:
+        if capture_file.read(len(CAPTURE_HEADER)) != CAPTURE_HEADER:
+            raise ValueError(f'{file_name} is no Modbus capture file.')
+        while True:
+            header = capture_file.read(_record_struct.size)
+            if len(header) < _record_struct.size:
+                return
+            (timestamp, duration, function_code, slaveid, address, count, status, data_len) = _record_struct.unpack(header)
+            values = _unpack_values(function_code, count, capture_file.read(data_len))
+            yield CaptureRecord(timestamp, duration, function_code, slaveid, address, count, status, values)
+
+
+class ReplayResponse:
+    # Just what ModbusMaster needs from a pymodbus response
+
+    def __init__(self, function_code:int, values:list=None, exception_code:int=None, failed:bool=False):
+        self.function_code = function_code | 0x80 if exception_code is not None else function_code
+        self.registers = values
+        self.bits = values
+        self.exception_code = exception_code
+        self.failed = failed
+
+    def isError(self) -> bool:
+        return self.failed or self.exception_code is not None
+
+
+class ReplayClient:
+
+    # Answer for requests not in the capture: "gateway target device failed to respond"
+    NOT_CAPTURED = 0x0B
+
+    def __init__(self, file_name:str, speed:float=1.0) -> None:
+        self.file_name = file_name
+        self.speed = speed
+        self.responses = dict() # (function code, slave id, address, count) -> list of CaptureRecords
+        self.next_idx = dict()
+        for record in read_capture(file_name):
+            if record.function_code in (1, 2, 3, 4):
+                self.responses.setdefault((record.function_code, record.slaveid, record.address, record.count), list()).append(record)
+        self.connected = False
+        logger.info(f'Replaying {sum(len(records) for records in self.responses.values())} Modbus responses from {file_name}.')
+
+    async def connect(self) -> None:
+        self.connected = True
+
+    def close(self) -> None:
+        self.connected = False
+
+    async def _replay(self, function_code:int, address:int, count:int, slaveid:int) -> ReplayResponse:
+        key = (function_code, slaveid, address, count)
+        records = self.responses.get(key)
+        if not records:
+            await asyncio.sleep(0)
+            return ReplayResponse(function_code, exception_code=ReplayClient.NOT_CAPTURED)
+        # Cycle through the recorded responses, so the replay can run for as long as wanted
+        idx = self.next_idx.get(key, 0)
+        self.next_idx[key] = (idx+1) % len(records)
+        record = records[idx]
+        await asyncio.sleep(record.duration/self.speed)
+        if record.status == STATUS_OK:
+            return ReplayResponse(function_code, record.values)
+        if record.status == STATUS_ERROR:
+            return ReplayResponse(function_code, failed=True)
+        return ReplayResponse(function_code, exception_code=record.status)
+
+    async def read_coils(self, address:int, count:int=1, slave:int=0) -> ReplayResponse:
+        return await self._replay(1, address, count, slave)
+
+    async def read_discrete_inputs(self, address:int, count:int=1, slave:int=0) -> ReplayResponse:
+        return await self._replay(2, address, count, slave)
+
+    async def read_holding_registers(self, address:int, count:int=1, slave:int=0) -> ReplayResponse:
+        return await self._replay(3, address, count, slave)
+
+    async def read_input_registers(self, address:int, count:int=1, slave:int=0) -> ReplayResponse:
+        return await self._replay(4, address, count, slave)
+
+    async def _write(self, function_code:int) -> ReplayResponse:
+        # Writes always succeed, there is nothing to write to
+        await asyncio.sleep(0)
+        return ReplayResponse(function_code)
+
+    async def write_coil(self, address:int, value, slave:int=0) -> ReplayResponse:
+        return await self._write(5)
+
+    async def write_coils(self, address:int, values, slave:int=0) -> ReplayResponse:
+        return await self._write(15)
+
+    async def write_register(self, address:int, value, slave:int=0) -> ReplayResponse:
+        return await self._write(6)
+
+    async def write_registers(self, address:int, values, slave:int=0) -> ReplayResponse:
+        return await self._write(16)
+
+    def __str__(self):
+        return f'replay: {self.file_name} speed:{self.speed}'
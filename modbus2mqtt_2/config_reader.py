@@ -1,10 +1,17 @@
-import csv
-import yaml
+import asyncio
+import copy
+import hashlib
+import logging
+import os
+import pickle
+import signal
+import stat
+
+import modbus2mqtt_2.globals as globs
 
 from .globals import logger, deamon_opts, device_opts, poller_opts, ref_opts
-from .modbus_objects import ModbusMaster,Device,Poller,Reference
+from .modbus_objects import ModbusMaster,ModbusWriter,Device,Poller,ReferenceDef,Reference
 from .mqtt_client import MqttClient
-from .home_assistant import HassDevice, HassEntity
 
 #
 # Global counter for errors during parsing config files
@@ -19,7 +26,7 @@ config_error_count = 0
 
 class ConfigSource:
     def __init__(self, file, line:str=None):
-        self.file_name = file.name
+        self.file_name = file if isinstance(file, str) else file.name
         self.line = line
     def __str__(self):
         if self.line:
@@ -28,16 +35,92 @@ class ConfigSource:
             return f'file:{self.file_name}'
 
 
+###################################################################################################################
+#
+# Cache for compiled configurations
+#
+# After a successful parse, the plan of all devices, pollers and references (with all option merging done) is
+# pickled to the cache file. It is keyed by the config file's content and our version, so any change to either
+# invalidates it.
+#
+# Unpickling can run arbitrary code. So the cache is only loaded if it is owned by our user and not writable by
+# anybody else, and it is written readable and writable by our user only.
+#
+
+class ConfigCache:
+
+    def __init__(self, cache_file:str) -> None:
+        self.cache_file = cache_file
+
+    @staticmethod
+    def get_key(config_text:str) -> str:
+        return hashlib.sha256(f'{globs.__version__}\n{config_text}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def check_owner(file) -> None:
+        # Checks the opened file, not its name: the file can't be swapped after the check
+        if not hasattr(os, 'geteuid'):
+            return
+        file_stat = os.fstat(file.fileno())
+        if file_stat.st_uid != os.geteuid():
+            raise PermissionError('not owned by our user')
+        if file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError('writable by group or others')
+
+    def load(self, key:str) -> dict|None:
+        try:
+            with open(self.cache_file, 'rb') as f:
+                ConfigCache.check_owner(f)
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning( f'Ignoring unreadable config cache {self.cache_file}: {e}')
+            return None
+        if cached.get('key') != key:
+            logger.info( f'Config cache {self.cache_file} is outdated.')
+            return None
+        return cached['plan']
+
+    def store(self, key:str, plan:dict) -> None:
+        try:
+            tmp_file = f'{self.cache_file}.tmp'
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                if hasattr(os, 'fchmod'):
+                    os.fchmod(f.fileno(), 0o600) # An existing file keeps its mode otherwise
+                pickle.dump({'key': key, 'plan': plan}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+            logger.info( f'Config cache {self.cache_file} written.')
+        except Exception as e:
+            logger.warning( f'Cannot write config cache {self.cache_file}: {e}')
+
+
 ###################################################################################################################
 #
 # Parsing YAML config files
 #
+# Parsing is done in two steps:
+#   1. The yaml file is parsed into a plan: plain dicts holding the merged options of all devices, pollers and
+#      references. This is the part which can be cached.
+#   2. The plan is built into the Device, Poller and Reference objects.
+#
+# Devices can be instantiated from a profile in the 'Profiles' section. All devices of a profile share the
+# profile's poller and reference plans and thus also the ReferenceDef objects built from them.
+#
+# yaml and the Home Assistant option tables are only imported when a plan actually needs to be parsed.
+#
 
 class ConfigYaml:
+
+    _loaded_plans = dict() # file name -> (plan, cache key, ConfigCache or None if plan came from cache)
+    _cache_file = None
+    _shared_ref_defs = dict() # id(reference plan) -> (reference plan, ReferenceDef)
     
     def print_yaml_options() -> None:
+        import yaml
         root = { }
         root['Daemon'] = dict(deamon_opts)
+        root['Profiles'] = [ dict(device_opts) ]
         dev= dict(device_opts)
         root['Devices'] = [ dev ]
         root['Devices'][0]['Pollers'] = [ dict(poller_opts) ]
@@ -45,60 +128,182 @@ class ConfigYaml:
         print( yaml.dump(root,sort_keys=False))
         
 
-    def read_daemon_config(yaml_file) -> None:
-        global config_error_count
+    def read_daemon_config(yaml_file, cache_file:str=None) -> None:
+        ConfigYaml._cache_file = cache_file
+        plan = ConfigYaml._load_plan(yaml_file, cache_file)
+        if plan is None:
+            return
+        for key, value in plan['daemon'].items():
+            deamon_opts[key] = value
+
+
+    def read_devices( yaml_file, mqttc:MqttClient, modbus_master:ModbusMaster, shard:tuple[int,int]=None) -> None:        
+        # With shard=(index, count), only the devices of this shard of the configuration are built
+        plan = ConfigYaml._load_plan(yaml_file)
+        if plan is None:
+            return
+        if shard is not None:
+            (shard_idx, shard_cnt) = shard
+            plan = dict(plan, devices=ConfigYaml.shard_device_plans(plan['devices'], shard_cnt)[shard_idx])
+        error_count_before = config_error_count
+        ConfigYaml._build_devices( plan, ConfigSource( yaml_file), mqttc, modbus_master)
+        if config_error_count == error_count_before and (shard is None or shard[0] == 0):
+            ConfigYaml._store_plan_cache( yaml_file.name)
+
+
+    def shard_device_plans(dev_plans:list, shard_cnt:int) -> list[list]:
+        # Distribute the devices over shard_cnt shards with about the same number of references each.
+        # Devices on the same serial bus behind a gateway (option bus) stay in one shard: The bus serves one request
+        # at a time, so several workers would only compete for it.
+        # Deterministic, so every worker process computes the same distribution from the same configuration.
+        groups = dict() # bus or device name -> device plans
+        for dev_plan in dev_plans:
+            bus = dev_plan['opts'].get('bus')
+            groups.setdefault(('device', dev_plan['opts']['name']) if bus is None else ('bus', bus), list()).append(dev_plan)
+        shards = [ list() for _ in range(shard_cnt) ]
+        loads = [ 0 ] * shard_cnt
+        ref_cnt = lambda group: sum(len(poller_plan['references']) for dev_plan in group for poller_plan in dev_plan['pollers'])
+        for group in sorted(groups.values(), key=ref_cnt, reverse=True):
+            shard_idx = loads.index(min(loads))
+            shards[shard_idx].extend(group)
+            loads[shard_idx] += ref_cnt(group)
+        return shards
+
+
+    def reread_plan(yaml_file_name:str) -> tuple[dict,dict]|None:
+        # Re-read the config file for a reload. Returns (old plan, new plan) or None on errors.
+        old_entry = ConfigYaml._loaded_plans.pop(yaml_file_name)
+        error_count_before = config_error_count
         try:
-            yaml_file.seek(0)
-            yaml_dict = yaml.safe_load(yaml_file)
+            with open(yaml_file_name, 'r') as yaml_file:
+                plan = ConfigYaml._load_plan(yaml_file, ConfigYaml._cache_file)
         except Exception as e:
-            logger.error( f'Config error ({ConfigSource( yaml_file)}): {e}')
-            config_error_count += 1
-            return
+            logger.error( f'Config error (file:{yaml_file_name}): {e}')
+            plan = None
+        if plan is None or config_error_count != error_count_before:
+            ConfigYaml._loaded_plans[yaml_file_name] = old_entry
+            return None
+        return (old_entry[0], plan)
 
-        if 'Daemon' not in yaml_dict:
-            return        
-        daemon_part = yaml_dict['Daemon']
 
-        for key in daemon_part:
-            if key not in deamon_opts:
-                logger.error( f'Unknown yaml daemon option "{key}"')
-                config_error_count += 1
-                continue
-            deamon_opts[key] = daemon_part[key]
+    def _store_plan_cache(yaml_file_name:str) -> None:
+        (plan, key, cache) = ConfigYaml._loaded_plans[yaml_file_name]
+        if cache is not None:
+            cache.store(key, plan)
 
 
-    def read_devices( yaml_file, mqttc:MqttClient, modbus_master:ModbusMaster) -> None:        
+    def _load_plan(yaml_file, cache_file:str=None) -> dict|None:
         global config_error_count
+        if yaml_file.name in ConfigYaml._loaded_plans:
+            return ConfigYaml._loaded_plans[yaml_file.name][0]
+
         config_source = ConfigSource( yaml_file)
         try:
             yaml_file.seek(0)
-            yaml_dict = yaml.safe_load(yaml_file)
+            config_text = yaml_file.read()
         except Exception as e:
             logger.error( f'Config error ({config_source}): {e}')
             config_error_count += 1
-            return
+            return None
+
+        key = ConfigCache.get_key(config_text)
+        cache = ConfigCache(cache_file) if cache_file else None
+        if cache is not None:
+            plan = cache.load(key)
+            if plan is not None:
+                logger.info( f'Using compiled config from cache {cache_file}')
+                ConfigYaml._loaded_plans[yaml_file.name] = (plan, key, None)
+                return plan
+
+        error_count_before = config_error_count
+        plan = ConfigYaml._parse_plan( config_text, config_source)
+        if plan is None:
+            return None
+        ConfigYaml._loaded_plans[yaml_file.name] = (plan, key, cache if config_error_count == error_count_before else None)
+        return plan
+
+
+    def _parse_plan(config_text:str, config_source:ConfigSource) -> dict|None:
+        global config_error_count
+        import yaml
+        try:
+            # Use the fast C implementation of the yaml loader if available
+            yaml_dict = yaml.load(config_text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        except Exception as e:
+            logger.error( f'Config error ({config_source}): {e}')
+            config_error_count += 1
+            return None
+        if yaml_dict is None:
+            yaml_dict = dict()
 
-        # pop an throw away the daemon options
-        yaml_dict.pop('Daemon', None)
+        plan = { 'daemon': dict(), 'devices': list() }
+
+        # pop the daemon options
+        daemon_part = yaml_dict.pop('Daemon', None)
+        if daemon_part is None:
+            daemon_part = dict()
+        for key in daemon_part:
+            if key not in deamon_opts:
+                logger.error( f'Unknown yaml daemon option "{key}"')
+                config_error_count += 1
+                continue
+            if key == 'config-cache':
+                logger.warning( f'Option "{key}" is only supported on the command line. Ignoring it ({config_source}).')
+                continue
+            plan['daemon'][key] = daemon_part[key]
+
+        # pop all device profiles
+        profiles = dict()
+        profiles_list = yaml_dict.pop('Profiles',[])
+        for profile in profiles_list:
+            profile_plan = ConfigYaml._parse_device_dict( profile, config_source, profiles)
+            if profile_plan is None:
+                continue
+            profile_name = profile_plan['opts']['name']
+            if profile_name is None or profile_name in profiles:
+                logger.error( f'Device profile without name or with duplicate name "{profile_name}" ({config_source})')
+                config_error_count += 1
+                continue
+            profiles[profile_name] = profile_plan
 
         # pop all devices
         devices_list = yaml_dict.pop('Devices',[])
         if len(devices_list) == 0:
             logger.warning( f'No devices defined ({config_source})')
         for dev in devices_list:
-            ConfigYaml._parse_device_dict( dev, config_source, mqttc, modbus_master)
+            dev_plan = ConfigYaml._parse_device_dict( dev, config_source, profiles)
+            if dev_plan is not None:
+                plan['devices'].append(dev_plan)
 
         # the remaining options are errnous
         for key in yaml_dict:
             logger.error( f'Unknown yaml option "{key}" ({config_source})')
             config_error_count += 1
 
+        return plan
+
 
-    def _parse_device_dict(dev_dict:dict, config_source:ConfigSource, mqttc:MqttClient, modbus_master:ModbusMaster) -> None:
+    def _parse_device_dict(dev_dict:dict, config_source:ConfigSource, profiles:dict=dict()) -> dict|None:
         global config_error_count
+        from .home_assistant import HassDevice
+        dev_dict = dict(dev_dict) # don't pop from the yaml dict itself, it may be shared by yaml aliases
         this_dev_opts = dict(device_opts) # create our own copy to make changes
         this_hass_dev_opts = dict(HassDevice.get_config_options()) # create our own copy to make changes
         default_poller_opts = dict(poller_opts)
+        profile_pollers = list()
+
+        # start from the profile, if the device is based on one
+        profile_name = dev_dict.get('profile')
+        if profile_name is not None:
+            if profile_name not in profiles:
+                logger.error( f'Unknown device profile "{profile_name}" for device {dev_dict.get("name")} ({config_source})')
+                config_error_count += 1
+                return None
+            profile_plan = profiles[profile_name]
+            this_dev_opts.update(profile_plan['opts'])
+            this_dev_opts['name'] = None
+            this_hass_dev_opts.update(profile_plan['hass'])
+            profile_pollers = profile_plan['pollers']
 
         # pop all device options and hass-device options
         for dev_key in list(dev_dict):
@@ -109,21 +314,17 @@ class ConfigYaml:
             elif dev_key.startswith('Default-') and (dev_key.removeprefix('Default-') in default_poller_opts):
                 default_poller_opts[dev_key.removeprefix('Default-')] = dev_dict.pop(dev_key)
 
-        try:
-            the_dev_name = this_dev_opts['name']
-            the_dev_id = this_dev_opts['slave-id']
-            new_device = Device(config_source, mqttc, modbus_master, the_dev_name, the_dev_id, this_hass_dev_opts)
-        except Exception as e:
-            logger.error( f'Config error parsing device {the_dev_name} ({config_source}): {e}')
-            config_error_count += 1
-            return
+        # the profile's pollers are shared, not copied
+        dev_plan = { 'opts': this_dev_opts, 'hass': this_hass_dev_opts, 'pollers': list(profile_pollers) }
 
         # pop all pollers
         pollers_list = dev_dict.pop('Pollers', [])
         for poller in pollers_list:
-            ConfigYaml._parse_poller_dict( poller, default_poller_opts, config_source, new_device, mqttc)
-        if len(pollers_list) == 0:
-            logger.warning( f'No pollers defined for device {new_device.name}')
+            poller_plan = ConfigYaml._parse_poller_dict( poller, default_poller_opts, config_source, this_dev_opts['name'])
+            if poller_plan is not None:
+                dev_plan['pollers'].append(poller_plan)
+        if len(dev_plan['pollers']) == 0:
+            logger.warning( f'No pollers defined for device {this_dev_opts["name"]}')
 
         # the remaining options are errnous
         local_errors = 0
@@ -132,9 +333,13 @@ class ConfigYaml:
             local_errors += 1
         config_error_count += local_errors
 
+        return dev_plan
 
-    def _parse_poller_dict(poller_dict:dict, default_poller_opts:dict, config_source:ConfigSource, curr_device:Device, mqttc:MqttClient) -> None:
+
+    def _parse_poller_dict(poller_dict:dict, default_poller_opts:dict, config_source:ConfigSource, dev_name:str) -> dict|None:
         global config_error_count
+        from .home_assistant import HassEntity
+        poller_dict = dict(poller_dict) # don't pop from the yaml dict itself, it may be shared by yaml aliases
         this_poller_opts = dict(default_poller_opts) # create our own copy to make changes
         this_default_ref_opts = dict(ref_opts) # create our own copy to make changes
         this_default_hass_opts = HassEntity.get_all_config_opts() # create our own copy to make changes
@@ -148,34 +353,31 @@ class ConfigYaml:
             elif poller_key.startswith('Default-') and (poller_key.removeprefix('Default-') in this_default_hass_opts):
                 this_default_hass_opts[poller_key.removeprefix('Default-')] = poller_dict.pop(poller_key)
 
-        try:
-            start_reg = this_poller_opts['start-reg']
-            len_regs = this_poller_opts['len-regs']
-            reg_type = this_poller_opts['reg-type']
-            poll_rate = this_poller_opts['poll-rate']
-            new_poller = Poller( config_source, curr_device, start_reg, len_regs, reg_type, poll_rate)
-        except Exception as e:
-            logger.error( f'Config error parsing poller in device {curr_device.name} ({config_source}): {e}')
-            config_error_count += 1
-            return
+        poller_plan = { 'opts': this_poller_opts, 'references': list() }
 
         # pop all references
         references_list = poller_dict.pop('References', [])
         if len(references_list) == 0:
-            logger.warning( f'No references defined for device {curr_device.name}')
+            logger.warning( f'No references defined for device {dev_name}')
         for reference in references_list:
-            ConfigYaml._parse_reference_dict( reference, this_default_ref_opts, this_default_hass_opts, config_source, new_poller, mqttc)
+            ref_plan = ConfigYaml._parse_reference_dict( reference, this_default_ref_opts, this_default_hass_opts, config_source, dev_name)
+            if ref_plan is not None:
+                poller_plan['references'].append(ref_plan)
 
         # the remaining options are errnous
         local_errors = 0
         for poller_key in poller_dict:
-            logger.error( f'Unknown yaml poller option "{poller_key}" in device {curr_device.name}')
+            logger.error( f'Unknown yaml poller option "{poller_key}" in device {dev_name}')
             local_errors += 1
         config_error_count += local_errors
 
+        return poller_plan
 
-    def _parse_reference_dict(reference_dict:dict, default_ref_opts:dict, all_default_hass_opts:dict, config_source:ConfigSource, curr_poller:Poller, mqttc:MqttClient) -> None:
+
+    def _parse_reference_dict(reference_dict:dict, default_ref_opts:dict, all_default_hass_opts:dict, config_source:ConfigSource, dev_name:str) -> dict|None:
         global config_error_count
+        from .home_assistant import HassEntity
+        reference_dict = dict(reference_dict) # don't pop from the yaml dict itself, it may be shared by yaml aliases
         this_ref_opts = dict(default_ref_opts) # create our own copy to make changes
         # pop all reference options
         for ref_key in list(reference_dict):
@@ -188,15 +390,81 @@ class ConfigYaml:
             for ref_key, config_default_val in HassEntity.get_valid_config_opts( this_ref_opts['hass_entity_type']).items():
                 this_hass_ref_opts[ref_key] = all_default_hass_opts[ref_key] if ref_key in all_default_hass_opts else config_default_val
         except Exception as e:
-            logger.error( f'Config error parsing reference in device/referece {curr_poller.device.name}/{this_ref_opts["topic"]} ({config_source}): {e}')
+            logger.error( f'Config error parsing reference in device/referece {dev_name}/{this_ref_opts["topic"]} ({config_source}): {e}')
             config_error_count += 1
-            return
+            return None
         # pop all valid hass options
         for ref_key in list(reference_dict):
             if ref_key in this_hass_ref_opts:
                 this_hass_ref_opts[ref_key] = reference_dict.pop(ref_key)
-                
+
+        if not this_ref_opts['readable'] and not this_ref_opts['writeable']:
+            logger.error(f'Reference neither readable nor writeable. Ignoring device/referece {dev_name}/{this_ref_opts["topic"]}.')
+            config_error_count += 1
+            return None
+
+        # the remaining options are errnous
+        local_errors = 0
+        for ref_key in reference_dict:
+            logger.error( f'Unknown/illegal yaml reference option in device/referece {dev_name}/{this_ref_opts["topic"]}')
+            local_errors += 1
+        config_error_count += local_errors
+
+        return { 'opts': this_ref_opts, 'hass': this_hass_ref_opts }
+
+
+    def _build_devices(plan:dict, config_source:ConfigSource, mqttc:MqttClient, modbus_master:ModbusMaster) -> None:
+        ConfigYaml._shared_ref_defs.clear()
+        for dev_plan in plan['devices']:
+            ConfigYaml._build_device( dev_plan, config_source, mqttc, modbus_master)
+
+
+    def _build_device(dev_plan:dict, config_source:ConfigSource, mqttc:MqttClient, modbus_master:ModbusMaster) -> Device|None:
+        global config_error_count
+        this_dev_opts = dev_plan['opts']
         try:
+            the_dev_name = this_dev_opts['name']
+            the_dev_id = this_dev_opts['slave-id']
+            payload_encoding = this_dev_opts['payload-encoding']
+            payload_batch = this_dev_opts['payload-batch']
+            new_device = Device(config_source, mqttc, modbus_master, the_dev_name, the_dev_id, dev_plan['hass'], payload_encoding, payload_batch)
+            new_device.config_plan = dev_plan
+        except Exception as e:
+            logger.error( f'Config error parsing device {this_dev_opts["name"]} ({config_source}): {e}')
+            config_error_count += 1
+            return None
+
+        for poller_plan in dev_plan['pollers']:
+            ConfigYaml._build_poller( poller_plan, config_source, new_device, mqttc)
+        return new_device
+
+
+    def _build_poller(poller_plan:dict, config_source:ConfigSource, curr_device:Device, mqttc:MqttClient) -> Poller|None:
+        global config_error_count
+        this_poller_opts = poller_plan['opts']
+        try:
+            start_reg = this_poller_opts['start-reg']
+            len_regs = this_poller_opts['len-regs']
+            reg_type = this_poller_opts['reg-type']
+            poll_rate = this_poller_opts['poll-rate']
+            new_poller = Poller( config_source, curr_device, start_reg, len_regs, reg_type, poll_rate)
+            new_poller.config_plan = poller_plan
+        except Exception as e:
+            logger.error( f'Config error parsing poller in device {curr_device.name} ({config_source}): {e}')
+            config_error_count += 1
+            return None
+
+        for ref_plan in poller_plan['references']:
+            ConfigYaml._build_reference( ref_plan, config_source, new_poller, mqttc)
+        return new_poller
+
+
+    def _build_reference(ref_plan:dict, config_source:ConfigSource, curr_poller:Poller, mqttc:MqttClient) -> Reference|None:
+        global config_error_count
+        this_ref_opts = ref_plan['opts']
+        try:
+            if id(ref_plan) in ConfigYaml._shared_ref_defs:
+                return Reference( curr_poller, ConfigYaml._shared_ref_defs[id(ref_plan)][1])
             topic = this_ref_opts['topic']
             start_reg = this_ref_opts['start-reg']
             write_reg = this_ref_opts['write-reg']
@@ -206,22 +474,169 @@ class ConfigYaml:
             scaling = this_ref_opts['scaling']
             format_str = this_ref_opts['format-str']
             hass_entity_type = this_ref_opts['hass_entity_type']
-            if not is_readable and not is_writeable:
-                logger.error(f'Reference neither readable nor writeable. Ignoring device/referece {curr_poller.device.name}/{this_ref_opts["topic"]}.')
-                config_error_count += 1
-                return
-            new_ref = Reference( config_source, mqttc, curr_poller, topic, start_reg, write_reg, is_readable, is_writeable, data_type, scaling, format_str, hass_entity_type, this_hass_ref_opts)
+            history_size = this_ref_opts['history']
+            ref_def = ReferenceDef( config_source, curr_poller, topic, start_reg, write_reg, is_readable, is_writeable, data_type, scaling, format_str, hass_entity_type, ref_plan['hass'], history_size)
+            new_ref = Reference( curr_poller, ref_def)
+            # keep the plan referenced, so its id can't be reused while the entry exists
+            ConfigYaml._shared_ref_defs[id(ref_plan)] = (ref_plan, ref_def)
+            return new_ref
         except Exception as e:
             logger.error( f'Config error parsing device/referece {curr_poller.device.name}/{this_ref_opts["topic"]} ({config_source}): {e}')
             config_error_count += 1
+            return None
+
+
+###################################################################################################################
+#
+# Reloading YAML config files while running
+#
+# A reload is triggered by SIGHUP or by publishing to <topic_base>/<clientId>/set/reload-config.
+# The new plan is diffed against the running objects and only the delta is applied:
+#   - Devices whose own options changed are rebuilt completely, new ones are added, removed ones are stopped.
+#   - For unchanged devices, pollers are compared by their plan (including all references).
+#     Unchanged pollers keep running with their state and schedule, all others are swapped.
+# Before anything running is touched, the whole new plan is built once in isolation. With any config error there,
+# the running configuration is kept completely.
+#
+
+class ConfigReloader:
+
+    def __init__(self, yaml_file_name:str, mqttc:MqttClient, modbus_master:ModbusMaster, modbus_writer:ModbusWriter, hass_connector:'HassConnector'=None) -> None:
+        self.yaml_file_name = yaml_file_name
+        self.mqttc = mqttc
+        self.modbus_master = modbus_master
+        self.modbus_writer = modbus_writer
+        self.hass_connector = hass_connector
+        self.reload_event = asyncio.Event()
+        self.task_group = None
+        self.runtask = None
+
+    async def on_reload_command(self, payload:bytes) -> None:
+        self.reload_event.set()
+
+    def run_workloop(self, task_group):
+        #...........................................................................................
+        async def workloop():
+            try:
+                while True:
+                    await self.reload_event.wait()
+                    self.reload_event.clear()
+                    try:
+                        await self.reload()
+                    except Exception as e:
+                        logger.error(f'Error reloading config file {self.yaml_file_name}: {e}')
+            except asyncio.exceptions.CancelledError as e:
+                logger.debug(f'Config reloader task stopped ({self}).')
+        #...........................................................................................
+        self.task_group = task_group
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload_event.set)
+        except (NotImplementedError, AttributeError):
+            logger.info(f'Reloading config by SIGHUP is not supported on this platform.')
+        self.modbus_writer.register_daemon_command('reload-config', self.on_reload_command)
+        self.runtask = task_group.create_task(workloop(), name='config-reloader')
+
+
+    async def reload(self) -> None:
+        logger.info(f'Reloading config file {self.yaml_file_name}')
+        plans = ConfigYaml.reread_plan(self.yaml_file_name)
+        if plans is None:
+            logger.error(f'Config errors in {self.yaml_file_name}. Keeping the running configuration.')
             return
+        (old_plan, new_plan) = plans
+        if old_plan['daemon'] != new_plan['daemon']:
+            logger.warning(f'Changed daemon options in {self.yaml_file_name} require a restart. Ignoring them.')
+
+        error_count_before = config_error_count
+        self.apply(new_plan)
+        if config_error_count == error_count_before:
+            ConfigYaml._store_plan_cache(self.yaml_file_name)
+
+        if self.hass_connector is not None:
+            await self.hass_connector.update_hass_autodiscovery()
+
+
+    def validate(self, new_plan:dict) -> bool:
+        # Trial build of the new plan with its own device/poller registries, MQTT topic registrations and Modbus master,
+        # so it neither sees nor changes the running objects. The trial objects are simply dropped afterwards.
+        error_count_before = config_error_count
+        saved_registries = (Device.all_devices, Poller.all_poller, Poller._poller_count, ConfigYaml._shared_ref_defs)
+        Device.all_devices = dict()
+        Poller.all_poller = list()
+        ConfigYaml._shared_ref_defs = dict()
+        trial_mqttc = copy.copy(self.mqttc)
+        trial_mqttc.unique_topic_publish_list = set()
+        trial_mqttc.unique_topic_subscribe_list = set()
+        trial_mqttc._register_daemon_topics()
+        trial_master = copy.copy(self.modbus_master)
+        trial_master.devices = list()
+        log_level = logger.level
+        logger.setLevel(max(log_level, logging.WARNING)) # The devices get built again, only report problems
+        try:
+            ConfigYaml._build_devices(new_plan, ConfigSource(self.yaml_file_name), trial_mqttc, trial_master)
+        finally:
+            (Device.all_devices, Poller.all_poller, Poller._poller_count, ConfigYaml._shared_ref_defs) = saved_registries
+            logger.setLevel(log_level)
+        return config_error_count == error_count_before
 
-        # the remaining options are errnous
-        local_errors = 0
-        for ref_key in reference_dict:
-            logger.error( f'Unknown/illegal yaml reference option in device/referece {curr_poller.device.name}/{this_ref_opts["topic"]}')
-            local_errors += 1
-        config_error_count += local_errors
+
+    def apply(self, new_plan:dict) -> None:
+        if not self.validate(new_plan):
+            logger.error(f'Config errors in {self.yaml_file_name}. Keeping the running configuration.')
+            return
+        config_source = ConfigSource(self.yaml_file_name)
+        ConfigYaml._shared_ref_defs.clear()
+        live_devices = { dev.config_plan['opts']['name']: dev for dev in list(Device.all_devices.values()) if dev.config_plan is not None }
+        new_dev_plans = { dev_plan['opts']['name']: dev_plan for dev_plan in new_plan['devices'] }
+        cnt_added = cnt_removed = cnt_changed = 0
+
+        # Remove all devices that vanished or changed on device level
+        kept_devices = dict()
+        for name, dev in live_devices.items():
+            dev_plan = new_dev_plans.get(name)
+            if dev_plan is None or dev_plan['opts'] != dev.config_plan['opts'] or dev_plan['hass'] != dev.config_plan['hass']:
+                dev.remove()
+                cnt_removed += 1
+            else:
+                kept_devices[name] = dev
+
+        for name, dev_plan in new_dev_plans.items():
+            dev = kept_devices.get(name)
+            if dev is None:
+                # New or rebuilt device
+                new_device = ConfigYaml._build_device( dev_plan, config_source, self.mqttc, self.modbus_master)
+                if new_device is not None:
+                    self._start_device(new_device)
+                    cnt_added += 1
+                continue
+
+            # Device unchanged, diff its pollers
+            unmatched_plans = list(dev_plan['pollers'])
+            for poller in list(dev.pollers):
+                if poller.config_plan in unmatched_plans:
+                    unmatched_plans.remove(poller.config_plan)
+                else:
+                    poller.remove()
+                    cnt_changed += 1
+            for poller_plan in unmatched_plans:
+                new_poller = ConfigYaml._build_poller( poller_plan, config_source, dev, self.mqttc)
+                if new_poller is not None:
+                    new_poller.run_workloop(self.task_group)
+                    cnt_changed += 1
+            dev.config_plan = dev_plan
+
+        logger.info(f'Config reloaded: {cnt_added} devices added, {cnt_removed} devices removed, {cnt_changed} pollers added or removed.')
+
+
+    def _start_device(self, device:Device) -> None:
+        if self.modbus_master.is_connected():
+            device.enable()
+        for poller in device.pollers:
+            poller.run_workloop(self.task_group)
+
+
+    def __str__(self):
+        return f'config reloader: file:{self.yaml_file_name}'
 
 
 ###################################################################################################################
@@ -237,6 +652,7 @@ class ConfigSpicierCsv:
     #  ref,  topicName, startReg,       rw, dataType, scaling, formatStr
 
     def read_devices( csv_file, mqttc:MqttClient, modbus_master:ModbusMaster) -> None:        
+        import csv
         with csv_file as csvfile:
             csvfile.seek(0)
             reader = csv.reader(csvfile, quoting=csv.QUOTE_ALL, skipinitialspace=True)
@@ -304,7 +720,8 @@ class ConfigSpicierCsv:
                 config_error_count += 1
                 return
             
-            new_ref = Reference( config_source, mqttc, curr_poller, topic, start_reg, is_readable, is_writeable, data_type, scaling, None)
+            ref_def = ReferenceDef( config_source, curr_poller, topic, start_reg, None, is_readable, is_writeable, data_type, scaling, None)
+            new_ref = Reference( curr_poller, ref_def)
 
         except Exception as e:
             logger.error( f'Config error ({config_source}): {e}')
@@ -44,6 +44,15 @@ class DataConverter:
         "float32BE": lambda self, val : struct.unpack('=f', struct.pack('=I',int(val[1])<<16|int(val[0])))[0],
     }
 
+    _shared_converters = dict()
+
+    @classmethod
+    def get_converter(cls, type:str) -> 'DataConverter':
+        # Converters are immutable, so all references of the same data type can share one
+        if type not in DataConverter._shared_converters:
+            DataConverter._shared_converters[type] = DataConverter(type)
+        return DataConverter._shared_converters[type]
+
     def __init__(self, type:str):
         self.type = "uint16" if type is None or type == "" else type
         self.list_length = 0
@@ -94,12 +103,28 @@ class DataConverter:
         else:
             raise ValueError(f'Unknown data type "{self.type}".')
 
+    def is_numeric(self) -> bool:
+        # Single numbers and bools, no strings or lists
+        return self.type in DataConverter._reg_cnt_dict
+
     def str2mb(self, string):
         return self._str2mb_fct(self, string)
 
     def mb2py(self, val):
         return self._mb2py_fct(self, val)
 
+    def py2mb(self, value):
+        # Like str2mb, but also accepting typed values as decoded from binary payloads
+        if isinstance(value, str):
+            return self.str2mb(value)
+        if self._base_data_type is not None and isinstance(value, (list, tuple)):
+            if len(value) != self.list_length:
+                raise ValueError(f'Cannot interpret "{value}" as {self.type}.')
+            if self._base_data_type.reg_cnt == 1:
+                return [ self._base_data_type.py2mb(part) for part in value ]
+            return [ reg for part in value for reg in self._base_data_type.py2mb(part) ]
+        return self.str2mb(str(value))
+
 
     def _str2modbus_bool(self, payload:str) -> bool:
         payload=str(payload)
@@ -148,11 +173,17 @@ class DataConverter:
             raise ValueError(f'Cannot interpret "{payload}" as {self.type}.')
         out = []
         for part in all_parts:
-            out.append(self._base_data_type.str2mb(part))
+            regs = self._base_data_type.str2mb(part)
+            if isinstance(regs, list):
+                out.extend(regs)
+            else:
+                out.append(regs)
         return out
 
     def _mb2py_list(self, val):
-        out = ''
-        for part in val:
-            out += str(self._base_data_type.mb2py(part)) + ' '
-        return out.strip()
+        base_reg_cnt = self._base_data_type.reg_cnt
+        if base_reg_cnt == 1:
+            parts = val
+        else:
+            parts = [ val[idx:idx+base_reg_cnt] for idx in range(0, len(val), base_reg_cnt) ]
+        return ' '.join( str(self._base_data_type.mb2py(part)) for part in parts )
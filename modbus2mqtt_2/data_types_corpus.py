@@ -0,0 +1,52 @@
+#
+# Known good conversions for every data type
+#
+# Shared by the unit tests (test_data_types.py) and the micro benchmark (benchmarks/bench_data_types.py), so an
+# optimized converter is checked against the same cases it is measured with.
+#
+
+import struct
+
+# (data type, string as written via MQTT, Modbus registers, value as returned by mb2py)
+# Registers are given as on the bus. str2mb returns signed 16 bit types as negative numbers, compare them by their bits.
+ROUND_TRIP_CASES = [
+    ('bool',              'TRUE',                    1,                                              True),
+    ('bool',              'off',                     0,                                              False),
+    ('int16',             '0x1234',                  0x1234,                                         0x1234),
+    ('int16',             '-314',                    0xfec6,                                         -314),
+    ('uint16',            '0x8000',                  0x8000,                                         0x8000),
+    ('uint16',            '65222',                   0xfec6,                                         0xfec6),
+    ('int32LE',           '0x12345678',              [0x1234, 0x5678],                               0x12345678),
+    ('int32LE',           '-123442345',              [0xf8a4, 0x6b57],                               -123442345),
+    ('int32BE',           '0x12345678',              [0x5678, 0x1234],                               0x12345678),
+    ('int32BE',           '-123442345',              [0x6b57, 0xf8a4],                               -123442345),
+    ('uint32LE',          '0xfedcba98',              [0xfedc, 0xba98],                               0xfedcba98),
+    ('uint32BE',          '0xfedcba98',              [0xba98, 0xfedc],                               0xfedcba98),
+    ('float32LE',         '-3.1415926',              [0xc049, 0x0fda],                               -3.1415926),
+    ('float32BE',         '3.1415926',               [0x0fda, 0x4049],                               3.1415926),
+    ('stringLE10',        'ShortStr',                [0x6853, 0x726f, 0x5374, 0x7274, 0x0000],       'ShortStr'),
+    ('stringLE10',        'OddLenStr',               [0x644f, 0x4c64, 0x6e65, 0x7453, 0x0072],       'OddLenStr'),
+    ('stringBE10',        'ExactLen90',              [0x4578, 0x6163, 0x744c, 0x656e, 0x3930],       'ExactLen90'),
+    ('stringBE10',        'OddLenStr',               [0x4f64, 0x644c, 0x656e, 0x5374, 0x7200],       'OddLenStr'),
+    ('list-bool-5',       'True True False False True', [1, 1, 0, 0, 1],                             'True True False False True'),
+    ('list-int16-5',      '4660 -314 1 18 291',      [0x1234, 0xfec6, 1, 18, 291],                   '4660 -314 1 18 291'),
+    ('list-uint16-5',     '4660 32768 17185 402 65535', [0x1234, 0x8000, 0x4321, 0x0192, 0xffff],    '4660 32768 17185 402 65535'),
+    ('list-int32LE-2',    '305419896 -123442345',    [0x1234, 0x5678, 0xf8a4, 0x6b57],               '305419896 -123442345'),
+    ('list-int32BE-2',    '305419896 -123442345',    [0x5678, 0x1234, 0x6b57, 0xf8a4],               '305419896 -123442345'),
+    ('list-uint32LE-2',   '305419896 4275878552',    [0x1234, 0x5678, 0xfedc, 0xba98],               '305419896 4275878552'),
+    ('list-uint32BE-2',   '305419896 4275878552',    [0x5678, 0x1234, 0xba98, 0xfedc],               '305419896 4275878552'),
+    ('list-float32LE-2',  '3.5 -1.25',               [0x4060, 0x0000, 0xbfa0, 0x0000],               '3.5 -1.25'),
+    ('list-float32BE-2',  '3.5 -1.25',               [0x0000, 0x4060, 0x0000, 0xbfa0],               '3.5 -1.25'),
+]
+
+# (data type, string as written via MQTT, expected exception)
+STR2MB_ERROR_CASES = [
+    ('bool',              'maybe',                   ValueError),
+    ('int16',             '0x8000',                  OverflowError),
+    ('uint16',            '-4095',                   OverflowError),
+    ('int32LE',           '0xfedcba98',              struct.error),
+    ('uint32BE',          '-1',                      OverflowError),
+    ('float32LE',         'pi',                      ValueError),
+    ('stringBE10',        'TooLongString',           ValueError),
+    ('list-uint16-3',     '1 2',                     ValueError),
+]
@@ -0,0 +1,41 @@
+import asyncio
+
+from .globals import logger
+
+
+###################################################################################################################
+#
+# Choosing the event loop implementation
+#
+# 'asyncio' is the standard library's loop. 'uvloop' (based on libuv) cuts the CPU time spent on socket I/O and timers,
+# which adds up with hundreds of pollers. It is optional and only imported when asked for. 'auto' uses uvloop if it is
+# installed, asyncio's loop otherwise.
+#
+
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+
+
+def get_loop_factory(event_loop:str):
+    # Returns the loop factory for asyncio.Runner, None for asyncio's default loop
+    if event_loop not in EVENT_LOOPS:
+        raise ValueError(f'Unknown event loop "{event_loop}". Must be one of {list(EVENT_LOOPS)}.')
+    if event_loop == 'asyncio':
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        if event_loop == 'uvloop':
+            logger.warning('Event loop "uvloop" requires the python package uvloop. Using the asyncio event loop.')
+        return None
+    return uvloop.new_event_loop
+
+
+def get_loop_name(loop:asyncio.AbstractEventLoop) -> str:
+    return 'uvloop' if type(loop).__module__.startswith('uvloop') else 'asyncio'
+
+
+def run(coro, event_loop:str='auto'):
+    # Like asyncio.run(), on the configured event loop
+    with asyncio.Runner(loop_factory=get_loop_factory(event_loop)) as runner:
+        logger.info(f'Using the {get_loop_name(runner.get_loop())} event loop.')
+        return runner.run(coro)
@@ -23,8 +23,10 @@ logger = logging.getLogger('main-logger')
 # Configuration options for daemon section with default values
 deamon_opts = {
     'config':                   None,
+    'config-cache':             None,               # File for caching the compiled configuration (command line only)
     'rtu':                      None,               # pyserial URL (or port name) for RTU serial port
     'tcp':                      None,               # Act as a Modbus TCP master, connecting to host TCP
+    'replay':                   None,               # Replay the Modbus responses from a capture file instead of connecting to Modbus
 
     # MQTT broker options: All options for connecting to an MQTT broker
     'mqtt-host':                'localhost',        # MQTT server address. Defaults to "localhost"
@@ -36,26 +38,43 @@ deamon_opts = {
     'mqtt-insecure':            False,              # Use TLS without providing certificates
     'mqtt-cacerts':             None,               # Path to keychain
     'mqtt-tls-version':         None,               # TLS protocol version, can be one of tlsv1.2 tlsv1.1 or tlsv1
+    'mqtt-protocol':            '3.1.1',            # MQTT protocol version, '3.1.1' or '5'. Responses to response topics with correlation data need '5'
 
     # MQTT publish options: All options influencing the MQTT related behaviour
     'mqtt-topic':               'modbus/',          # Topic prefix to be used for subscribing/publishing. Defaults to "modbus/"
     'mqtt-value-qos':           0,                  # QoS value for publishing values. Defaults to 0
     'publish-seconds':          300,                # Publish values after n seconds (0=always), even if they did not change.
     'retain-values':            False,              # Set retain flag for published modbus values.
+    'seed-retained-values':     0,                  # If retain-values is set, seconds to collect our own retained values at startup to avoid republishing unchanged values (0=off)
+    'payload-encoding':         'text',             # Encoding of published values and set payloads ('text', 'cbor', 'msgpack'). Can be overridden per device.
 
     # Modbus connection options: All options influencing the Modbus connection related behaviour
     'rtu-baud':                 19200,              # Baud rate for serial port. Defaults to 19200
     'rtu-parity':               'even',             # Parity for serial port ('even', 'odd', 'none). Defaults to even
     'tcp-port':                 502,                # Port for MODBUS TCP. Defaults to 502
+    'replay-speed':             1.0,                # Speed factor for replaying a capture file. Poll rates and response times are scaled by it.
 
     # Modbus running options: Modbus related options during running
     'set-modbus-timeout':       1.0,                # Response time-out for Modbus devices
+    'get-ttl':                  1.0,                # Get requests are answered from the last poll if it is younger than this (in seconds), otherwise the poller reads again
+    'capture':                  None,               # Record all Modbus requests and responses to this capture file (optional)
     'avoid-fc6':                False,              # If set, use function code 16 (write multiple registers) even when just writing a single register
+    'modbus-server-port':       0,                  # TCP port for serving the polled registers to other Modbus TCP masters (0=off)
+    'modbus-server-address':    None,               # Address to bind the Modbus TCP server to. Default: All interfaces
+    'split-retry':              600.0,              # Seconds after which a poller split because of illegal data addresses tries its whole range again
+    'workers':                  0,                  # Number of worker processes to share the devices between (0 or 1=all in one process). Modbus TCP only.
 
     # Misc options
     'diagnostics-rate':         0,                  # Time in seconds after which for each device diagnostics are published via mqtt. Set to sth. like 600 (= every 10 minutes) or so.
+    'metrics-port':             0,                  # TCP port for serving metrics in OpenMetrics/Prometheus format via HTTP (0=off)
+    'profile-dir':              None,               # Directory to additionally write the results of the profiling commands to
+    'event-loop':               'auto',             # Event loop implementation ('auto', 'asyncio', 'uvloop'). auto uses uvloop if it is installed.
+    'loop-block-threshold':     0,                  # Event loop stalls longer than this (in seconds) are reported with the blocking stack (0=no loop monitoring)
     'add-to-homeassistant':     False,              # Add devices to Home Assistant using Home Assistant\'s MQTT-Discovery
     'hass-discovery-prefix':    'homeassistant',    # Add devices to Home Assistant using Home Assistant\'s MQTT-Discovery
+    'hass-discovery-rate':      100,                # Max. number of autodiscovery messages published per second (0=unlimited)
+    'hass-birth-topic':         'homeassistant/status', # Topic of Home Assistant\'s birth message. On receiving "online", autodiscovery is republished.
+    'hass-seed-retained':       2.0,                # Seconds to collect our retained autodiscovery messages at startup, to only publish what changed (0=publish all)
     'verbosity':                'info',             # Verbosity level ('debug', 'info', 'warning', 'error', 'critical')
 }
 
@@ -63,6 +82,10 @@ deamon_opts = {
 device_opts = {
     'name':         None,   # The name of the device.
     'slave-id':     None,   # Modbus slave address
+    'profile':      None,   # Name of a device profile from the Profiles section the device is instantiated from
+    'payload-encoding': None,   # Encoding of values ('text', 'cbor', 'msgpack'). If undefined, the daemon's payload-encoding will be used
+    'payload-batch':    False,  # Publish the changed values of each poll as one document to <device>/batch instead of one topic per reference
+    'bus':              None,   # Name of the serial bus behind a Modbus TCP gateway the device is on. With workers, devices on one bus are polled by the same worker.
 }
 
 # Configuration options for poller section with default values
@@ -83,5 +106,6 @@ ref_opts = {
     'data-type':            None, # if undefined, a default depending on the poller type will be used
     'scaling':              None,
     'format-str':           None,
+    'history':              0,    # Number of recent samples kept for requests to <device>/get-history/<topic> (0=no history). Numeric data-types only.
     'hass_entity_type':     None,
 }
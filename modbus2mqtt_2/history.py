@@ -0,0 +1,52 @@
+import bisect
+
+from array import array
+
+
+###################################################################################################################
+#
+# Ring buffer of recent samples of a reference
+#
+# Timestamps and values are kept in two preallocated arrays of doubles, 16 bytes per sample, no python object per
+# sample. When full, the oldest sample gets overwritten. The timestamps must not decrease, so the references record
+# them on the monotonic clock and convert them to wall clock time only for reporting. With time.time(), a clock step
+# (e.g. NTP setting the clock of a gateway without RTC) would break the order the window search relies on.
+#
+
+class HistoryBuffer:
+
+    __slots__ = ('size', 'timestamps', 'values', 'next_idx', 'count')
+
+    def __init__(self, size:int) -> None:
+        if size <= 0:
+            raise ValueError(f'History size must be positive, not {size}.')
+        self.size = size
+        self.timestamps = array('d', bytes(8*size))
+        self.values = array('d', bytes(8*size))
+        self.next_idx = 0
+        self.count = 0
+
+    def append(self, timestamp:float, value:float) -> None:
+        idx = self.next_idx
+        self.timestamps[idx] = timestamp
+        self.values[idx] = value
+        self.next_idx = idx+1 if idx+1 < self.size else 0
+        if self.count < self.size:
+            self.count += 1
+
+    def window(self, since:float=None, until:float=None, max_samples:int=None) -> tuple[list[float], list[float]]:
+        # Samples with since <= timestamp <= until, oldest first. With max_samples, only the most recent ones.
+        if self.count < self.size:
+            timestamps = self.timestamps[:self.count]
+            values = self.values[:self.count]
+        else:
+            timestamps = self.timestamps[self.next_idx:] + self.timestamps[:self.next_idx]
+            values = self.values[self.next_idx:] + self.values[:self.next_idx]
+        first = bisect.bisect_left(timestamps, since) if since is not None else 0
+        last = bisect.bisect_right(timestamps, until) if until is not None else len(timestamps)
+        if max_samples is not None:
+            first = max(first, last-max_samples)
+        return (timestamps[first:last].tolist(), values[first:last].tolist())
+
+    def __len__(self) -> int:
+        return self.count
@@ -1,6 +1,7 @@
+import asyncio
+import hashlib
 import json
 import re
-import jsons
 
 from .mqtt_client import MqttClient
 from .modbus_objects import Device, Reference
@@ -24,20 +25,99 @@ def staticinit(cls):
 #
 
 class HassConnector:
-    @classmethod
-    def publish_hass_autodiscovery(cls, mqttc:MqttClient) -> None :
-        mqttc.register_hass_topics()
+
+    def __init__(self, mqttc:MqttClient, publish_rate:float, birth_topic:str, seed_time:float=0) -> None:
+        self.mqttc = mqttc
+        self.publish_rate = publish_rate      # max. autodiscovery messages per second (0=unlimited)
+        self.birth_topic = birth_topic
+        self.seed_time = seed_time            # seconds to collect our retained autodiscovery messages at startup (0=publish all)
+        self.payload_cache = dict()           # rel_topic -> (json_str, digest), serialized once
+        self.published_digests = dict()       # rel_topic -> digest of the last retained publish
+        self.republish_event = asyncio.Event()
+        self.loop = None
+        self.runtask = None
+
+    def build_autodiscovery_cache(self) -> None:
+        self.payload_cache = dict()
         for dev in Device.all_devices.values() :
             ha_dev = HassDevice( dev)
             for ref in dev.references.values() :
                 try:
                     ha_entity = HassEntity.new_entity_for_reference(ref, ha_dev)
-                    autodisco_topic = ha_entity.get_autodiscovery_rel_topic()
                     json_str = ha_entity.get_autodiscovery_value()
-                    mqttc.publish_hass_autodiscovery_entity(autodisco_topic, json_str)
+                    self.payload_cache[ha_entity.get_autodiscovery_rel_topic()] = (json_str, HassConnector._digest(json_str.encode('utf-8')))
                 except Exception as e:
                     logger.warning( f'Home Assistant: Error generating autodiscovery for  "{ref.poller.device.name}/{ref.topic}": {e}')
 
+    @staticmethod
+    def _digest(payload:bytes) -> bytes:
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    async def seed_published_digests(self) -> None :
+        # Take the digests from the retained autodiscovery messages of our devices, published before a restart.
+        # Only what changed since then gets published, entities gone since then get removed.
+        base = self.mqttc.get_topic_hass_autoconfig_base()
+        node_ids = { rel_topic.split('/')[1] for rel_topic in self.payload_cache }
+        retained = await self.mqttc.collect_retained(f'{base}/+/+/+/config', self.seed_time)
+        for (topic, payload) in retained.items():
+            rel_topic = topic.removeprefix(base+'/')
+            if payload and rel_topic.split('/')[1] in node_ids:
+                self.published_digests[rel_topic] = HassConnector._digest(payload)
+        self.remove_stale_entities()
+
+    def remove_stale_entities(self) -> None :
+        for rel_topic in list(self.published_digests):
+            if rel_topic not in self.payload_cache:
+                self.mqttc.publish_hass_autodiscovery_entity(rel_topic, '') # an empty retained payload removes the entity
+                del self.published_digests[rel_topic]
+
+    async def publish_hass_autodiscovery(self, force:bool=False) -> None :
+        # Only publish entities whose payload changed since our last retained publish, unless forced.
+        # Publishing is paced to avoid bursts hitting the broker and Home Assistant.
+        burst_len = max(1, int(self.publish_rate/10)) if self.publish_rate > 0 else 0
+        pub_cnt = 0
+        for rel_topic, (json_str, digest) in list(self.payload_cache.items()):
+            if not force and self.published_digests.get(rel_topic) == digest:
+                continue
+            self.mqttc.publish_hass_autodiscovery_entity(rel_topic, json_str)
+            self.published_digests[rel_topic] = digest
+            pub_cnt += 1
+            if burst_len and pub_cnt % burst_len == 0:
+                await asyncio.sleep(burst_len/self.publish_rate)
+        logger.info(f'Home Assistant: Published {pub_cnt} of {len(self.payload_cache)} autodiscovery entities.')
+
+    async def update_hass_autodiscovery(self) -> None :
+        # Rebuild after a config change: publish changed entities and remove the ones which are gone
+        self.build_autodiscovery_cache()
+        self.remove_stale_entities()
+        await self.publish_hass_autodiscovery()
+
+    def on_hass_status(self, payload:str) -> None:
+        # Called from within the MQTT client's thread
+        if payload == 'online' and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.republish_event.set)
+
+    def run_workloop(self, task_group):
+        #...........................................................................................
+        async def workloop():
+            try:
+                if self.seed_time > 0:
+                    await self.seed_published_digests()
+                await self.publish_hass_autodiscovery()
+                while True:
+                    await self.republish_event.wait()
+                    self.republish_event.clear()
+                    logger.info(f'Home Assistant: Birth message received. Republishing autodiscovery.')
+                    await self.publish_hass_autodiscovery(force=True)
+            except asyncio.exceptions.CancelledError as e:
+                logger.debug(f'Home Assistant task stopped ({self}).')
+        #...........................................................................................
+        self.loop = asyncio.get_running_loop()
+        self.mqttc.register_hass_topics()
+        self.build_autodiscovery_cache()
+        self.mqttc.subscribe_hass_birth(self.birth_topic, self.on_hass_status)
+        self.runtask = task_group.create_task(workloop(), name='hass-autodiscovery')
+
 
 ###################################################################################################################
 #
@@ -75,6 +155,8 @@ class HassDevice :
         # identifiers                           |     |   X   | A list of IDs that uniquely identify the device.
     }
 
+    _ui_short_name = None
+
     @classmethod
     def get_config_options(cls) -> dict :
         return HassDevice._config_options
@@ -225,9 +307,12 @@ class HassEntity :
         return f'{self._entity_type}/{node_id}/{obj_id}/config'
 
     def get_autodiscovery_value(self) -> str:
-        dump = jsons.dump(self, strip_nulls=False, strip_privates=True)
-        #dump = jsons.dump(self, strip_nulls=True, strip_privates=True)
-        return json.JSONEncoder( skipkeys=False, ensure_ascii=True, check_circular=True, allow_nan=True, sort_keys=False, indent=2, separators=None, default=None).encode(dump)
+        return json.dumps(self, default=HassEntity._public_attrs, separators=(',',':'))
+
+    @staticmethod
+    def _public_attrs(obj) -> dict:
+        # Serialize our HASS objects by their public attributes. Private ones (leading "_") are not for json.
+        return { attr: value for attr, value in vars(obj).items() if not attr.startswith('_') }
 
 
 ###################################################################################################################
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+from .globals import logger
+from .mqtt_client import MqttClient
+
+
+###################################################################################################################
+#
+# Monitoring the event loop
+#
+# A ticker task wakes up every tick_interval and measures how late it got scheduled. A stalled loop delays all pollers,
+# so this tells loop starvation apart from bus trouble.
+# A watchdog thread notices when the ticker is overdue by more than block_threshold and captures the stack of the
+# event loop thread, i.e. the callback blocking the loop. When the loop resumes, the stall is published to
+# <topic_base>/<clientId>/diagnostics/loop together with the task counts per subsystem.
+# Tasks are named "<subsystem>:<detail>", the subsystem is the part before the colon.
+#
+
+class LoopMonitor:
+
+    tick_interval = 0.05
+    tasks_update_interval = 5.0
+
+    def __init__(self, mqtt_client:MqttClient, block_threshold:float) -> None:
+        self.mqtt_client = mqtt_client
+        self.block_threshold = block_threshold
+        self.lag = metrics.event_loop_lag.labels()
+        self.lag_last = self.lag.copy()
+        self.blocked_cnt = 0
+        self.blocked_cnt_last = 0
+        self.lag_max = 0.0
+        self.loop_thread_id = None
+        self.last_tick = None
+        self.captured_tick = None
+        self.captured_stack = None
+        self.stop_event = threading.Event()
+        self.runtask = None
+
+    @staticmethod
+    def count_tasks_by_subsystem() -> dict:
+        counts = dict()
+        for task in asyncio.all_tasks():
+            name = task.get_name()
+            subsystem = name.split(':', 1)[0] if not name.startswith('Task-') else 'other'
+            counts[subsystem] = counts.get(subsystem, 0) + 1
+        return counts
+
+    def update_task_metrics(self) -> dict:
+        counts = LoopMonitor.count_tasks_by_subsystem()
+        for label_values in list(metrics.asyncio_tasks.children):
+            if label_values[0] not in counts:
+                metrics.asyncio_tasks.labels(*label_values).set(0)
+        for (subsystem, count) in counts.items():
+            metrics.asyncio_tasks.labels(subsystem).set(count)
+        return counts
+
+    def watchdog(self) -> None:
+        # Runs in its own thread, as it has to look at the loop while the loop is blocked
+        while not self.stop_event.wait(self.block_threshold/2):
+            tick = self.last_tick
+            if tick is None or self.captured_tick == tick:
+                continue
+            if time.perf_counter() - tick > self.tick_interval + self.block_threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                self.captured_stack = ''.join(traceback.format_stack(frame)) if frame is not None else None
+                self.captured_tick = tick
+
+    def on_blocked(self, lag:float, tick:float) -> None:
+        self.blocked_cnt += 1
+        metrics.event_loop_blocked.labels().inc()
+        stack = self.captured_stack if self.captured_tick == tick else None
+        logger.warning(f'Event loop blocked for {lag*1000:.0f} ms.' + (f' Stack:\n{stack}' if stack else ''))
+        doc = { 'lag-ms': round(lag*1000, 1), 'stack': stack, 'tasks': LoopMonitor.count_tasks_by_subsystem() }
+        self.mqtt_client.publish_modbus_diagnostics('loop', json.dumps(doc))
+
+    def get_interval_document(self) -> dict:
+        # Loop health since the previous call, for the daemon's diagnostics
+        lag = self.lag.copy()
+        lag_diff = lag.diff(self.lag_last)
+        self.lag_last = lag
+        doc = {
+            'lag-ms': { key: round(min(lag_diff.quantile(q), self.lag_max)*1000, 2) if lag_diff.count > 0 else None for (key, q) in (('p50', 0.5), ('p99', 0.99)) },
+            'lag-max-ms': round(self.lag_max*1000, 2),
+            'blocked': self.blocked_cnt - self.blocked_cnt_last,
+            'tasks': LoopMonitor.count_tasks_by_subsystem(),
+        }
+        self.lag_max = 0.0
+        self.blocked_cnt_last = self.blocked_cnt
+        return doc
+
+    def run_workloop(self, task_group):
+        self.loop_thread_id = threading.get_ident()
+        #...........................................................................................
+        async def workloop():
+            watchdog_thread = threading.Thread(target=self.watchdog, name='loop-watchdog', daemon=True)
+            watchdog_thread.start()
+            try:
+                self.last_tick = time.perf_counter()
+                next_tasks_update = self.last_tick
+                while True:
+                    await asyncio.sleep(self.tick_interval)
+                    tick = self.last_tick
+                    now = time.perf_counter()
+                    self.last_tick = now
+                    lag = max(0.0, now - tick - self.tick_interval)
+                    self.lag.observe(lag)
+                    self.lag_max = max(self.lag_max, lag)
+                    try:
+                        if lag > self.block_threshold:
+                            self.on_blocked(lag, tick)
+                        if now >= next_tasks_update:
+                            self.update_task_metrics()
+                            next_tasks_update = now + self.tasks_update_interval
+                    except Exception as e:
+                        logger.error(f'Error reporting event loop health ({self}): {e}')
+            except asyncio.exceptions.CancelledError as e:
+                logger.debug(f'Loop monitor task stopped ({self}).')
+            finally:
+                self.stop_event.set()
+        #...........................................................................................
+        self.runtask = task_group.create_task(workloop(), name='loop-monitor')
+
+    def __str__(self):
+        return f'loop monitor: threshold:{self.block_threshold}'
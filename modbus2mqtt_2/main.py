@@ -17,18 +17,19 @@
 
 
 import argparse
-import time
+import json
 import sys
 import asyncio
 
 import modbus2mqtt_2.globals as globs
 import modbus2mqtt_2.config_reader as config_reader
+import modbus2mqtt_2.event_loop as event_loop
 
-from .config_reader import ConfigYaml, ConfigSpicierCsv
+from .config_reader import ConfigYaml, ConfigSpicierCsv, ConfigReloader
+from .event_loop import EVENT_LOOPS
 from .globals import logger, deamon_opts
-from .modbus_objects import ModbusMaster, ModbusWriter, Device, Poller
+from .modbus_objects import ModbusMaster, ModbusWriter, ModbusStats, PollerStats, Device, Poller
 from .mqtt_client import MqttClient
-from .home_assistant import HassConnector
 
 
 class DiagnosticsMaster:
@@ -37,6 +38,8 @@ class DiagnosticsMaster:
         self.diag_rate = diag_rate
         self.mqtt_client = mqtt_client
         self.mb_master = mb_master
+        self.loop_monitor = None
+        self.stats_topic = 'stats'
         self.runtask = None
 
     def run_workloop(self, task_group):
@@ -62,34 +65,98 @@ class DiagnosticsMaster:
                 logger.debug(f'Diagnostics task stopped ({self}).')
         #...........................................................................................
         if self.diag_rate > 0:
-            self.runtask = task_group.create_task(workloop())
+            self.runtask = task_group.create_task(workloop(), name='diagnostics')
+
+    @staticmethod
+    def _rate(count:float, interval:float) -> float|None:
+        return round(count/interval, 3) if interval > 0 else None
+
+    @staticmethod
+    def modbus_stats_document(stats:ModbusStats, diff_stats:ModbusStats) -> dict:
+        interval = diff_stats.timestamp
+        doc = { 'interval-s': round(interval, 3) }
+        for (name, count, errors, count_total, errors_total) in (
+                ('reads', diff_stats.reads_total, diff_stats.reads_error, stats.reads_total, stats.reads_error),
+                ('writes', diff_stats.writes_total, diff_stats.writes_error, stats.writes_total, stats.writes_error)):
+            doc[name] = {
+                'count': count,
+                'errors': errors,
+                'rate': DiagnosticsMaster._rate(count, interval),
+                'error-rate': DiagnosticsMaster._rate(errors, interval),
+                'count-since-start': count_total,
+                'errors-since-start': errors_total,
+            }
+        # Quantiles of lock wait and wire time in ms per function code
+        doc['timing'] = dict()
+        for (function_code, timing) in diff_stats.get_timing_quantiles().items():
+            doc['timing'][f'fc{function_code}'] = {
+                'count': timing['count'],
+                'lock-wait-ms': { key: round(value*1000, 2) for (key, value) in timing['lock-wait'].items() },
+                'wire-ms': { key: round(value*1000, 2) for (key, value) in timing['wire'].items() },
+            }
+        return doc
+
+    @staticmethod
+    def poller_stats_document(poller:Poller, diff_stats:PollerStats, stats_old:PollerStats) -> dict:
+        polls = diff_stats.polls
+        # Actual period from the poll starts within the interval (the last one of the previous interval included)
+        actual_period = None
+        if polls > 0 and stats_old.last_start is not None:
+            actual_period = round((diff_stats.last_start-stats_old.last_start)/polls, 3)
+        return {
+            'configured-period-s': poller.poll_rate,
+            'actual-period-s': actual_period,
+            'polls': polls,
+            'failed': diff_stats.polls_failed,
+            'skipped': diff_stats.skipped,
+            'duration-ms': {
+                'mean': round(diff_stats.duration_sum/polls*1000, 2) if polls > 0 else None,
+                'max': round(diff_stats.duration_max*1000, 2),
+            },
+            'values-polled': diff_stats.values_polled,
+            'values-published': diff_stats.values_published,
+            'change-ratio': round(diff_stats.values_published/diff_stats.values_polled, 3) if diff_stats.values_polled > 0 else None,
+            'dead-registers': Poller._format_regs(poller.dead_regs) if poller.dead_regs else None,
+        }
 
     async def publish_modbus_diag(self, mb_master:ModbusMaster) -> None :
         (stats, stats_old) = mb_master.get_statistics()
         if stats_old == None:
             return
-        diff_stats = stats.diff_stat(stats_old)
-        value_template = '{{\n  "rate": "{:.1f}",\n  "count-relative": "{}",\n  "count-since-start": "{}"\n}}'
-        self.mqtt_client.publish_modbus_diagnostics('modbus-read-total', value_template.format(diff_stats.reads_total/diff_stats.timestamp, diff_stats.reads_total, stats.reads_total))
-        self.mqtt_client.publish_modbus_diagnostics('modbus-write-total', value_template.format(diff_stats.writes_total/diff_stats.timestamp, diff_stats.writes_total, stats.writes_total))
-        self.mqtt_client.publish_modbus_diagnostics('modbus-total-total', value_template.format((diff_stats.reads_total+diff_stats.writes_total)/diff_stats.timestamp, diff_stats.reads_total+diff_stats.writes_total, stats.reads_total+stats.writes_total))
-        self.mqtt_client.publish_modbus_diagnostics('modbus-read-err', value_template.format(diff_stats.reads_error/diff_stats.timestamp, diff_stats.reads_error, stats.reads_error))
-        self.mqtt_client.publish_modbus_diagnostics('modbus-write-err', value_template.format(diff_stats.writes_error/diff_stats.timestamp, diff_stats.writes_error, stats.writes_error))
-        self.mqtt_client.publish_modbus_diagnostics('modbus-total-err', value_template.format((diff_stats.reads_error+diff_stats.writes_error)/diff_stats.timestamp, diff_stats.reads_error+diff_stats.writes_error, stats.reads_error+stats.writes_error))
+        doc = DiagnosticsMaster.modbus_stats_document(stats, stats.diff_stat(stats_old))
+        if self.loop_monitor is not None:
+            doc['loop'] = self.loop_monitor.get_interval_document()
+        self.mqtt_client.publish_modbus_diagnostics(self.stats_topic, json.dumps(doc))
     
     async def publish_device_diag(self, dev:Device) -> None :
         (stats, stats_old) = dev.get_statistics()
+        poller_stats = [ (poller, *poller.get_statistics()) for poller in dev.pollers ]
         if stats_old == None:
             return
-        diff_stats = stats.diff_stat(stats_old)
-        value_template = '{{\n  "rate": "{:.1f}",\n  "count-relative": "{}",\n  "count-since-start": "{}"\n}}'
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-read-total', value_template.format(diff_stats.reads_total/diff_stats.timestamp, diff_stats.reads_total, stats.reads_total))
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-write-total', value_template.format(diff_stats.writes_total/diff_stats.timestamp, diff_stats.writes_total, stats.writes_total))
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-total-total', value_template.format((diff_stats.reads_total+diff_stats.writes_total)/diff_stats.timestamp, diff_stats.reads_total+diff_stats.writes_total, stats.reads_total+stats.writes_total))
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-read-err', value_template.format(diff_stats.reads_error/diff_stats.timestamp, diff_stats.reads_error, stats.reads_error))
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-write-err', value_template.format(diff_stats.writes_error/diff_stats.timestamp, diff_stats.writes_error, stats.writes_error))
-        self.mqtt_client.publish_device_diagnostics(dev.name, 'modbus-total-err', value_template.format((diff_stats.reads_error+diff_stats.writes_error)/diff_stats.timestamp, diff_stats.reads_error+diff_stats.writes_error, stats.reads_error+stats.writes_error))
-
+        doc = DiagnosticsMaster.modbus_stats_document(stats, stats.diff_stat(stats_old))
+        doc['pollers'] = dict()
+        for (poller, p_stats, p_stats_old) in poller_stats:
+            if p_stats_old is not None:
+                doc['pollers'][poller.name] = DiagnosticsMaster.poller_stats_document(poller, p_stats.diff_stat(p_stats_old), p_stats_old)
+        self.mqtt_client.publish_device_diagnostics(dev.name, 'stats', json.dumps(doc))
+
+
+
+def new_mqtt_client() -> MqttClient:
+    return MqttClient(
+                    mqtt_host=deamon_opts['mqtt-host'], 
+                    mqtt_port=deamon_opts['mqtt-port'], 
+                    mqtt_clientid=deamon_opts['mqtt-clientid'], 
+                    mqtt_user=deamon_opts['mqtt-user'], 
+                    mqtt_pass=deamon_opts['mqtt-pass'],
+                    mqtt_cacerts=deamon_opts['mqtt-cacerts'], 
+                    mqtt_insecure=deamon_opts['mqtt-insecure'], 
+                    mqtt_tls_version=deamon_opts['mqtt-tls-version'], 
+                    topic_base=deamon_opts['mqtt-topic'],
+                    topic_hass_autodisco_base=deamon_opts['hass-discovery-prefix'],
+                    retain_values=deamon_opts['retain-values'],
+                    mqtt_value_qos=deamon_opts['mqtt-value-qos'],
+                    mqtt_protocol=deamon_opts['mqtt-protocol'])
 
 
 def main():
@@ -99,10 +166,12 @@ def main():
 
     parser = argparse.ArgumentParser(prog=globs.__myname__,description='Bridge between ModBus and MQTT')
     parser.add_argument('--config', default="config.yaml", type=argparse.FileType('r'), help='Configuration file. Required!')
+    parser.add_argument('--config-cache', help='File for caching the compiled yaml configuration. Speeds up startup if the configuration did not change.')
 
     connTypeGroup = parser.add_mutually_exclusive_group(required=False)
     connTypeGroup.add_argument('--rtu', help='pyserial URL (or port name) for RTU serial port')
     connTypeGroup.add_argument('--tcp', help='Act as a Modbus TCP master, connecting to host TCP')
+    connTypeGroup.add_argument('--replay', help='Replay the Modbus responses from a capture file instead of connecting to Modbus')
 
     mqttBrokerGroup = parser.add_argument_group( 'MQTT broker options', 'All options for connecting to an MQTT broker')
     mqttBrokerGroup.add_argument('--mqtt-host', help=f'MQTT server address. Default: "{deamon_opts["mqtt-host"]}"')
@@ -114,25 +183,39 @@ def main():
     mqttBrokerGroup.add_argument('--mqtt-insecure', type=bool, help=f'Use TLS without providing certificates. Default: "{deamon_opts["mqtt-insecure"]}"')
     mqttBrokerGroup.add_argument('--mqtt-cacerts', help="Path to keychain")
     mqttBrokerGroup.add_argument('--mqtt-tls-version', choices=['tlsv1.2', 'tlsv1.1', 'tlsv1'], help=f'TLS protocol version, can be one of tlsv1.2 tlsv1.1 or tlsv1.')
+    mqttBrokerGroup.add_argument('--mqtt-protocol', choices=['3.1.1', '5'], help=f'MQTT protocol version. Responses to the response topic of a request, with its correlation data, need "5". Default: "{deamon_opts["mqtt-protocol"]}"')
 
     mqttPubGroup = parser.add_argument_group( 'MQTT publish options', 'All options influencing the MQTT related behaviour')
     mqttPubGroup.add_argument('--mqtt-topic', help=f'Topic prefix to be used for subscribing/publishing. Default: "{deamon_opts["mqtt-topic"]}"')
     mqttPubGroup.add_argument('--mqtt-value-qos', type=int, choices=[0,1,2], help=f'QoS value for publishing values. Default: "{deamon_opts["mqtt-value-qos"]}"')
     mqttPubGroup.add_argument('--publish-seconds', type=int, help=f'Publish values after n seconds (0=always), even if they did not change. Default: {deamon_opts["publish-seconds"]}')
     mqttPubGroup.add_argument('--retain-values', type=bool, help=f'Set retain flag for published modbus values. Default: "{deamon_opts["retain-values"]}"')
+    mqttPubGroup.add_argument('--seed-retained-values', type=float, help=f'If retain-values is set, seconds to collect our own retained values at startup to avoid republishing unchanged values (0=off). Default: "{deamon_opts["seed-retained-values"]}"')
+    mqttPubGroup.add_argument('--payload-encoding', choices=['text', 'cbor', 'msgpack'], help=f'Encoding of published values and set payloads. Default: "{deamon_opts["payload-encoding"]}"')
 
     mbConnGroup = parser.add_argument_group( 'Modbus connection options', 'All options influencing the Modbus connection related behaviour')
     mbConnGroup.add_argument('--rtu-baud', type=int, help=f'Baud rate for serial port. Default: "{deamon_opts["rtu-baud"]}"')
     mbConnGroup.add_argument('--rtu-parity', choices=[ 'even', 'odd', 'none'], help=f'Parity for serial port. Default: "{deamon_opts["rtu-parity"]}"')
     mbConnGroup.add_argument('--tcp-port', type=int, help=f'Port for MODBUS TCP. Default: "{deamon_opts["tcp-port"]}"')
+    mbConnGroup.add_argument('--replay-speed', type=float, help=f'Speed factor for replaying a capture file. Poll rates and response times are scaled by it. Default: "{deamon_opts["replay-speed"]}"')
 
     mbWorkGroup = parser.add_argument_group( 'Modbus running options', 'Modbus related options during running')
     mbWorkGroup.add_argument('--set-modbus-timeout', type=float, help=f'Response time-out for Modbus devices. Default: "{deamon_opts["set-modbus-timeout"]}"')
+    mbWorkGroup.add_argument('--split-retry', type=float, help=f'Seconds after which a poller split because of illegal data addresses tries its whole range again. Default: "{deamon_opts["split-retry"]}"')
+    mbWorkGroup.add_argument('--get-ttl', type=float, help=f'Get requests are answered from the last poll if it is younger than this (in seconds), otherwise the poller reads again. Default: "{deamon_opts["get-ttl"]}"')
     #mbWorkGroup.add_argument('--autoremove', action='store_true', help='Automatically remove poller if modbus communication has failed three times. Removed pollers can be reactivated by sending "True" or "1" to topic modbus/reset-autoremove')
+    mbWorkGroup.add_argument('--capture', help='Record all Modbus requests and responses to this capture file (optional)')
+    mbWorkGroup.add_argument('--modbus-server-port', type=int, help=f'TCP port for serving the polled registers to other Modbus TCP masters (0=off). Default: "{deamon_opts["modbus-server-port"]}"')
+    mbWorkGroup.add_argument('--modbus-server-address', help='Address to bind the Modbus TCP server to. Default: All interfaces')
     mbWorkGroup.add_argument('--avoid-fc6', type=bool, help=f'If set, use function code 16 (write multiple registers) even when just writing a single register. Default: "{deamon_opts["avoid-fc6"]}"')
 
     miscGroup = parser.add_argument_group('Misc options', '')
+    miscGroup.add_argument('--workers', type=int, help=f'Number of worker processes to share the devices between (0 or 1=all in one process). Modbus TCP only. Default: "{deamon_opts["workers"]}"')
     miscGroup.add_argument('--diagnostics-rate', type=float, help=f'Time in seconds after which for each device diagnostics are published via mqtt. Default: "{deamon_opts["diagnostics-rate"]}"')
+    miscGroup.add_argument('--metrics-port', type=int, help=f'TCP port for serving metrics in OpenMetrics/Prometheus format via HTTP (0=off). Default: "{deamon_opts["metrics-port"]}"')
+    miscGroup.add_argument('--profile-dir', help='Directory to additionally write the results of the profiling commands to (optional)')
+    miscGroup.add_argument('--event-loop', choices=EVENT_LOOPS, help=f'Event loop implementation. auto uses uvloop if it is installed. Default: "{deamon_opts["event-loop"]}"')
+    miscGroup.add_argument('--loop-block-threshold', type=float, help=f'Event loop stalls longer than this (in seconds) are reported with the blocking stack (0=no loop monitoring). Default: "{deamon_opts["loop-block-threshold"]}"')
     miscGroup.add_argument('--add-to-homeassistant', type=bool, help=f'Add devices to Home Assistant using Home Assistant\'s MQTT-Discovery. Default: "{deamon_opts["add-to-homeassistant"]}"')
     miscGroup.add_argument('--verbosity', choices=['debug', 'info', 'warning', 'error', 'critical'], help=f'Verbosity level. Default: "{deamon_opts["verbosity"]}"')
 
@@ -140,7 +223,7 @@ def main():
 
     # First parse daemon config from yaml
     if args.config.name.endswith('.yaml'):
-        ConfigYaml.read_daemon_config(args.config)
+        ConfigYaml.read_daemon_config(args.config, args.config_cache)
     if config_reader.config_error_count > 0:
         logger.critical("Configuration error. Exiting.")
         sys.exit(1)
@@ -157,29 +240,27 @@ def main():
 
     logger.setLevel(deamon_opts['verbosity'].upper())
 
+    if deamon_opts['event-loop'] not in EVENT_LOOPS:
+        logger.critical(f'Unknown event loop "{deamon_opts["event-loop"]}". Must be one of {list(EVENT_LOOPS)}. Exiting.')
+        sys.exit(1)
+
     if deamon_opts['mqtt-port'] is None:
         deamon_opts['mqtt-port'] = 8883 if deamon_opts['mqtt-use-tls'] else 1883
 
     logger.info( f'Starting {globs.__myname__} V{globs.__version__}')
 
-    mqtt_client = MqttClient(
-                        mqtt_host=deamon_opts['mqtt-host'], 
-                        mqtt_port=deamon_opts['mqtt-port'], 
-                        mqtt_clientid=deamon_opts['mqtt-clientid'], 
-                        mqtt_user=deamon_opts['mqtt-user'], 
-                        mqtt_pass=deamon_opts['mqtt-pass'],
-                        mqtt_cacerts=deamon_opts['mqtt-cacerts'], 
-                        mqtt_insecure=deamon_opts['mqtt-insecure'], 
-                        mqtt_tls_version=deamon_opts['mqtt-tls-version'], 
-                        topic_base=deamon_opts['mqtt-topic'],
-                        topic_hass_autodisco_base=deamon_opts['hass-discovery-prefix'],
-                        retain_values=deamon_opts['retain-values'],
-                        mqtt_value_qos=deamon_opts['mqtt-value-qos'])
+    mqtt_client = new_mqtt_client()
 
     if deamon_opts['rtu']:
         modbus_master = ModbusMaster.new_modbus_rtu_master(deamon_opts['rtu'], deamon_opts['rtu-parity'], deamon_opts['rtu-baud'], deamon_opts['set-modbus-timeout'])
     elif deamon_opts['tcp']:
         modbus_master = ModbusMaster.new_modbus_tcp_master(deamon_opts['tcp'], deamon_opts['tcp-port'])
+    elif deamon_opts['replay']:
+        try:
+            modbus_master = ModbusMaster.new_modbus_replay_master(deamon_opts['replay'], deamon_opts['replay-speed'])
+        except Exception as e:
+            logger.critical(f'Error reading capture file {deamon_opts["replay"]}: {e}')
+            sys.exit(1)
     else:
         logger.critical(f'No modbus master defined')
         sys.exit(1)
@@ -188,24 +269,61 @@ def main():
     modbus_writer = ModbusWriter(mqtt_client)
     mqtt_client.set_modbus_writer(modbus_writer)
 
-    if args.config.name.endswith('.csv'):
-        ConfigSpicierCsv.read_devices(args.config, mqtt_client, modbus_master)
+    sharded_bridge = None
+    if deamon_opts['workers'] > 1 and (not deamon_opts['tcp'] or not args.config.name.endswith('.yaml')):
+        logger.error('Worker processes are only supported for Modbus TCP and yaml configuration files. Running in one process.')
+        deamon_opts['workers'] = 0
+    if deamon_opts['workers'] > 1 and deamon_opts['modbus-server-port'] > 0:
+        logger.error('The Modbus TCP server is not supported with worker processes. Running without it.')
+        deamon_opts['modbus-server-port'] = 0
+    if deamon_opts['workers'] > 1 and deamon_opts['capture']:
+        logger.error('Capturing the Modbus traffic is not supported with worker processes. Running without capture.')
+        deamon_opts['capture'] = None
+    if deamon_opts['workers'] > 1:
+        # The workers read their share of the devices themselves
+        from .sharding import ShardedBridge
+        sharded_bridge = ShardedBridge(mqtt_client, modbus_writer, args.config.name, deamon_opts['workers'])
+        try:
+            sharded_bridge.start()
+        except Exception as e:
+            logger.critical(f'Error starting worker processes: {e}. Exiting.')
+            sharded_bridge.stop()
+            sys.exit(1)
+        mqtt_client.set_modbus_writer(sharded_bridge)
     else:
-        ConfigYaml.read_devices(args.config, mqtt_client, modbus_master)
-    if config_reader.config_error_count > 0:
-        logger.critical("Configuration error. Exiting.")
-        sys.exit(1)
+        if args.config.name.endswith('.csv'):
+            ConfigSpicierCsv.read_devices(args.config, mqtt_client, modbus_master)
+        else:
+            ConfigYaml.read_devices(args.config, mqtt_client, modbus_master)
+        if config_reader.config_error_count > 0:
+            logger.critical("Configuration error. Exiting.")
+            sys.exit(1)
 
-    if len(Poller.all_poller) == 0:
-        logger.critical("No pollers. Exiting.")
-        sys.exit(1)
+        if len(Poller.all_poller) == 0:
+            logger.critical("No pollers. Exiting.")
+            sys.exit(1)
 
     logger.info(f'Config file {args.config.name} successfully read.')
 
+    if deamon_opts['replay']:
+        # Time runs faster in the replay, for the pollers as well
+        for poller in Poller.all_poller:
+            poller.poll_rate /= deamon_opts['replay-speed']
+    if deamon_opts['capture']:
+        try:
+            modbus_master.start_capture(deamon_opts['capture'])
+        except Exception as e:
+            logger.critical(f'Error opening capture file {deamon_opts["capture"]}: {e}')
+            sys.exit(1)
+
     try:
-        asyncio.run(async_main(mqtt_client, modbus_writer, modbus_master, diag_master), debug=False)
+        event_loop.run(async_main(mqtt_client, modbus_writer, modbus_master, diag_master, args.config.name, sharded_bridge), deamon_opts['event-loop'])
     except KeyboardInterrupt as e: 
         pass
+    finally:
+        modbus_master.stop_capture()
+        if sharded_bridge is not None:
+            sharded_bridge.stop()
 
     logger.critical(f'{globs.__myname__} stopped. Exiting.')
 
@@ -213,32 +331,77 @@ def main():
         dev.disable()
 
 
-async def async_main(mqtt_client:MqttClient, modbus_writer:ModbusWriter, modbus_master:ModbusMaster, diag_master:DiagnosticsMaster):
+async def async_main(mqtt_client:MqttClient, modbus_writer:ModbusWriter, modbus_master:ModbusMaster, diag_master:DiagnosticsMaster, config_file_name:str,
+                     sharded_bridge:'ShardedBridge'=None):
     logger.debug("Starting main loop.")
 
     # Loop until initial connection to mqtt server is made. Reconnect is handled by mqtt client internally.
     try:
         while not mqtt_client.make_initial_connection():
-            time.sleep(0.5)
+            await asyncio.sleep(0.5)
     except (KeyboardInterrupt, SystemExit) as e:
         logger.critical(f'Stopped before initial MQTT connect. Exiting.')
         sys.exit(1)
 
-    # Setup HomeAssistant after mqtt client is up
-    if deamon_opts['add-to-homeassistant']:
+    # Seed last values from our own retained topics, so only changed values get published after a restart
+    if deamon_opts['retain-values'] and deamon_opts['seed-retained-values'] > 0:
         try:
-            HassConnector.publish_hass_autodiscovery(mqtt_client)
+            retained = await mqtt_client.collect_retained(mqtt_client.get_topic_reference_value('+', '+'), deamon_opts['seed-retained-values'])
+            if sharded_bridge is not None:
+                sharded_bridge.seed_last_values(retained)
+            else:
+                seeded = sum(dev.seed_last_values(retained) for dev in Device.all_devices.values())
+                logger.info(f'Seeded {seeded} references from retained values.')
         except Exception as e:
-            logger.error( f'Error setting up homeassistant autodiscovery: {e}')
-     
-    # Now comes the real main loop
+            logger.error( f'Error seeding values from retained topics: {e}')
+
+    # Now comes the real main loop. Optional subsystems are only imported when they are enabled.
+    from .profiling import Profiler
     try:
         async with asyncio.TaskGroup() as tg:
-            modbus_master.run_workloop(tg)
-            modbus_writer.run_workloop(tg)
-            diag_master.run_workloop(tg)
-            for poller in Poller.all_poller:
-                poller.run_workloop(tg)
+            if sharded_bridge is not None:
+                # The workers do the polling, autodiscovery and their diagnostics. Only the daemon commands are left here.
+                if deamon_opts['add-to-homeassistant']:
+                    mqtt_client.subscribe_hass_birth(deamon_opts['hass-birth-topic'], sharded_bridge.on_hass_status)
+                if deamon_opts['loop-block-threshold'] > 0:
+                    from .loop_monitor import LoopMonitor
+                    LoopMonitor(mqtt_client, deamon_opts['loop-block-threshold']).run_workloop(tg)
+                sharded_bridge.run_workloop(tg)
+                modbus_writer.run_workloop(tg)
+                if deamon_opts['metrics-port'] > 0:
+                    from .metrics import MetricsServer
+                    MetricsServer(deamon_opts['metrics-port']).run_workloop(tg)
+                Profiler(mqtt_client, deamon_opts['profile-dir']).run_workloop(tg, modbus_writer)
+            else:
+                # Setup HomeAssistant after mqtt client is up
+                hass_connector = None
+                if deamon_opts['add-to-homeassistant']:
+                    try:
+                        from .home_assistant import HassConnector
+                        hass_connector = HassConnector(mqtt_client, deamon_opts['hass-discovery-rate'], deamon_opts['hass-birth-topic'], deamon_opts['hass-seed-retained'])
+                        hass_connector.run_workloop(tg)
+                    except Exception as e:
+                        logger.error( f'Error setting up homeassistant autodiscovery: {e}')
+                if config_file_name.endswith('.yaml'):
+                    config_reloader = ConfigReloader(config_file_name, mqtt_client, modbus_master, modbus_writer, hass_connector)
+                    config_reloader.run_workloop(tg)
+                if deamon_opts['loop-block-threshold'] > 0:
+                    from .loop_monitor import LoopMonitor
+                    loop_monitor = LoopMonitor(mqtt_client, deamon_opts['loop-block-threshold'])
+                    loop_monitor.run_workloop(tg)
+                    diag_master.loop_monitor = loop_monitor
+                modbus_master.run_workloop(tg)
+                modbus_writer.run_workloop(tg)
+                diag_master.run_workloop(tg)
+                if deamon_opts['modbus-server-port'] > 0:
+                    from .modbus_server import ModbusServer
+                    ModbusServer(modbus_writer, deamon_opts['modbus-server-port'], deamon_opts['modbus-server-address']).run_workloop(tg)
+                if deamon_opts['metrics-port'] > 0:
+                    from .metrics import MetricsServer
+                    MetricsServer(deamon_opts['metrics-port']).run_workloop(tg)
+                Profiler(mqtt_client, deamon_opts['profile-dir']).run_workloop(tg, modbus_writer)
+                for poller in Poller.all_poller:
+                    poller.run_workloop(tg)
     except Exception as e:
         logger.critical( f'Fatal error in main loop: {e}')
     except (asyncio.exceptions.CancelledError, KeyboardInterrupt) as e:
@@ -0,0 +1,279 @@
+import asyncio
+import bisect
+import math
+
+from .globals import logger
+
+
+###################################################################################################################
+#
+# Metrics for monitoring the bridge
+#
+# A minimal metrics registry (counters, gauges, histograms with labels) and an HTTP endpoint serving them in the
+# OpenMetrics / Prometheus text format. The endpoint runs on the daemon's event loop.
+# Metrics are always recorded: it's just a dict lookup and some additions, also when no endpoint is configured.
+#
+
+class Metric:
+
+    all_metrics = dict()
+
+    metric_type = None
+
+    def __init__(self, name:str, help_text:str, label_names:tuple=()):
+        if name in Metric.all_metrics:
+            raise LookupError(f'Metric "{name}" already exists.')
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.children = dict() # label values -> child
+        Metric.all_metrics[name] = self
+
+    def labels(self, *label_values):
+        child = self.children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f'Metric "{self.name}" requires labels {self.label_names}, got {label_values}.')
+            child = self._new_child()
+            self.children[label_values] = child
+        return child
+
+    def remove(self, *label_values) -> None:
+        self.children.pop(label_values, None)
+
+    def remove_all(self, **label_values) -> None:
+        # Remove all children with the given label values, e.g. remove_all(device='dev-1')
+        positions = [ (self.label_names.index(name), value) for (name, value) in label_values.items() ]
+        for key in [ key for key in self.children if all(key[idx] == value for (idx, value) in positions) ]:
+            del self.children[key]
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_str(self, label_values:tuple, extra:str=None) -> str:
+        pairs = [ f'{name}="{Metric._escape(value)}"' for (name, value) in zip(self.label_names, label_values) ]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    @staticmethod
+    def _format_value(value:float) -> str:
+        if isinstance(value, int):
+            return str(value)
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(float(value))
+
+    def render(self, openmetrics:bool) -> list[str]:
+        sample_name = self.name + '_total' if self.metric_type == 'counter' else self.name
+        type_name = self.name if openmetrics or self.metric_type != 'counter' else sample_name
+        lines = [ f'# HELP {type_name} {self.help_text}', f'# TYPE {type_name} {self.metric_type}' ]
+        for (label_values, child) in list(self.children.items()):
+            lines.append(f'{sample_name}{self._label_str(label_values)} {Metric._format_value(child.get())}')
+        return lines
+
+    def __str__(self):
+        return f'metric: {self.name}'
+
+
+class _ValueChild:
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount:float=1) -> None:
+        self.value += amount
+
+    def set(self, value:float) -> None:
+        self.value = value
+
+    def set_function(self, function) -> None:
+        # The value is taken from calling function when the metrics get collected
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _ValueChild()
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _ValueChild()
+
+
+class HistogramChild:
+
+    __slots__ = ('upper_bounds', 'bucket_counts', 'count', 'sum')
+
+    def __init__(self, upper_bounds:tuple):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * len(upper_bounds) # not cumulative
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value:float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self) -> 'HistogramChild':
+        the_copy = HistogramChild(self.upper_bounds)
+        the_copy.bucket_counts = list(self.bucket_counts)
+        the_copy.count = self.count
+        the_copy.sum = self.sum
+        return the_copy
+
+    def diff(self, old:'HistogramChild') -> 'HistogramChild':
+        # The observations made since old was copied from this histogram
+        the_diff = HistogramChild(self.upper_bounds)
+        the_diff.bucket_counts = [ new_cnt-old_cnt for (new_cnt, old_cnt) in zip(self.bucket_counts, old.bucket_counts) ]
+        the_diff.count = self.count - old.count
+        the_diff.sum = self.sum - old.sum
+        return the_diff
+
+    def quantile(self, q:float) -> float|None:
+        # Estimate by linear interpolation inside the bucket the quantile falls into
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for (idx, bound) in enumerate(self.upper_bounds):
+            in_bucket = self.bucket_counts[idx]
+            if cumulative + in_bucket >= rank and in_bucket > 0:
+                if math.isinf(bound):
+                    return lower # Nothing better to say about the overflow bucket
+                return lower + (bound-lower) * (rank-cumulative) / in_bucket
+            cumulative += in_bucket
+            lower = bound
+        return lower
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    # Seconds, suitable for Modbus round trips on serial and TCP lines as well as for event loop delays
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name:str, help_text:str, label_names:tuple=(), buckets:tuple=None):
+        super().__init__(name, help_text, label_names)
+        self.upper_bounds = tuple(buckets if buckets is not None else Histogram.default_buckets) + (math.inf,)
+
+    def _new_child(self):
+        return HistogramChild(self.upper_bounds)
+
+    def render(self, openmetrics:bool) -> list[str]:
+        lines = [ f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram' ]
+        for (label_values, child) in list(self.children.items()):
+            cumulative = 0
+            for (bound, bucket_count) in zip(child.upper_bounds, child.bucket_counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if math.isinf(bound) else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{self._label_str(label_values, le)} {cumulative}')
+            lines.append(f'{self.name}_count{self._label_str(label_values)} {child.count}')
+            lines.append(f'{self.name}_sum{self._label_str(label_values)} {repr(child.sum)}')
+        return lines
+
+
+def render_metrics(openmetrics:bool=True) -> str:
+    lines = list()
+    for metric in list(Metric.all_metrics.values()):
+        try:
+            lines += metric.render(openmetrics)
+        except Exception as e:
+            logger.error(f'Error collecting {metric}: {e}')
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+###################################################################################################################
+#
+# The metrics of the bridge
+#
+
+modbus_lock_wait = Histogram('modbus_lock_wait_seconds', 'Time waited for the Modbus master lock.', ('master',))
+modbus_request_duration = Histogram('modbus_request_duration_seconds', 'Duration of Modbus requests on the wire, without lock wait ("none" for requests of no device or poller).', ('master', 'device', 'poller', 'fc'))
+modbus_errors = Counter('modbus_errors', 'Failed Modbus requests by exception code ("none" for errors without exception response).', ('master', 'fc', 'exception_code'))
+poll_duration = Histogram('poll_duration_seconds', 'Duration of a complete poll, including lock wait.', ('device', 'poller', 'fc'))
+poll_lateness = Histogram('poll_lateness_seconds', 'Delay of poll starts behind their schedule.', ('device', 'poller'))
+mqtt_publishes = Counter('mqtt_publishes', 'Values published to MQTT.', ('device',))
+modbus_server_requests = Counter('modbus_server_requests', 'Requests to the Modbus TCP server by function code and result ("ok" or the exception code).', ('fc', 'result'))
+get_requests = Counter('get_requests', 'On-demand get requests by how they were answered ("cache", "read" or "failed").', ('device', 'result'))
+write_stage_duration = Histogram('write_stage_duration_seconds', 'Duration of the stages of MQTT write requests, from arrival to the echo publish.', ('device', 'stage'))
+event_loop_lag = Histogram('event_loop_lag_seconds', 'Delay of event loop wake-ups behind their schedule.', buckets=(0.0001, 0.00025, 0.0005)+Histogram.default_buckets)
+event_loop_blocked = Counter('event_loop_blocked', 'Event loop stalls longer than loop-block-threshold.')
+asyncio_tasks = Gauge('asyncio_tasks', 'Number of asyncio tasks per subsystem.', ('subsystem',))
+queue_depth = Gauge('queue_depth', 'Number of entries waiting in internal queues.', ('queue',))
+
+
+###################################################################################################################
+#
+# The HTTP endpoint
+#
+
+class MetricsServer:
+
+    def __init__(self, port:int, host:str=None) -> None:
+        self.port = port
+        self.host = host
+        self.server = None
+        self.runtask = None
+
+    async def handle_request(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), 5.0)).decode('latin-1')
+            accept = ''
+            while True:
+                header = (await asyncio.wait_for(reader.readline(), 5.0)).decode('latin-1')
+                if header in ('\r\n', '\n', ''):
+                    break
+                if header.lower().startswith('accept:'):
+                    accept = header
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] != 'GET' or parts[1].split('?')[0] not in ('/metrics', '/'):
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            else:
+                openmetrics = 'application/openmetrics-text' in accept
+                body = render_metrics(openmetrics).encode('utf-8')
+                content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8' if openmetrics else 'text/plain; version=0.0.4; charset=utf-8'
+                writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+                writer.write(body)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'Error serving metrics request: {e}')
+        finally:
+            writer.close()
+
+    def run_workloop(self, task_group):
+        #...........................................................................................
+        async def workloop():
+            try:
+                self.server = await asyncio.start_server(self.handle_request, self.host, self.port)
+                logger.info(f'Serving metrics on port {self.port}')
+                async with self.server:
+                    await self.server.serve_forever()
+            except asyncio.exceptions.CancelledError as e:
+                logger.debug(f'Metrics server task stopped ({self}).')
+            except Exception as e:
+                logger.error(f'Error running metrics server ({self}): {e}')
+        #...........................................................................................
+        self.runtask = task_group.create_task(workloop(), name='metrics-server')
+
+    def __str__(self):
+        return f'metrics server: port:{self.port}'
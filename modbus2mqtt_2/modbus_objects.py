@@ -1,41 +1,205 @@
 import asyncio
 import copy
+import json
+import math
 import random
 import time
 
-from pymodbus.client import (
-    AsyncModbusSerialClient,
-    AsyncModbusTcpClient
-)
-
+from . import metrics
 from .data_types import DataConverter
+from .history import HistoryBuffer
 from .mqtt_client import MqttClient
+from .payload_codec import PayloadCodec
 from .globals import logger, deamon_opts
 
 
+class ModbusExceptionResponse(Exception):
+
+    # Modbus exception codes
+    ILLEGAL_FUNCTION = 1
+    ILLEGAL_DATA_ADDRESS = 2
+    ILLEGAL_DATA_VALUE = 3
+    GATEWAY_PATH_UNAVAILABLE = 0x0A
+    GATEWAY_TARGET_FAILED = 0x0B
+
+    def __init__(self, function_code:int, exception_code:int):
+        super().__init__(f'Exception response from Modbus call (fc:{function_code}): exception code {exception_code}')
+        self.function_code = function_code
+        self.exception_code = exception_code
+
+    @classmethod
+    def raise_for_result(cls, result, call_name:str) -> None:
+        # pymodbus exception responses carry the exception code, all other errors (e.g. IO errors) don't
+        exception_code = getattr(result, 'exception_code', None)
+        if exception_code is not None:
+            raise cls(result.function_code & 0x7F, exception_code)
+        raise Exception(f'Error response from Modbus {call_name} call: {result.function_code}')
+
+
 class ModbusStats:
-    def __init__(self, writes_total:int=0, writes_error:int=0, reads_total:int=0, reads_error:int=0, timestamp:float=None):
+
+    __slots__ = ('writes_total', 'writes_error', 'reads_total', 'reads_error', 'timestamp', 'timings')
+
+    # Upper bounds of the timing histograms: 0.1ms to ~9s, 25% steps. Fixed memory, quantiles are accurate to some percent.
+    _timing_bounds = tuple(0.0001 * 1.25**idx for idx in range(52)) + (math.inf,)
+
+    def __init__(self, writes_total:int=0, writes_error:int=0, reads_total:int=0, reads_error:int=0, timestamp:float=None, timings:dict=None):
         self.writes_total = writes_total
         self.writes_error = writes_error
         self.reads_total = reads_total
         self.reads_error = reads_error
         self.timestamp = timestamp if timestamp!=None else time.monotonic()
+        self.timings = timings if timings!=None else dict() # function code -> (lock wait histogram, wire time histogram)
+
+    def record_timing(self, function_code:int, lock_wait:float, wire_time:float) -> None:
+        timing = self.timings.get(function_code)
+        if timing is None:
+            timing = (metrics.HistogramChild(ModbusStats._timing_bounds), metrics.HistogramChild(ModbusStats._timing_bounds))
+            self.timings[function_code] = timing
+        timing[0].observe(lock_wait)
+        timing[1].observe(wire_time)
+
+    def get_timing_quantiles(self, quantiles:tuple=(0.5, 0.95, 0.99)) -> dict:
+        # function code -> { 'count': n, 'lock-wait': { 'p50': seconds, ... }, 'wire': { ... } }
+        result = dict()
+        for (function_code, (lock_wait, wire_time)) in sorted(self.timings.items()):
+            if wire_time.count == 0:
+                continue
+            result[function_code] = {
+                'count': wire_time.count,
+                'lock-wait': { f'p{round(q*100)}': lock_wait.quantile(q) for q in quantiles },
+                'wire': { f'p{round(q*100)}': wire_time.quantile(q) for q in quantiles },
+            }
+        return result
         
     def snapshot(self):
         snap = copy.copy(self)
         snap.timestamp = time.monotonic()
+        snap.timings = { fc: (lock_wait.copy(), wire_time.copy()) for (fc, (lock_wait, wire_time)) in self.timings.items() }
         return snap
     
     def diff_stat(self, old_snap):
+        timings = dict()
+        for (fc, (lock_wait, wire_time)) in self.timings.items():
+            old_timing = old_snap.timings.get(fc)
+            timings[fc] = (lock_wait.diff(old_timing[0]), wire_time.diff(old_timing[1])) if old_timing else (lock_wait, wire_time)
         return(ModbusStats(
                 writes_total=self.writes_total-old_snap.writes_total, 
                 writes_error=self.writes_error-old_snap.writes_error, 
                 reads_total=self.reads_total-old_snap.reads_total, 
                 reads_error=self.reads_error-old_snap.reads_error, 
-                timestamp=self.timestamp-old_snap.timestamp
+                timestamp=self.timestamp-old_snap.timestamp,
+                timings=timings
             ))
  
 
+class PollerStats:
+
+    __slots__ = ('polls', 'polls_failed', 'skipped', 'values_polled', 'values_published', 'duration_sum', 'duration_max', 'last_start', 'timestamp')
+
+    def __init__(self, polls:int=0, polls_failed:int=0, skipped:int=0, values_polled:int=0, values_published:int=0,
+                 duration_sum:float=0.0, duration_max:float=0.0, last_start:float=None, timestamp:float=None):
+        self.polls = polls
+        self.polls_failed = polls_failed
+        self.skipped = skipped # Poll cycles missed completely, because the poller was late or the device not ready
+        self.values_polled = values_polled
+        self.values_published = values_published
+        self.duration_sum = duration_sum
+        self.duration_max = duration_max
+        self.last_start = last_start
+        self.timestamp = timestamp if timestamp!=None else time.monotonic()
+
+    def record_poll(self, start:float, duration:float, success:bool) -> None:
+        self.polls += 1
+        if not success:
+            self.polls_failed += 1
+        self.duration_sum += duration
+        self.duration_max = max(self.duration_max, duration)
+        self.last_start = start
+
+    def snapshot(self):
+        snap = copy.copy(self)
+        snap.timestamp = time.monotonic()
+        self.duration_max = 0.0 # The maximum is per snapshot interval
+        return snap
+
+    def diff_stat(self, old_snap):
+        return(PollerStats(
+                polls=self.polls-old_snap.polls,
+                polls_failed=self.polls_failed-old_snap.polls_failed,
+                skipped=self.skipped-old_snap.skipped,
+                values_polled=self.values_polled-old_snap.values_polled,
+                values_published=self.values_published-old_snap.values_published,
+                duration_sum=self.duration_sum-old_snap.duration_sum,
+                duration_max=self.duration_max,
+                last_start=self.last_start,
+                timestamp=self.timestamp-old_snap.timestamp
+            ))
+
+
+class WriteTrace:
+
+    # Follows one MQTT write request through the stages:
+    #   queue    arrival in the MQTT client's thread until taken from the writer's queue
+    #   convert  decoding the payload and converting it to Modbus registers
+    #   lock     waiting for the Modbus master
+    #   wire     the Modbus write request
+    #   publish  publishing the written value as the new state
+    # The times get exported as metrics. A response is only published, if the request carried an ID: the MQTT v5
+    # correlation data or a "request-id" in a payload like {"value": 42, "request-id": "abc"}.
+
+    __slots__ = ('arrival', 'last_mark', 'stages', 'request_id', 'correlation_data', 'response_topic')
+
+    def __init__(self, arrival:float, properties=None):
+        self.arrival = arrival
+        self.last_mark = arrival
+        self.stages = dict()
+        self.request_id = None
+        # Only MQTT v5 messages carry properties
+        self.correlation_data = getattr(properties, 'CorrelationData', None)
+        self.response_topic = getattr(properties, 'ResponseTopic', None)
+
+    def mark(self, stage:str) -> None:
+        # The stage ended now and started with the end of the previous stage
+        now = time.monotonic()
+        self.stages[stage] = now - self.last_mark
+        self.last_mark = now
+
+    def add(self, stage:str, duration:float) -> None:
+        # For stages measured elsewhere, directly following the previous stage
+        self.stages[stage] = duration
+        self.last_mark += duration
+
+    def unwrap_value(self, value):
+        # Strip an envelope with a request ID off the decoded payload
+        if isinstance(value, str) and value.startswith('{'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return value
+        if isinstance(value, dict) and 'value' in value:
+            self.request_id = value.get('request-id')
+            return value['value']
+        return value
+
+    def wants_response(self) -> bool:
+        return self.request_id is not None or self.correlation_data is not None
+
+    def finish(self, device_name:str) -> None:
+        self.stages['total'] = time.monotonic() - self.arrival
+        for (stage, duration) in self.stages.items():
+            metrics.write_stage_duration.labels(device_name, stage).observe(duration)
+
+    def response_document(self, device_name:str, ref_topic:str, error:str=None) -> str:
+        doc = { 'device': device_name, 'reference': ref_topic, 'success': error is None }
+        if self.request_id is not None:
+            doc['request-id'] = self.request_id
+        if error is not None:
+            doc['error'] = error
+        doc['latency-ms'] = { stage: round(duration*1000, 3) for (stage, duration) in self.stages.items() }
+        return json.dumps(doc)
+
+
 class ModbusMaster:
 
     #==================================================================================================================
@@ -47,6 +211,7 @@ class ModbusMaster:
 
     @classmethod
     def new_modbus_rtu_master(cls, rtu_dev:str, rtu_parity:str, rtu_baud:int, modbus_timeout:int) -> 'ModbusMaster' :
+        from pymodbus.client import AsyncModbusSerialClient
         if rtu_parity == "none":
             parity = "N"
         if rtu_parity == "odd":
@@ -54,12 +219,19 @@ class ModbusMaster:
         if rtu_parity == "even":
             parity = "E"
         master = AsyncModbusSerialClient(port=rtu_dev, stopbits=1, bytesize=8, parity=parity, baudrate=rtu_baud, timeout=modbus_timeout)
-        return cls(master)
+        return cls(master, f'rtu:{rtu_dev}')
 
     @classmethod
     def new_modbus_tcp_master(cls, tcp_host:str, tcp_port:int) -> 'ModbusMaster' :
+        from pymodbus.client import AsyncModbusTcpClient
         master = AsyncModbusTcpClient(tcp_host, port=tcp_port)
-        return cls(master)
+        return cls(master, f'tcp:{tcp_host}:{tcp_port}')
+
+    @classmethod
+    def new_modbus_replay_master(cls, capture_file:str, speed:float) -> 'ModbusMaster' :
+        from .capture import ReplayClient
+        master = ReplayClient(capture_file, speed)
+        return cls(master, f'replay:{capture_file}')
 
 
     #==================================================================================================================
@@ -67,24 +239,55 @@ class ModbusMaster:
     # Instance methods
     #
 
-    def __init__(self, master):
+    def __init__(self, master, name:str='modbus'):
         self.master = master
+        self.name = name
         self.devices = list()
         self.runtask = None
         ModbusMaster.all_modbus_master.append(self)
         self.modbuslock = asyncio.Lock()
         self.stats = ModbusStats()
         self.stats_last = None
+        self.capture = None
+
+    def start_capture(self, file_name:str) -> None:
+        from .capture import CaptureWriter
+        self.capture = CaptureWriter(file_name)
+        logger.info(f'Capturing Modbus traffic to {file_name}.')
+
+    def stop_capture(self) -> None:
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
+    def _capture_request(self, function_code:int, slaveid:int, address:int, count:int, error:Exception, duration:float, values) -> None:
+        from .capture import STATUS_OK, STATUS_ERROR
+        status = STATUS_OK if error is None else getattr(error, 'exception_code', STATUS_ERROR)
+        try:
+            self.capture.record(function_code, slaveid, address, count, status, duration, values if error is None else None)
+        except Exception as e:
+            logger.error(f'Error capturing Modbus traffic, capture stopped ({self.capture}): {e}')
+            self.capture = None
 
-    async def write_to_slave(self, fct_code_write:int, write_reg, value, slaveid):
+
+    async def write_to_slave(self, fct_code_write:int, write_reg, value, slaveid, dev_stats:ModbusStats=None, trace:WriteTrace=None,
+                             device_name:str='none', poller_name:str='none'):
+        # fct_code_write is the single write function code of the register type (5 or 6). Lists of values get
+        # written with the multiple write function code (15 or 16), which is the one recorded in metrics and capture.
         result = None
+        error = None
+        wire_start = None
+        function_code = fct_code_write
+        wait_start = time.monotonic()
+        await self.modbuslock.acquire() # Outside of try: a cancelled acquire must not release the lock held by someone else
         try:     
-            await self.modbuslock.acquire()
+            wire_start = time.monotonic()
+            metrics.modbus_lock_wait.labels(self.name).observe(wire_start-wait_start)
             if fct_code_write == 5:
                 if not isinstance(value,list) :
                     result = await self.master.write_coil(write_reg, value, slave=slaveid)
                 else:
+                    function_code = 15
                     result = await self.master.write_coils(write_reg, value, slave=slaveid)
             elif fct_code_write == 6 :
                 if not isinstance(value,list) and deamon_opts['avoid-fc6'] :
@@ -92,41 +295,77 @@ class ModbusMaster:
                 if not isinstance(value,list) :
                     result = await self.master.write_register(write_reg, value, slave=slaveid)
                 else:
+                    function_code = 16
                     result = await self.master.write_registers(write_reg, value, slave=slaveid)
             if result!=None and result.isError() :
-                raise Exception(f'Error response from Modbus write call: {result.function_code}')
+                ModbusExceptionResponse.raise_for_result(result, 'write')
         except Exception as e:
+            error = e
             self.stats.writes_error += 1
+            metrics.modbus_errors.labels(self.name, function_code, getattr(e, 'exception_code', 'none')).inc()
             raise e
         finally:
             self.modbuslock.release()
             self.stats.writes_total += 1
+            if wire_start is not None:
+                wire_time = time.monotonic()-wire_start
+                metrics.modbus_request_duration.labels(self.name, device_name, poller_name, function_code).observe(wire_time)
+                self.stats.record_timing(function_code, wire_start-wait_start, wire_time)
+                if dev_stats is not None:
+                    dev_stats.record_timing(function_code, wire_start-wait_start, wire_time)
+                if trace is not None:
+                    trace.add('lock', wire_start-wait_start)
+                    trace.add('wire', wire_time)
+                if self.capture is not None:
+                    self._capture_request(function_code, slaveid, write_reg, len(value) if isinstance(value, list) else 1, error, wire_time, value)
     
 
-    async def read_from_slave(self, function_code:int, start_reg:int, len_regs:int, slaveid:int):
+    async def read_from_slave(self, function_code:int, start_reg:int, len_regs:int, slaveid:int, dev_stats:ModbusStats=None, timeout:float=None,
+                              device_name:str='none', poller_name:str='none'):
+        # With timeout, only the request on the wire is limited, not waiting for the bus.
+        # device_name and poller_name only label the request duration metric.
         result = None
+        data = None
+        error = None
+        wire_start = None
+        wait_start = time.monotonic()
+        await self.modbuslock.acquire() # Outside of try: a cancelled acquire must not release the lock held by someone else
         try:
-            await self.modbuslock.acquire()
+            wire_start = time.monotonic()
+            metrics.modbus_lock_wait.labels(self.name).observe(wire_start-wait_start)
             if function_code == 3:
-                result = await self.master.read_holding_registers(start_reg, len_regs, slave=slaveid)
-                data = result.registers if not result.isError() else None
+                request = self.master.read_holding_registers(start_reg, len_regs, slave=slaveid)
             elif function_code == 1:
-                result = await self.master.read_coils(start_reg, len_regs, slave=slaveid)
-                data = result.bits if not result.isError() else None
+                request = self.master.read_coils(start_reg, len_regs, slave=slaveid)
             elif function_code == 2:
-                result = await self.master.read_discrete_inputs(start_reg, len_regs, slave=slaveid)
-                data = result.bits if not result.isError() else None
+                request = self.master.read_discrete_inputs(start_reg, len_regs, slave=slaveid)
             elif function_code == 4:
-                result = await self.master.read_input_registers(start_reg, len_regs, slave=slaveid)
-                data = result.registers if not result.isError() else None
+                request = self.master.read_input_registers(start_reg, len_regs, slave=slaveid)
+            else:
+                raise ValueError(f'Unsupported read function code {function_code}')
+            if timeout is not None:
+                request = asyncio.wait_for(request, timeout)
+            result = await request
+            if not result.isError():
+                data = result.registers if function_code in (3, 4) else result.bits
             if data == None:
-                raise Exception(f'Error response from Modbus read call: {result.function_code}')
+                ModbusExceptionResponse.raise_for_result(result, 'read')
         except Exception as e:
+            error = e
             self.stats.reads_error += 1
+            metrics.modbus_errors.labels(self.name, function_code, getattr(e, 'exception_code', 'none')).inc()
             raise e
         finally:
             self.modbuslock.release()
             self.stats.reads_total += 1
+            if wire_start is not None:
+                wire_time = time.monotonic()-wire_start
+                metrics.modbus_request_duration.labels(self.name, device_name, poller_name, function_code).observe(wire_time)
+                self.stats.record_timing(function_code, wire_start-wait_start, wire_time)
+                if dev_stats is not None:
+                    dev_stats.record_timing(function_code, wire_start-wait_start, wire_time)
+                if self.capture is not None:
+                    self._capture_request(function_code, slaveid, start_reg, len_regs, error, wire_time, data[:len_regs] if data is not None else None)
 
         return data
 
@@ -155,11 +394,14 @@ class ModbusMaster:
             except asyncio.exceptions.CancelledError as e:
                 logger.debug(f'Modbus master task stopped ({self}).')
         #...........................................................................................
-        self.runtask = task_group.create_task(workloop())
+        self.runtask = task_group.create_task(workloop(), name=f'modbus-master:{self.name}')
 
     def register_device(self, device:'Device') -> None:
         self.devices.append(device)
 
+    def unregister_device(self, device:'Device') -> None:
+        self.devices.remove(device)
+
     def is_connected(self) -> bool:
         return self.master.connected
     
@@ -170,39 +412,124 @@ class ModbusMaster:
         return (stats, stats_last)
     
 
+class RegisterWrite:
+    # A write of raw registers or coils, queued to the ModbusWriter like MQTT set requests. Used by the Modbus TCP server.
+
+    __slots__ = ('device', 'function_code', 'address', 'value', 'future')
+
+    def __init__(self, device:'Device', function_code:int, address:int, value, future:asyncio.Future):
+        self.device = device
+        self.function_code = function_code
+        self.address = address
+        self.value = value
+        self.future = future
+
+
 class ModbusWriter:
     
     def __init__(self, mqtt_client:MqttClient) -> None:
         self.mqtt_client = mqtt_client
         self.set_request_queue = asyncio.Queue()
+        self.daemon_commands = dict()
+        self.loop = None
+        self.task_group = None
         self.runtask = None
+        metrics.queue_depth.labels('modbus-writer').set_function(self.set_request_queue.qsize)
+
+    def register_daemon_command(self, command:str, callback) -> None:
+        # callback is a coroutine function, called with the payload sent to <topic_base>/<clientId>/set/<command>
+        self.daemon_commands[command] = callback
 
-    def add_set_request(self,req_userdata, req_msg):
-        #XXX Exception handling
+    def add_set_request(self,req_userdata, req_msg, arrival:float=None):
+        # Called from within the MQTT client's thread (or a worker's event loop, with the arrival time at the parent)
         #XXX Warning if long queue
-        self.set_request_queue.put_nowait((req_userdata, req_msg))
+        request = (req_userdata, req_msg, arrival if arrival is not None else time.monotonic())
+        if self.loop is None:
+            self.set_request_queue.put_nowait(request) # Nobody can wait on the queue yet
+        else:
+            self.loop.call_soon_threadsafe(self.set_request_queue.put_nowait, request)
+
+    async def write_registers(self, device:'Device', function_code:int, address:int, value) -> None:
+        # Called from within the event loop. Returns after the write, raises its error.
+        request = RegisterWrite(device, function_code, address, value, self.loop.create_future())
+        self.set_request_queue.put_nowait((None, request, time.monotonic()))
+        await request.future
+
+    async def handle_register_write(self, request:RegisterWrite, trace:WriteTrace) -> None:
+        try:
+            await request.device.write_registers(request.function_code, request.address, request.value, trace)
+            if not request.future.done():
+                request.future.set_result(None)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            trace.finish(request.device.name)
+
+    async def handle_set_request(self, req_msg, trace:WriteTrace) -> None:
+        short_topic = str(req_msg.topic).removeprefix(self.mqtt_client.get_topic_base()+'/')
+        topic_parts = short_topic.split('/')
+        device_name = topic_parts[0]
+        value_topic = topic_parts[-1]
+        if len(topic_parts) != 3 or topic_parts[1] not in ('set', 'get', 'get-history'):
+            # E.g. late messages of a retained value collection. Never write them back to the device.
+            logger.debug( f'Ignoring MQTT message on topic {req_msg.topic}, not a request.')
+            return
+        if topic_parts[1] == 'get':
+            # Get requests may wait for the bus, they must not hold up the writes
+            the_dev:Device = Device.all_devices.get(device_name)
+            if the_dev is None:
+                logger.warning( f'Get request for unknown device {device_name} by MQTT topic {req_msg.topic}.')
+            else:
+                self.task_group.create_task(the_dev.read_on_demand(value_topic, deamon_opts['get-ttl'], self.task_group), name=f'get-request:{device_name}/{value_topic}')
+            return
+        if topic_parts[1] == 'get-history':
+            # Answered from memory, no bus access
+            the_dev:Device = Device.all_devices.get(device_name)
+            if the_dev is None:
+                logger.warning( f'History request for unknown device {device_name} by MQTT topic {req_msg.topic}.')
+            else:
+                the_dev.publish_history(value_topic, req_msg.payload, getattr(req_msg, 'properties', None))
+            return
+        if device_name == self.mqtt_client.clientid:
+            # Here go any daemon level subscriptions
+            if value_topic not in self.daemon_commands:
+                logger.warning( f'Unknown daemon command {value_topic} by MQTT topic {req_msg.topic}.')
+            else:
+                await self.daemon_commands[value_topic](req_msg.payload)
+            return
+
+        the_dev:Device = Device.all_devices.get(device_name)
+        if the_dev is None:
+            logger.warning( f'Tried writing to unknown device {device_name} by MQTT topic {req_msg.topic}.')
+            return
+        error = None
+        try:
+            await the_dev.write_to_device( req_msg.payload, req_msg.topic, device_name, value_topic, trace)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            trace.finish(device_name)
+            if trace.wants_response():
+                self.mqtt_client.publish_write_response(device_name, value_topic, trace.response_document(device_name, value_topic, error),
+                                                        trace.response_topic, trace.correlation_data)
 
     def run_workloop(self, task_group):
+        self.loop = asyncio.get_running_loop()
+        self.task_group = task_group
         #...........................................................................................
         async def workloop():
             try:
                 while True:
-                    (req_userdata, req_msg) = await self.set_request_queue.get()
+                    (req_userdata, req_msg, arrival) = await self.set_request_queue.get()
                     try:
-                        short_topic = str(req_msg.topic).removeprefix(self.mqtt_client.get_topic_base()+'/')
-                        topic_parts = short_topic.split('/')
-                        device_name = topic_parts[0]
-                        value_topic = topic_parts[-1]
-                        if device_name == self.mqtt_client.clientid:
-                            # Here go any device level subscriptions
-                            pass
+                        trace = WriteTrace(arrival, getattr(req_msg, 'properties', None))
+                        trace.mark('queue')
+                        if isinstance(req_msg, RegisterWrite):
+                            await self.handle_register_write(req_msg, trace)
                         else:
-                            the_dev:Device = Device.all_devices[device_name]
-                            if the_dev is None:
-                                logger.warning( f'Tried writing to unknown device {device_name} by MQTT topic {req_msg.topic}.')
-                            else:
-                                payload = str(req_msg.payload.decode("utf-8"))
-                                await the_dev.write_to_device( payload, req_msg.topic, device_name, value_topic)
+                            await self.handle_set_request(req_msg, trace)
                     except Exception as e:
                         logger.error(f'Error handling MQTT set request: {e}')
 
@@ -210,7 +537,7 @@ class ModbusWriter:
             except asyncio.exceptions.CancelledError as e:
                 logger.debug(f'Modbus writer task stopped ({self}).')
         #...........................................................................................
-        self.runtask = task_group.create_task(workloop())
+        self.runtask = task_group.create_task(workloop(), name='modbus-writer')
 
 
 class Device:
@@ -222,6 +549,11 @@ class Device:
 
     all_devices = dict()
 
+    # Lots of devices, pollers and references for large configs. Slots keep their memory footprint small.
+    __slots__ = ('config_source', 'mqttc', 'modbus_master', 'name', 'slaveid', 'ha_properties', 'payload_codec', 'payload_batch',
+                 'pending_batch', 'stats', 'stats_last', 'last_poll_success', 'consec_fail_cnt', 'references', 'pollers',
+                 'config_plan', 'enabled', 'reenable_task')
+
     @classmethod
     def register_device(cls, device:'Device') -> None :
         if device.name in cls.all_devices:
@@ -229,13 +561,19 @@ class Device:
         device.mqttc.register_device_topics( device.name)
         cls.all_devices[device.name] = device
 
+    @classmethod
+    def unregister_device(cls, device:'Device') -> None :
+        device.mqttc.unregister_device_topics( device.name)
+        del cls.all_devices[device.name]
+
 
     #==================================================================================================================
     #
     # Instance methods
     #
 
-    def __init__(self, config_source, mqttc:MqttClient, modbus_master:ModbusMaster, device_name:str, slaveid:int, ha_properties:dict=dict()):
+    def __init__(self, config_source, mqttc:MqttClient, modbus_master:ModbusMaster, device_name:str, slaveid:int, ha_properties:dict=dict(),
+                payload_encoding:str=None, payload_batch:bool=False):
         if device_name in Device.all_devices:
             raise LookupError(f'Device "{device_name}" from {config_source} already exists.')
         
@@ -245,6 +583,9 @@ class Device:
         self.name = MqttClient.clean_topic(device_name, is_single_part=True)
         self.slaveid = slaveid
         self.ha_properties = ha_properties
+        self.payload_codec = PayloadCodec.get_codec(payload_encoding if payload_encoding else deamon_opts['payload-encoding'])
+        self.payload_batch = payload_batch
+        self.pending_batch = dict()
 
         self.stats = ModbusStats()
         self.stats_last = None
@@ -253,10 +594,14 @@ class Device:
 
         self.references = dict()
         self.pollers = list()
+        self.config_plan = None # The config plan this device was built from. Used for diffing on config reloads.
 
         self.enabled = False # We will get enabled once the Modbus is up
+        self.reenable_task = None
 
         Device.register_device(self)
+        if self.payload_batch:
+            self.mqttc.register_device_batch_topic(self.name)
         self.modbus_master.register_device(self)
 
         logger.info(f'Added new device {self}')
@@ -278,6 +623,21 @@ class Device:
 
     def is_ready_to_comm(self) -> bool:
         return (self.modbus_master.is_connected() and self.enabled)
+
+    def remove(self) -> None :
+        # Stop all pollers and remove the device with all of its topics
+        for poller in list(self.pollers):
+            poller.remove()
+        self.disable()
+        if self.reenable_task is not None:
+            self.reenable_task.cancel()
+        if self.payload_batch:
+            self.mqttc.unregister_device_batch_topic(self.name)
+        self.modbus_master.unregister_device(self)
+        Device.unregister_device(self)
+        metrics.mqtt_publishes.remove(self.name)
+        metrics.modbus_request_duration.remove_all(device=self.name)
+        logger.info(f'Removed device {self}')
     
 
     def schedule_reenable(self, task_group):
@@ -291,7 +651,7 @@ class Device:
                 logger.debug(f'Reenabler task stopped ({self}).')
         #...........................................................................................
         sleeptime = 120 # XXX Make this configurable
-        self.reenable_task = task_group.create_task(workloop(sleeptime))
+        self.reenable_task = task_group.create_task(workloop(sleeptime), name=f'device-reenable:{self.name}')
     
 
     #------------------------------------------------------------------------------------------------------------------
@@ -304,9 +664,48 @@ class Device:
     def register_reference( self, new_ref:'Reference') -> None :
         if new_ref.topic in self.references:
             raise LookupError( f'Topic "{new_ref.topic}" from {new_ref.config_source} already exists in device "{self.name}"')
-        self.mqttc.register_reference_topics( self.name, new_ref.topic, new_ref.is_writeable)
+        self.mqttc.register_reference_topics( self.name, new_ref.topic, new_ref.is_writeable, new_ref.history is not None)
         self.references[new_ref.topic] = new_ref
 
+    def unregister_poller( self, poller:'Poller') -> None :
+        self.pollers.remove( poller)
+
+    def unregister_reference( self, ref:'Reference') -> None :
+        self.mqttc.unregister_reference_topics( self.name, ref.topic, ref.is_writeable, ref.history is not None)
+        del self.references[ref.topic]
+
+
+    #------------------------------------------------------------------------------------------------------------------
+    # Publishing
+    #
+
+    def publish_reference_value(self, ref:'Reference', value, payload) -> None:
+        if self.payload_batch:
+            self.pending_batch[ref.topic] = value
+        else:
+            self.mqttc.publish_reference_state(self.name, ref.topic, payload)
+            metrics.mqtt_publishes.labels(self.name).inc()
+
+    def seed_last_values(self, retained:dict) -> int:
+        # Seed the references' last values from our own retained value topics. Returns the number of seeded references.
+        if self.payload_batch:
+            return 0
+        seeded = 0
+        for ref in self.references.values():
+            payload = retained.get(self.mqttc.get_topic_reference_value(self.name, ref.topic))
+            if payload is not None and ref.is_readable:
+                ref.seed_last_value(payload)
+                seeded += 1
+        return seeded
+
+    def flush_batch(self) -> None:
+        # Publish all values collected during the last poll cycle as one document
+        if len(self.pending_batch) == 0:
+            return
+        self.mqttc.publish_device_batch(self.name, self.payload_codec.encode_batch(self.pending_batch))
+        metrics.mqtt_publishes.labels(self.name).inc()
+        self.pending_batch = dict()
+
 
     #------------------------------------------------------------------------------------------------------------------
     # Modbus related
@@ -335,8 +734,69 @@ class Device:
         self.last_poll_success = was_successfull
 
 
-    async def write_to_device(self, payload_str:str, full_topic:str, dev_topic, val_topic) -> None:
-        the_ref:Reference = self.references[val_topic]
+    async def read_on_demand(self, val_topic:str, max_age:float, task_group) -> None:
+        # Publish the reference's value, read through its poller if the last poll is older than max_age
+        the_ref:Reference = self.references.get(val_topic)
+        if the_ref is None or not the_ref.is_readable:
+            logger.warning( f'Get request for unknown or write only reference {val_topic} of device {self.name}.')
+            return
+        last_val_time = the_ref.last_val_time
+        result = await the_ref.poller.refresh(task_group, max_age)
+        metrics.get_requests.labels(self.name, result).inc()
+        if result == 'failed' or the_ref.last_val is None:
+            logger.warning( f'No current value for get request of {the_ref}.')
+            return
+        if result == 'read' and the_ref.last_val_time != last_val_time and not self.payload_batch:
+            return # The poll just published the value
+        # Always on the reference's own value topic, also for batched devices
+        self.mqttc.publish_reference_state(self.name, the_ref.topic, the_ref.last_val)
+        metrics.mqtt_publishes.labels(self.name).inc()
+
+
+    def publish_history(self, val_topic:str, payload:bytes, properties=None) -> None:
+        # Publish the recent samples of the reference. The request payload may be empty or a document like
+        # {"seconds": 60, "max-samples": 100, "request-id": "abc"}, "since" (seconds since the epoch) instead of "seconds".
+        the_ref:Reference = self.references.get(val_topic)
+        if the_ref is None or the_ref.history is None:
+            logger.warning( f'History request for unknown reference or reference without history {val_topic} of device {self.name}.')
+            return
+        try:
+            request = self.payload_codec.decode(payload) if payload else dict()
+            if isinstance(request, str):
+                request = json.loads(request) if request else dict()
+            if not isinstance(request, dict):
+                raise ValueError('not a document')
+            # The samples are recorded on the monotonic clock, convert from and to wall clock time with today's offset
+            clock_offset = time.time() - time.monotonic()
+            since = request.get('since')
+            if since is not None:
+                since = float(since) - clock_offset
+            if request.get('seconds') is not None:
+                since = time.monotonic() - float(request['seconds'])
+            max_samples = request.get('max-samples')
+            (timestamps, values) = the_ref.history.window(since=since, max_samples=None if max_samples is None else int(max_samples))
+        except Exception as e:
+            logger.warning( f'Invalid history request "{payload}" for {the_ref}: {e}')
+            return
+        data_type = the_ref.data_converter.type
+        if data_type == 'bool':
+            values = [ bool(value) for value in values ]
+        elif not data_type.startswith('float') and not the_ref.scale:
+            values = [ int(value) for value in values ]
+        doc = { 'device': self.name, 'reference': the_ref.topic }
+        if request.get('request-id') is not None:
+            doc['request-id'] = request['request-id']
+        doc['timestamps'] = [ round(timestamp+clock_offset, 3) for timestamp in timestamps ]
+        doc['values'] = values
+        self.mqttc.publish_reference_history(self.name, the_ref.topic, self.payload_codec.encode_batch(doc),
+                                             getattr(properties, 'ResponseTopic', None), getattr(properties, 'CorrelationData', None))
+        metrics.mqtt_publishes.labels(self.name).inc()
+
+
+    async def write_to_device(self, payload:bytes, full_topic:str, dev_topic, val_topic, trace:WriteTrace=None) -> None:
+        if trace is None:
+            trace = WriteTrace(time.monotonic())
+        the_ref:Reference = self.references.get(val_topic)
         if the_ref is None :
             logger.warning( f'Tried writing to unknown reference {val_topic} by MQTT topic {full_topic}.')
             return
@@ -345,14 +805,16 @@ class Device:
             return
 
         try:
-            value = the_ref.data_converter.str2mb( payload_str)
+            value = the_ref.data_converter.py2mb( trace.unwrap_value(self.payload_codec.decode(payload)))
         except Exception as e:
-            raise Exception(f'Error converting MQTT value "{payload_str}" from "{full_topic}" for writing to Modbus: {e}')
+            raise Exception(f'Error converting MQTT value "{payload}" from "{full_topic}" for writing to Modbus: {e}')
+        trace.mark('convert')
 
         self.stats.writes_total += 1
         fct_code_write = the_ref.poller.function_code_write
         try:
-            result = await self.modbus_master.write_to_slave(fct_code_write, the_ref.write_reg, value, self.slaveid)
+            result = await self.modbus_master.write_to_slave(fct_code_write, the_ref.write_reg, value, self.slaveid, self.stats, trace,
+                                                             self.name, the_ref.poller.name)
         except Exception as e:
             self.stats.writes_error += 1
             raise Exception(f'Error writing to Modbus (device:{self.name} topic:{full_topic}): {e}')
@@ -364,6 +826,36 @@ class Device:
         # writing was successful => we can assume, that the corresponding state can be set and published
         if the_ref.is_readable:
             the_ref.publish_value( value)
+            self.flush_batch()
+            trace.mark('publish')
+
+
+    async def write_registers(self, fct_code_write:int, address:int, value, trace:WriteTrace=None) -> None:
+        # Write raw registers or coils (fct_code_write 5 or 6, multiple with a list of values)
+        self.stats.writes_total += 1
+        try:
+            await self.modbus_master.write_to_slave(fct_code_write, address, value, self.slaveid, self.stats, trace, self.name)
+        except Exception as e:
+            self.stats.writes_error += 1
+            raise
+        # Like writes from MQTT: Take the written values as the new state of the pollers' registers and publish it
+        values = value if isinstance(value, list) else [ value ]
+        for poller in self.pollers:
+            if poller.function_code_write != fct_code_write or poller.last_data is None:
+                continue
+            first = max(address, poller.start_reg)
+            last = min(address+len(values), poller.start_reg+poller.len_regs)
+            if first >= last:
+                continue
+            poller.last_data[first-poller.start_reg : last-poller.start_reg] = values[first-address : last-address]
+            for ref in poller.refs_readable_list:
+                if ref.start_reg < last and ref.start_reg+ref.data_converter.reg_cnt > first:
+                    raw_val = poller.last_data[ref.start_reg_relative : ref.start_reg_relative+ref.data_converter.reg_cnt]
+                    if None not in raw_val:
+                        ref.publish_value(raw_val)
+        self.flush_batch()
+        if trace is not None:
+            trace.mark('publish')
 
 
     def __str__(self):
@@ -378,6 +870,11 @@ class Poller:
     #
 
     all_poller = list()
+    _poller_count = 0
+
+    __slots__ = ('config_source', 'device', 'runtask', 'name', 'config_plan', 'start_reg', 'len_regs', 'reg_type', 'poll_rate',
+                 'function_code', 'function_code_write', 'refs_all_list', 'refs_readable_list', 'refs_writeable_list',
+                 'segments', 'dead_regs', 'dead_refs', 'split_retry', 'stats', 'stats_last', 'last_read', 'in_flight', 'last_data')
 
 
     #==================================================================================================================
@@ -389,7 +886,9 @@ class Poller:
         self.config_source = config_source
         self.device = device
         self.runtask = None
-        self.name = f'Poller-{len(Poller.all_poller)}'
+        self.name = f'Poller-{Poller._poller_count}'
+        Poller._poller_count += 1
+        self.config_plan = None # The config plan this poller was built from. Used for diffing on config reloads.
 
         self.start_reg = start_reg
         self.len_regs = len_regs
@@ -431,6 +930,19 @@ class Poller:
         self.refs_readable_list = list()
         self.refs_writeable_list = list()
 
+        # Split plan, if the range contains registers the slave refuses with "illegal data address"
+        self.segments = None # None: read the whole range at once. Otherwise list of (start_reg, len_regs) to read, empty if none is readable.
+        self.dead_regs = list()
+        self.dead_refs = tuple() # Topics of the references covering dead registers. They don't get published.
+        self.split_retry = None  # Time to try the whole range again, while it is split
+
+        self.stats = PollerStats()
+        self.stats_last = None
+
+        self.last_read = None   # Time of the last successful poll
+        self.in_flight = None   # Future of the running poll, resolved with its success
+        self.last_data = None   # Registers/bits of the last successful read, None for dead registers
+
         Poller.all_poller.append( self)
         self.device.register_poller( self)
 
@@ -441,18 +953,93 @@ class Poller:
         return self.device.is_ready_to_comm()
 
 
-    async def poll(self, task_group) -> None :
+    def get_statistics(self):
+        stats = self.stats.snapshot()
+        stats_last = self.stats_last
+        self.stats_last = stats
+        return (stats, stats_last)
+
+
+    async def poll(self, task_group) -> bool :
+        # Returns whether the poll succeeded. A poll requested while another one is running (scheduled or for
+        # a get request) waits for that one instead of reading the same registers again. Only the poll doing
+        # the read raises its error.
+        if self.in_flight is not None:
+            return await asyncio.shield(self.in_flight)
+        poll_start = time.monotonic()
+        success = False
+        in_flight = asyncio.get_running_loop().create_future()
+        self.in_flight = in_flight
+        try:
+            await self._poll(task_group)
+            success = True
+            self.last_read = time.monotonic()
+        finally:
+            poll_duration = time.monotonic()-poll_start
+            metrics.poll_duration.labels(self.device.name, self.name, self.function_code).observe(poll_duration)
+            self.stats.record_poll(poll_start, poll_duration, success)
+            self.in_flight = None
+            in_flight.set_result(success)
+        return success
+
+
+    async def refresh(self, task_group, max_age:float) -> str :
+        # Read-through for get requests: Poll now, unless the last poll is younger than max_age.
+        # Returns how the request is answered: 'cache', 'read' or 'failed'.
+        if self.in_flight is None:
+            if self.last_read is not None and time.monotonic()-self.last_read <= max_age:
+                return 'cache'
+            if not self.is_ready_to_comm():
+                return 'failed'
         try:
-            data = await self.device.modbus_master.read_from_slave(self.function_code, self.start_reg, self.len_regs, self.device.slaveid)
+            success = await self.poll(task_group)
+        except Exception as e:
+            logger.error(f'Error polling on request ({self}): {e}')
+            return 'failed'
+        return 'read' if success else 'failed'
+
+
+    async def _poll(self, task_group) -> None :
+        try:
+            if self.segments is None or time.monotonic() >= self.split_retry:
+                try:
+                    data = await self.device.modbus_master.read_from_slave(self.function_code, self.start_reg, self.len_regs, self.device.slaveid, self.device.stats,
+                                                                           device_name=self.device.name, poller_name=self.name)
+                except ModbusExceptionResponse as e:
+                    if e.exception_code != ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS:
+                        raise
+                    data = await self.split_range()
+                else:
+                    if self.segments is not None:
+                        logger.info(f'Whole range of {self} is readable again.')
+                        self.segments = None
+                        self.dead_regs = list()
+                    if self.dead_refs:
+                        self.update_dead_refs(data)
+            elif self.segments:
+                data = await self.read_segments()
+            else:
+                data = None # Not a single readable register, don't ask the slave again before the retry
+            if data is None:
+                raise Exception( 'No readable register in range.')
         except Exception as e:
             self.device.count_new_poll( False, task_group)
             raise Exception( f'Error reading from Modbus ({self}): {e}')
 
+        self.last_data = data
         try:
             logger.debug(f'Read Modbus fc:{self.function_code}, ref:{self.start_reg}, len:{self.len_regs}, id:{self.device.slaveid} -> data:{data}')
+            values_polled = values_published = 0
             for ref in self.refs_readable_list:
                 raw_val = data[ref.start_reg_relative : (ref.data_converter.reg_cnt+ref.start_reg_relative)]
-                ref.publish_value(raw_val)
+                if self.segments is not None and None in raw_val:
+                    continue # Reference covers a dead register
+                values_polled += 1
+                if ref.publish_value(raw_val):
+                    values_published += 1
+            self.stats.values_polled += values_polled
+            self.stats.values_published += values_published
+            self.device.flush_batch()
         except Exception as e:
             self.device.count_new_poll( False, task_group)
             raise Exception( f'Error publishing value from Modbus ({self}): {e}')
@@ -460,6 +1047,96 @@ class Poller:
         self.device.count_new_poll( True, task_group)
 
 
+    async def split_range(self) -> list|None:
+        # Bisect the poller's range into sub-requests the slave accepts. Returns the data read meanwhile,
+        # with None for the dead registers, or None if no register at all is readable.
+        # The split is kept until the retry time, only then the whole range is tried (and bisected) again.
+        segments = list()
+        data = [None] * self.len_regs
+        await self._read_bisect(self.start_reg, self.len_regs, segments, data)
+
+        # Join adjacent segments again, bisecting leaves them more fragmented than necessary
+        self.segments = list()
+        for (start_reg, len_regs) in segments:
+            if self.segments and self.segments[-1][0]+self.segments[-1][1] == start_reg:
+                self.segments[-1] = (self.segments[-1][0], self.segments[-1][1]+len_regs)
+            else:
+                self.segments.append((start_reg, len_regs))
+        dead_regs = [ self.start_reg+idx for idx in range(self.len_regs) if data[idx] is None ]
+        self.split_retry = time.monotonic() + deamon_opts['split-retry']
+
+        if dead_regs != self.dead_regs:
+            self.dead_regs = dead_regs
+            if not self.segments:
+                logger.warning(f'Illegal data address for every register in range of {self}. '
+                               f'Trying again in {deamon_opts["split-retry"]}s.')
+            else:
+                logger.warning(f'Illegal data address in range of {self}. Split into {len(self.segments)} requests. '
+                               f'Dead registers: {Poller._format_regs(self.dead_regs)}.')
+        if not self.segments:
+            return None
+        self.update_dead_refs(data)
+        return data
+
+
+    def update_dead_refs(self, data:list) -> None:
+        # Log once per reference when it starts or stops covering a dead register
+        dead_refs = tuple( ref.topic for ref in self.refs_readable_list
+                           if None in data[ref.start_reg_relative : ref.start_reg_relative+ref.data_converter.reg_cnt] )
+        if dead_refs == self.dead_refs:
+            return
+        for ref in self.refs_readable_list:
+            if ref.topic in dead_refs and ref.topic not in self.dead_refs:
+                logger.warning(f'Reference covers a register the slave refuses, not publishing it ({ref}).')
+            elif ref.topic in self.dead_refs and ref.topic not in dead_refs:
+                logger.info(f'Reference is readable again ({ref}).')
+        self.dead_refs = dead_refs
+
+
+    async def _read_bisect(self, start_reg:int, len_regs:int, segments:list, data:list) -> None:
+        try:
+            seg_data = await self.device.modbus_master.read_from_slave(self.function_code, start_reg, len_regs, self.device.slaveid, self.device.stats,
+                                                                       device_name=self.device.name, poller_name=self.name)
+        except ModbusExceptionResponse as e:
+            if e.exception_code != ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS:
+                raise
+            if len_regs > 1:
+                half = len_regs // 2
+                await self._read_bisect(start_reg, half, segments, data)
+                await self._read_bisect(start_reg+half, len_regs-half, segments, data)
+            return
+        segments.append((start_reg, len_regs))
+        data[start_reg-self.start_reg : start_reg-self.start_reg+len_regs] = seg_data[:len_regs]
+
+
+    async def read_segments(self) -> list|None:
+        data = [None] * self.len_regs
+        for (start_reg, len_regs) in self.segments:
+            try:
+                seg_data = await self.device.modbus_master.read_from_slave(self.function_code, start_reg, len_regs, self.device.slaveid, self.device.stats,
+                                                                           device_name=self.device.name, poller_name=self.name)
+            except ModbusExceptionResponse as e:
+                if e.exception_code != ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS:
+                    raise
+                # The slave changed its mind about the registers. Start over with the whole range.
+                self.segments = None
+                self.dead_regs = list()
+                raise
+            data[start_reg-self.start_reg : start_reg-self.start_reg+len_regs] = seg_data[:len_regs]
+        return data
+
+
+    @staticmethod
+    def _format_regs(regs:list[int]) -> str:
+        ranges = list()
+        for reg in regs:
+            if ranges and ranges[-1][1]+1 == reg:
+                ranges[-1][1] = reg
+            else:
+                ranges.append([reg, reg])
+        return ','.join(f'{first}' if first==last else f'{first}-{last}' for (first, last) in ranges)
+
+
     def run_workloop(self, task_group):
         #...........................................................................................
         async def workloop() -> None :
@@ -467,20 +1144,41 @@ class Poller:
                 while not self.is_ready_to_comm(): # Wait with our initial delay to be ready for communication
                     await asyncio.sleep(0.5)
                 await asyncio.sleep(self.poll_rate*random.uniform(0, 1)) # Delay start for a random time to distribute bus usage a bit
+                poll_due = None
                 while True:
                     if not self.is_ready_to_comm(): # If we're unable to communicate, just wait a bit and give it another try
                         await asyncio.sleep(0.5)
                         continue
+                    if poll_due is not None:
+                        # Whole periods we're late count as skipped cycles, the rest as lateness
+                        lateness = max(0.0, time.monotonic()-poll_due)
+                        skipped = int(lateness // self.poll_rate) if self.poll_rate > 0 else 0
+                        self.stats.skipped += skipped
+                        metrics.poll_lateness.labels(self.device.name, self.name).observe(lateness - skipped*self.poll_rate)
                     logger.debug(f'Polling... ({self}).')
                     try:
                         await self.poll(task_group)
                     except Exception as e:
                         logger.error(f'Error polling ({self}): {e}')
+                    poll_due = time.monotonic() + self.poll_rate
                     await asyncio.sleep(self.poll_rate)
             except asyncio.exceptions.CancelledError as e:
                 logger.debug(f'Poller task stopped ({self}).')
         #...........................................................................................
-        self.runtask = task_group.create_task(workloop())
+        self.runtask = task_group.create_task(workloop(), name=f'poller:{self.device.name}/{self.name}')
+
+
+    def remove(self) -> None :
+        if self.runtask is not None:
+            self.runtask.cancel()
+        for ref in self.refs_all_list:
+            self.device.unregister_reference( ref)
+        self.device.unregister_poller( self)
+        Poller.all_poller.remove( self)
+        metrics.poll_duration.remove(self.device.name, self.name, self.function_code)
+        metrics.poll_lateness.remove(self.device.name, self.name)
+        metrics.modbus_request_duration.remove_all(device=self.device.name, poller=self.name)
+        logger.debug(f'Removed poller {self}')
 
 
     def register_reference(self, new_ref:'Reference') -> None :
@@ -496,7 +1194,10 @@ class Poller:
         return f'device/poller: {self.device.name}/{self.name}, {self.config_source}'
 
 
-class Reference:
+class ReferenceDef:
+
+    __slots__ = ('config_source', 'topic', 'start_reg', 'start_reg_relative', 'write_reg', 'is_readable', 'is_writeable',
+                 'scale', 'format_str', 'hass_entity_type', 'ha_properties', 'data_converter', 'history_size')
 
     _default_data_type_by_fc = {
          3:     "uint16",   # holding_register
@@ -509,13 +1210,14 @@ class Reference:
     #
     # Instance methods
     #
+    # The immutable part of a reference: Everything taken from the config. 
+    # Built once per reference in the config and shared by all devices instantiated from the same device profile.
+    #
     
-    def __init__(self, config_source, mqttc:MqttClient, poller:Poller, topic:str, start_reg:int, write_reg:int,
+    def __init__(self, config_source, poller:Poller, topic:str, start_reg:int, write_reg:int,
                 is_readable:bool, is_writeable:bool, data_type:str, scale:float, format_str:str, 
-                hass_entity_type:str=None, ha_properties:dict=dict()):
+                hass_entity_type:str=None, ha_properties:dict=dict(), history_size:int=0):
         self.config_source = config_source
-        self.mqttc = mqttc
-        self.poller = poller
         self.topic = MqttClient.clean_topic(topic, is_single_part=True)
         self.start_reg = start_reg
         self.write_reg = write_reg
@@ -527,17 +1229,40 @@ class Reference:
         self.ha_properties = ha_properties
 
         if self.start_reg == None:
-            self.start_reg = self.poller.start_reg
-            logger.warning(f'start-reg not given for "{self}". Assuming poller\'s start-reg.')
-        self.start_reg_relative = self.start_reg-self.poller.start_reg
+            self.start_reg = poller.start_reg
+            logger.warning(f'start-reg not given for "device/reference: {poller.device.name}/{self.topic}, {self.config_source}". Assuming poller\'s start-reg.')
+        self.start_reg_relative = self.start_reg-poller.start_reg
         if self.is_writeable and self.write_reg==None:
             self.write_reg = self.start_reg
-        self.last_val = None
-        self.last_val_time = 0
 
         if not data_type or data_type=="":
-            data_type = Reference._default_data_type_by_fc[poller.function_code]
-        self.data_converter = DataConverter( data_type)
+            data_type = ReferenceDef._default_data_type_by_fc[poller.function_code]
+        self.data_converter = DataConverter.get_converter( data_type)
+
+        self.history_size = history_size if history_size else 0
+        if self.history_size < 0:
+            raise ValueError(f'history must not be negative at {self.config_source}')
+        if self.history_size > 0 and not (self.is_readable and self.data_converter.is_numeric()):
+            raise ValueError(f'history requires a readable reference with a numeric data type at {self.config_source}')
+
+
+class Reference:
+
+    __slots__ = ('poller', 'ref_def', 'last_val', 'last_val_time', 'history')
+
+    #==================================================================================================================
+    #
+    # Instance methods
+    #
+    # Only the mutable state lives here, all config derived values are taken from the (possibly shared) ReferenceDef.
+    #
+    
+    def __init__(self, poller:Poller, ref_def:ReferenceDef):
+        self.poller = poller
+        self.ref_def = ref_def
+        self.last_val = None
+        self.last_val_time = 0
+        self.history = HistoryBuffer(ref_def.history_size) if ref_def.history_size > 0 else None
 
         if self.is_writeable and self.poller.function_code_write is None:
             raise ValueError(f'Writing requested for non-writeable poller (discrete input or input register) at {self}')
@@ -548,17 +1273,58 @@ class Reference:
         self.poller.register_reference( self)
 
 
-    def publish_value(self, raw_val:list[int]) -> None:
-        pub_val = self.data_converter.mb2py(raw_val)
+    @property
+    def config_source(self): return self.ref_def.config_source
+    @property
+    def mqttc(self) -> MqttClient: return self.poller.device.mqttc
+    @property
+    def topic(self) -> str: return self.ref_def.topic
+    @property
+    def start_reg(self) -> int: return self.ref_def.start_reg
+    @property
+    def start_reg_relative(self) -> int: return self.ref_def.start_reg_relative
+    @property
+    def write_reg(self) -> int: return self.ref_def.write_reg
+    @property
+    def is_readable(self) -> bool: return self.ref_def.is_readable
+    @property
+    def is_writeable(self) -> bool: return self.ref_def.is_writeable
+    @property
+    def data_converter(self) -> DataConverter: return self.ref_def.data_converter
+    @property
+    def scale(self) -> float: return self.ref_def.scale
+    @property
+    def format_str(self) -> str: return self.ref_def.format_str
+    @property
+    def hass_entity_type(self) -> str: return self.ref_def.hass_entity_type
+    @property
+    def ha_properties(self) -> dict: return self.ref_def.ha_properties
+
+
+    def publish_value(self, raw_val:list[int]) -> bool:
+        # Returns whether the value got published
+        ref_def = self.ref_def
+        pub_val = ref_def.data_converter.mb2py(raw_val)
         pub_time = time.monotonic()
-        if self.scale:
-            pub_val = pub_val * self.scale
-        if self.format_str:
-            pub_val = self.format_str % pub_val
-        if self.last_val != pub_val or pub_time-self.last_val_time>=deamon_opts['publish-seconds']:
-            self.mqttc.publish_reference_state(self.poller.device.name, self.topic, pub_val)
-            self.last_val = pub_val
+        if ref_def.scale:
+            pub_val = pub_val * ref_def.scale
+        if self.history is not None:
+            self.history.append(pub_time, pub_val)
+        if ref_def.format_str:
+            pub_val = ref_def.format_str % pub_val
+        device = self.poller.device
+        payload = device.payload_codec.encode(pub_val)
+        if self.last_val != payload or pub_time-self.last_val_time>=deamon_opts['publish-seconds']:
+            device.publish_reference_value(self, pub_val, payload)
+            self.last_val = payload
             self.last_val_time = pub_time
+            return True
+        return False
+
+
+    def seed_last_value(self, payload:bytes) -> None:
+        self.last_val = self.poller.device.payload_codec.from_wire(payload)
+        self.last_val_time = time.monotonic()
 
 
     def __str__(self):
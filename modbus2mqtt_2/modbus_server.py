@@ -0,0 +1,174 @@
+import asyncio
+import struct
+
+from . import metrics
+from .globals import logger
+from .modbus_objects import ModbusExceptionResponse, ModbusWriter, Device
+
+
+###################################################################################################################
+#
+# Modbus TCP server
+#
+# Serves the register blocks last read by the pollers to other Modbus TCP masters (SCADA, PLCs), from memory and
+# without touching the bus. The unit ID selects the devices with that slave id. Writes to registers covered by
+# writeable references are forwarded to the slave through the ModbusWriter, like writes from MQTT.
+#
+# Exception responses:
+#   - Illegal data address:  Registers not covered by a poller, or written registers not covered by a writeable reference.
+#   - Gateway path unavailable:  No device with the unit ID.
+#   - Gateway target device failed to respond:  No current data, e.g. the device is not available.
+#
+
+_mbap_header = struct.Struct('>HHHB') # transaction id, protocol id, length, unit id
+
+_max_read_count = { 1: 2000, 2: 2000, 3: 125, 4: 125 }
+
+
+def _pack_bits(bits:list) -> bytes:
+    packed = bytearray((len(bits)+7)//8)
+    for (idx, bit) in enumerate(bits):
+        if bit:
+            packed[idx//8] |= 1 << (idx%8)
+    return bytes(packed)
+
+
+def _unpack_bits(data:bytes, count:int) -> list[bool]:
+    return [ bool(data[idx//8] & (1 << (idx%8))) for idx in range(count) ]
+
+
+class ModbusServer:
+
+    def __init__(self, modbus_writer:ModbusWriter, port:int, address:str=None) -> None:
+        self.modbus_writer = modbus_writer
+        self.port = port
+        self.address = address
+        self.runtask = None
+
+    def read(self, unit_id:int, function_code:int, address:int, count:int) -> bytes:
+        devices = [ dev for dev in Device.all_devices.values() if dev.slaveid == unit_id ]
+        if not devices:
+            raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.GATEWAY_PATH_UNAVAILABLE)
+        values = [ None ] * count
+        covered = [ False ] * count
+        for dev in devices:
+            for poller in dev.pollers:
+                if poller.function_code != function_code:
+                    continue
+                first = max(address, poller.start_reg)
+                last = min(address+count, poller.start_reg+poller.len_regs)
+                if first >= last:
+                    continue
+                covered[first-address : last-address] = [ True ] * (last-first)
+                if poller.last_data is not None and dev.is_ready_to_comm():
+                    block = poller.last_data[first-poller.start_reg : last-poller.start_reg]
+                    if poller.segments is not None and None in block:
+                        # Registers the slave refuses itself
+                        raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS)
+                    values[first-address : last-address] = block
+        if not all(covered):
+            raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS)
+        if None in values:
+            raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.GATEWAY_TARGET_FAILED)
+        if function_code in (1, 2):
+            data = _pack_bits(values)
+        else:
+            data = struct.pack(f'>{count}H', *values)
+        return struct.pack('>BB', function_code, len(data)) + data
+
+    async def write(self, unit_id:int, function_code:int, address:int, values:list) -> None:
+        # Function codes 5 and 15 write coils, 6 and 16 registers. The write is forwarded with the matching single or multiple function code.
+        fct_code_write = 5 if function_code in (5, 15) else 6
+        registers = range(address, address+len(values))
+        for dev in Device.all_devices.values():
+            if dev.slaveid != unit_id:
+                continue
+            writeable = set()
+            for poller in dev.pollers:
+                if poller.function_code_write == fct_code_write:
+                    for ref in poller.refs_writeable_list:
+                        writeable.update(range(ref.write_reg, ref.write_reg+ref.data_converter.reg_cnt))
+            if writeable.issuperset(registers):
+                value = values if function_code in (15, 16) else values[0]
+                try:
+                    await self.modbus_writer.write_registers(dev, fct_code_write, address, value)
+                except ModbusExceptionResponse as e:
+                    raise ModbusExceptionResponse(function_code, e.exception_code)
+                except Exception as e:
+                    logger.warning(f'Error forwarding write from Modbus TCP server to {dev}: {e}')
+                    raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.GATEWAY_TARGET_FAILED)
+                return
+        raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS)
+
+    async def handle_pdu(self, unit_id:int, pdu:bytes) -> bytes:
+        function_code = pdu[0]
+        try:
+            if function_code in _max_read_count:
+                (address, count) = struct.unpack_from('>HH', pdu, 1)
+                if not 1 <= count <= _max_read_count[function_code]:
+                    raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_VALUE)
+                response = self.read(unit_id, function_code, address, count)
+            elif function_code in (5, 6):
+                (address, value) = struct.unpack_from('>HH', pdu, 1)
+                if function_code == 5:
+                    if value not in (0x0000, 0xFF00):
+                        raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_VALUE)
+                    value = value == 0xFF00
+                await self.write(unit_id, function_code, address, [ value ])
+                response = pdu[:5] # Echo of the request
+            elif function_code in (15, 16):
+                (address, count, byte_cnt) = struct.unpack_from('>HHB', pdu, 1)
+                data = pdu[6:6+byte_cnt]
+                if function_code == 15 and 1 <= count <= 1968 and byte_cnt == (count+7)//8 == len(data):
+                    values = _unpack_bits(data, count)
+                elif function_code == 16 and 1 <= count <= 123 and byte_cnt == 2*count == len(data):
+                    values = list(struct.unpack(f'>{count}H', data))
+                else:
+                    raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_DATA_VALUE)
+                await self.write(unit_id, function_code, address, values)
+                response = struct.pack('>BHH', function_code, address, count)
+            else:
+                raise ModbusExceptionResponse(function_code, ModbusExceptionResponse.ILLEGAL_FUNCTION)
+        except struct.error:
+            response = struct.pack('>BB', function_code | 0x80, ModbusExceptionResponse.ILLEGAL_DATA_VALUE)
+        except ModbusExceptionResponse as e:
+            response = struct.pack('>BB', function_code | 0x80, e.exception_code)
+        metrics.modbus_server_requests.labels(function_code, 'ok' if response[0] == function_code else response[1]).inc()
+        return response
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+        logger.debug(f'Modbus TCP server: Connection from {peer}.')
+        try:
+            while True:
+                (transaction_id, protocol_id, length, unit_id) = _mbap_header.unpack(await reader.readexactly(_mbap_header.size))
+                if protocol_id != 0 or not 2 <= length <= 254:
+                    logger.warning(f'Modbus TCP server: Invalid request header from {peer}. Closing connection.')
+                    break
+                pdu = await reader.readexactly(length-1)
+                response = await self.handle_pdu(unit_id, pdu)
+                writer.write(_mbap_header.pack(transaction_id, 0, len(response)+1, unit_id) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            logger.debug(f'Modbus TCP server: Connection from {peer} closed.')
+
+    def run_workloop(self, task_group) -> None:
+        #...........................................................................................
+        async def workloop():
+            try:
+                server = await asyncio.start_server(self.handle_connection, self.address, self.port)
+                logger.info(f'Modbus TCP server listening on port {self.port}.')
+                async with server:
+                    await server.serve_forever()
+            except asyncio.exceptions.CancelledError as e:
+                logger.debug(f'Modbus TCP server task stopped ({self}).')
+            except Exception as e:
+                logger.error(f'Error running Modbus TCP server ({self}): {e}')
+        #...........................................................................................
+        self.runtask = task_group.create_task(workloop(), name='modbus-server')
+
+    def __str__(self):
+        return f'modbus server: {self.address or "*"}:{self.port}'
@@ -1,3 +1,4 @@
+import asyncio
 import ssl
 import paho.mqtt.client as mqtt
 import queue
@@ -32,7 +33,7 @@ class MqttClient:
 
     def __init__(self, mqtt_host:str, mqtt_port:int, mqtt_clientid:str,
                  mqtt_user:str, mqtt_pass:str, mqtt_cacerts:str, mqtt_insecure:bool, mqtt_tls_version:str, 
-                 topic_base:str, topic_hass_autodisco_base:str, retain_values:bool, mqtt_value_qos:int):
+                 topic_base:str, topic_hass_autodisco_base:str, retain_values:bool, mqtt_value_qos:int, mqtt_protocol:str='3.1.1'):
         self.mqtt_host = mqtt_host
         self.mqtt_port = mqtt_port
         self.mqtt_user = mqtt_user
@@ -42,17 +43,22 @@ class MqttClient:
         self.mqtt_tls_version = mqtt_tls_version
         self.retain_values = retain_values
         self.mqtt_value_qos = mqtt_value_qos
+        self.mqtt_protocol = str(mqtt_protocol) # YAML may give 5 as a number
         self.topic_base = MqttClient.clean_topic( topic_base.rstrip('/'))
         self.topic_hass_autodisco_base =  MqttClient.clean_topic( topic_hass_autodisco_base.rstrip('/'))
         self.clientid = MqttClient.clean_topic(mqtt_clientid, is_single_part=True)
         self.modbus_writer = None
+        self.hass_birth_topic = None
+        self.hass_birth_callback = None
+        self.retained_collector = None # (topic filter, collected messages) while collecting retained messages
 
-        self.unique_topic_publish_list = list()
-        self.unique_topic_subscribe_list = list()
+        self.unique_topic_publish_list = set()
+        self.unique_topic_subscribe_list = set()
 
         self._register_daemon_topics()
 
-        self.mqc = mqtt.Client(client_id=self.clientid)
+        # Only MQTT v5 carries the response topic and correlation data of requests
+        self.mqc = mqtt.Client(client_id=self.clientid, protocol=mqtt.MQTTv5 if self.mqtt_protocol == '5' else mqtt.MQTTv311)
         self.mqc.on_connect = self.on_connect_callback
         self.mqc.on_disconnect = self.on_disconnect_callback
         self.mqc.on_message = self.on_message_callback
@@ -70,6 +76,28 @@ class MqttClient:
     def set_modbus_writer(self, modbus_writer):
         self.modbus_writer = modbus_writer
 
+    def subscribe_hass_birth(self, birth_topic:str, callback) -> None:
+        self.hass_birth_topic = birth_topic
+        self.hass_birth_callback = callback
+        if self.mqc.is_connected():
+            self.mqc.subscribe(self.hass_birth_topic)
+            logger.info(f'Subscribed to MQTT topic: {self.hass_birth_topic}')
+
+    async def collect_retained(self, topic_filter:str, duration:float) -> dict:
+        # Briefly subscribe to topic_filter and collect the retained messages the broker delivers
+        for _ in range(int(duration*10)):
+            if self.mqc.is_connected():
+                break
+            await asyncio.sleep(0.1)
+        collected = dict()
+        self.retained_collector = (topic_filter, collected) # One attribute, so the MQTT thread sees filter and dict together
+        self.mqc.subscribe(topic_filter)
+        await asyncio.sleep(duration)
+        self.mqc.unsubscribe(topic_filter)
+        self.retained_collector = None
+        logger.info(f'Collected {len(collected)} retained messages from MQTT topic: {topic_filter}')
+        return collected
+
     def make_initial_connection(self) -> bool :
         # Only publish messages after the initial connection has been made. 
         # If it becomes disconnected later, then the offline buffer will store messages, but only after the intial connection was made.
@@ -100,10 +128,31 @@ class MqttClient:
     def publish_device_diagnostics(self, device_name:str, topic:str, value:str) -> None:
         self.mqc.publish(self.get_topic_device_diagnostics(device_name, topic), value, qos=0, retain=False)
 
+    def publish_device_batch(self, device_name:str, value) -> None:
+        publish_result = self.mqc.publish(self.get_topic_device_batch(device_name), value, qos=self.mqtt_value_qos, retain=self.retain_values)
+        logger.debug(f'Published MQTT topic: {self.get_topic_device_batch(device_name)} RC: {publish_result.rc}')
+
     def publish_reference_state(self, device_name:str, topic:str, value:str) -> None :
         publish_result = self.mqc.publish(f'{self.get_topic_reference_value(device_name,topic)}', value, qos=self.mqtt_value_qos, retain=self.retain_values)
         logger.debug(f'Published MQTT topic: {self.get_topic_reference_value(device_name,topic)} value: {value} RC: {publish_result.rc}')
 
+    def publish_write_response(self, device_name:str, ref_topic:str, value:str, response_topic:str=None, correlation_data:bytes=None) -> None:
+        topic = response_topic if response_topic else self.get_topic_reference_response(device_name, ref_topic)
+        self._publish_response(topic, value, correlation_data)
+
+    def publish_reference_history(self, device_name:str, ref_topic:str, value, response_topic:str=None, correlation_data:bytes=None) -> None:
+        topic = response_topic if response_topic else self.get_topic_reference_history(device_name, ref_topic)
+        self._publish_response(topic, value, correlation_data)
+
+    def _publish_response(self, topic:str, value, correlation_data:bytes=None) -> None:
+        properties = None
+        if correlation_data is not None:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.CorrelationData = correlation_data
+        self.mqc.publish(topic, value, qos=1, retain=False, properties=properties)
+
     def publish_hass_autodiscovery_entity(self, rel_topic:str, value:str) -> None :
         publish_result = self.mqc.publish(f'{self.get_topic_hass_autoconfig(rel_topic)}', value, retain=True)
         logger.debug(f'Published hass autodiscovery: {self.get_topic_hass_autoconfig(rel_topic)} value: {value} RC: {publish_result.rc}')
@@ -121,6 +170,9 @@ class MqttClient:
     #   Device topics:
     #     - Publish:   <topic_base>/<device>/<value_topic>/<reference>
     #     - Subscribe: <topic_base>/<device>/<set_topic>/<reference>
+    #     - Get:       <topic_base>/<device>/get/<reference>        (answered on the reference's value topic)
+    #     - History:   <topic_base>/<device>/get-history/<reference> (answered on <topic_base>/<device>/history/<reference>)
+    #     - Responses: <topic_base>/<device>/response/<reference>   (only for write requests with an ID)
     #
 
     def get_topic_base(self) -> str : 
@@ -147,6 +199,10 @@ class MqttClient:
         self._register_unique_topic( self.get_topic_device_availability(device_name))
         self._register_unique_topic( self.get_topic_device_diagnostics(device_name).rstrip('/'))
 
+    def unregister_device_topics( self, device_name:str) -> None :
+        self._unregister_unique_topic( self.get_topic_device_availability(device_name))
+        self._unregister_unique_topic( self.get_topic_device_diagnostics(device_name).rstrip('/'))
+
     def get_topic_device_value_base(self, device_name:str) -> str : 
         return f'{self.get_topic_base()}/{device_name}'
     def get_topic_device_sub_base(self, device_name:str) -> str : 
@@ -156,13 +212,31 @@ class MqttClient:
         return f'{self.get_topic_device_value_base(device_name)}/connected'
     def get_topic_device_diagnostics(self, device_name:str, topic:str="") -> str:
         return f'{self.get_topic_device_value_base(device_name)}/diagnostics/{topic}'
+
+    def register_device_batch_topic( self, device_name:str) -> None :
+        self._register_unique_topic( self.get_topic_device_batch(device_name))
+
+    def unregister_device_batch_topic( self, device_name:str) -> None :
+        self._unregister_unique_topic( self.get_topic_device_batch(device_name))
+
+    def get_topic_device_batch(self, device_name:str) -> str:
+        return f'{self.get_topic_device_value_base(device_name)}/batch'
     
 
-    def register_reference_topics( self, device_name:str, ref_topic:str, is_writable:bool) -> None :
+    def register_reference_topics( self, device_name:str, ref_topic:str, is_writable:bool, has_history:bool=False) -> None :
         self._register_unique_topic( self.get_topic_reference_value(device_name, ref_topic))
+        if has_history:
+             self._register_unique_topic( self.get_topic_reference_history_request(device_name, ref_topic), is_subsciption=True)
         if is_writable:
              self._register_unique_topic( self.get_topic_reference_subsciption(device_name, ref_topic), is_subsciption=True)
     
+    def unregister_reference_topics( self, device_name:str, ref_topic:str, is_writable:bool, has_history:bool=False) -> None :
+        self._unregister_unique_topic( self.get_topic_reference_value(device_name, ref_topic))
+        if has_history:
+             self._unregister_unique_topic( self.get_topic_reference_history_request(device_name, ref_topic), is_subsciption=True)
+        if is_writable:
+             self._unregister_unique_topic( self.get_topic_reference_subsciption(device_name, ref_topic), is_subsciption=True)
+
     def get_topic_reference_value_base(self, device_name:str) -> str : 
         return f'{self.get_topic_base()}/{device_name}/value'
     def get_topic_reference_sub_base(self, device_name:str) -> str : 
@@ -172,6 +246,14 @@ class MqttClient:
         return f'{self.get_topic_reference_value_base(device_name)}/{ref_topic}'
     def get_topic_reference_subsciption(self, device_name:str, ref_topic:str) -> str : 
         return f'{self.get_topic_reference_sub_base(device_name)}/{ref_topic}'
+    def get_topic_reference_get(self, device_name:str, ref_topic:str) -> str : 
+        return f'{self.get_topic_base()}/{device_name}/get/{ref_topic}'
+    def get_topic_reference_history_request(self, device_name:str, ref_topic:str) -> str : 
+        return f'{self.get_topic_base()}/{device_name}/get-history/{ref_topic}'
+    def get_topic_reference_history(self, device_name:str, ref_topic:str) -> str : 
+        return f'{self.get_topic_base()}/{device_name}/history/{ref_topic}'
+    def get_topic_reference_response(self, device_name:str, ref_topic:str) -> str : 
+        return f'{self.get_topic_base()}/{device_name}/response/{ref_topic}'
 
 
     def register_hass_topics( self) -> None :
@@ -187,9 +269,15 @@ class MqttClient:
     def _register_unique_topic(self, topic:str, is_subsciption:bool=False) -> None:
         self._check_unique_topic(topic, is_subsciption) 
         if is_subsciption:
-            self.unique_topic_publish_list.append(topic)
+            self.unique_topic_publish_list.add(topic)
+        else:
+            self.unique_topic_subscribe_list.add(topic)
+
+    def _unregister_unique_topic(self, topic:str, is_subsciption:bool=False) -> None:
+        if is_subsciption:
+            self.unique_topic_publish_list.discard(topic)
         else:
-            self.unique_topic_subscribe_list.append(topic)
+            self.unique_topic_subscribe_list.discard(topic)
 
     def _check_unique_topic(self, topic:str, is_subsciption:bool=False) -> None:
         if is_subsciption:
@@ -209,9 +297,10 @@ class MqttClient:
     # Callback methods
     #
 
-    def on_connect_callback(self, mqc, userdata, flags, rc):
+    def on_connect_callback(self, mqc, userdata, flags, rc, properties=None):
+        # With MQTT v5, rc is a ReasonCodes object, which compares equal to its numeric value
         if rc != 0:
-            logger.error(f'MQTT Connection refused: {mqtt.connack_string(rc)}')
+            logger.error(f'MQTT Connection refused: {rc if self.mqtt_protocol == "5" else mqtt.connack_string(rc)}')
             return
 
         self.publish_daemon_availability(True)
@@ -219,14 +308,29 @@ class MqttClient:
 
         mqc.subscribe(self.get_topic_reference_subsciption('+', '+'))
         logger.info(f'Subscribed to MQTT topic: {self.get_topic_reference_subsciption("+", "+")}')
+        mqc.subscribe(self.get_topic_reference_get('+', '+'))
+        logger.info(f'Subscribed to MQTT topic: {self.get_topic_reference_get("+", "+")}')
+        mqc.subscribe(self.get_topic_reference_history_request('+', '+'))
+        logger.info(f'Subscribed to MQTT topic: {self.get_topic_reference_history_request("+", "+")}')
+        if self.hass_birth_topic:
+            mqc.subscribe(self.hass_birth_topic)
+            logger.info(f'Subscribed to MQTT topic: {self.hass_birth_topic}')
         #XXX mqc.subscribe(self.topic_base + "/reset-autoremove")
 
 
-    def on_disconnect_callback(self, mqc, userdata, rc):
+    def on_disconnect_callback(self, mqc, userdata, rc, properties=None):
         logger.info("MQTT Disconnected, RC:"+str(rc))
 
     def on_log_callback(self, mgc, userdata, level, buf):
         logger.log( level, f'MQTT log: {buf}')
 
     def on_message_callback(self, mqc, userdata, msg):
+        if self.hass_birth_topic and msg.topic == self.hass_birth_topic:
+            self.hass_birth_callback(msg.payload.decode('utf-8', errors='replace'))
+            return
+        retained_collector = self.retained_collector
+        if retained_collector is not None and mqtt.topic_matches_sub(retained_collector[0], msg.topic):
+            if msg.retain:
+                retained_collector[1][msg.topic] = msg.payload
+            return
         self.modbus_writer.add_set_request(userdata, msg)
@@ -0,0 +1,115 @@
+import json
+
+
+###################################################################################################################
+#
+# Classes for encoding MQTT payloads
+#
+# The text codec keeps the classic behaviour: values are published as their string representation.
+# Binary codecs publish typed values (and batched device documents) as CBOR or MessagePack.
+# Their libraries are optional and only imported when the encoding is actually configured.
+#
+
+class PayloadCodec:
+
+    _all_codecs = dict()
+    _instances = dict()
+    encoding = None
+    is_binary = False
+
+    @classmethod
+    def _register_codec(cls, codec_cls) -> None:
+        PayloadCodec._all_codecs[codec_cls.encoding] = codec_cls
+
+    @classmethod
+    def get_codec(cls, encoding:str) -> 'PayloadCodec':
+        encoding = 'text' if encoding is None or encoding == '' else encoding
+        if encoding not in PayloadCodec._all_codecs:
+            raise ValueError(f'Unknown payload encoding "{encoding}". Must be one of {list(PayloadCodec._all_codecs)}.')
+        if encoding not in PayloadCodec._instances:
+            PayloadCodec._instances[encoding] = PayloadCodec._all_codecs[encoding]()
+        return PayloadCodec._instances[encoding]
+
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, payload:bytes):
+        raise NotImplementedError
+
+    def encode_batch(self, values:dict):
+        raise NotImplementedError
+
+    def from_wire(self, payload:bytes):
+        # Returns a received payload in the form encode() would have produced it
+        return payload
+
+    def __str__(self):
+        return f'payload encoding: {self.encoding}'
+
+
+class _TextCodec(PayloadCodec):
+
+    encoding = 'text'
+
+    def encode(self, value) -> str:
+        return str(value)
+
+    def decode(self, payload:bytes) -> str:
+        return str(payload.decode("utf-8"))
+
+    def encode_batch(self, values:dict) -> str:
+        return json.dumps(values, separators=(',',':'))
+
+    def from_wire(self, payload:bytes) -> str:
+        return payload.decode("utf-8", errors="replace")
+
+
+class _CborCodec(PayloadCodec):
+
+    encoding = 'cbor'
+    is_binary = True
+
+    def __init__(self) -> None:
+        try:
+            import cbor2
+        except ImportError:
+            raise ValueError(f'Payload encoding "{self.encoding}" requires the python package cbor2.')
+        self._dumps = cbor2.dumps
+        self._loads = cbor2.loads
+
+    def encode(self, value) -> bytes:
+        return self._dumps(value)
+
+    def decode(self, payload:bytes):
+        return self._loads(payload)
+
+    def encode_batch(self, values:dict) -> bytes:
+        return self._dumps(values)
+
+
+class _MsgpackCodec(PayloadCodec):
+
+    encoding = 'msgpack'
+    is_binary = True
+
+    def __init__(self) -> None:
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError(f'Payload encoding "{self.encoding}" requires the python package msgpack.')
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+
+    def encode(self, value) -> bytes:
+        return self._packb(value, use_bin_type=True)
+
+    def decode(self, payload:bytes):
+        return self._unpackb(payload, raw=False)
+
+    def encode_batch(self, values:dict) -> bytes:
+        return self._packb(values, use_bin_type=True)
+
+
+PayloadCodec._register_codec(_TextCodec)
+PayloadCodec._register_codec(_CborCodec)
+PayloadCodec._register_codec(_MsgpackCodec)
@@ -0,0 +1,156 @@
+import asyncio
+import io
+import json
+import os
+import time
+
+from .globals import logger
+from .mqtt_client import MqttClient
+
+
+###################################################################################################################
+#
+# Profiling a running daemon
+#
+# Daemon commands, sent to <topic_base>/<clientId>/set/<command>:
+#   profile-start   Run cProfile on the event loop thread for <payload> seconds (default 30)
+#   profile-stop    Stop a running profile early
+#   memory-top      Publish the <payload> (default 25) top allocation sites. Starts tracemalloc on first use.
+#   memory-stop     Stop tracemalloc
+#   tasks           Publish the number of asyncio tasks, grouped by their coroutine
+#
+# Results are published to <topic_base>/<clientId>/diagnostics/{profile|memory|tasks}. If profile-dir is set, they are
+# also written there, the profile additionally in binary form for tools like snakeviz.
+# cProfile, pstats and tracemalloc are only imported on first use.
+#
+
+class Profiler:
+
+    def __init__(self, mqtt_client:MqttClient, profile_dir:str=None) -> None:
+        self.mqtt_client = mqtt_client
+        self.profile_dir = profile_dir
+        self.task_group = None
+        self.profile = None
+        self.profile_task = None
+
+    def run_workloop(self, task_group, modbus_writer) -> None:
+        # No own loop, just the command handlers. Profiling runs are tasks in the task group.
+        self.task_group = task_group
+        modbus_writer.register_daemon_command('profile-start', self.on_profile_start)
+        modbus_writer.register_daemon_command('profile-stop', self.on_profile_stop)
+        modbus_writer.register_daemon_command('memory-top', self.on_memory_top)
+        modbus_writer.register_daemon_command('memory-stop', self.on_memory_stop)
+        modbus_writer.register_daemon_command('tasks', self.on_tasks)
+
+    @staticmethod
+    def _payload_number(payload:bytes, default:float) -> float:
+        text = payload.decode('utf-8', errors='replace').strip() if payload else ''
+        return float(text) if text else default
+
+
+    #------------------------------------------------------------------------------------------------------------------
+    # cProfile
+    #
+
+    async def on_profile_start(self, payload:bytes) -> None:
+        if self.profile is not None:
+            logger.warning(f'Profiling already running ({self}).')
+            return
+        duration = Profiler._payload_number(payload, 30.0)
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logger.info(f'Profiling started for {duration} seconds.')
+        #...........................................................................................
+        async def stop_later():
+            try:
+                await asyncio.sleep(duration)
+                self.finish_profile()
+            except asyncio.exceptions.CancelledError as e:
+                pass
+        #...........................................................................................
+        self.profile_task = self.task_group.create_task(stop_later(), name='profiler')
+
+    async def on_profile_stop(self, payload:bytes) -> None:
+        if self.profile is None:
+            logger.warning(f'No profiling running ({self}).')
+            return
+        self.profile_task.cancel()
+        self.finish_profile()
+
+    def finish_profile(self) -> None:
+        import pstats
+        profile = self.profile
+        self.profile = None
+        profile.disable()
+        text_stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=text_stream)
+        stats.sort_stats('cumulative').print_stats(40)
+        result = text_stream.getvalue()
+        self.publish_result('profile', result)
+        if self.profile_dir:
+            try:
+                stats.dump_stats(self._result_file_name('profile', 'prof'))
+            except Exception as e:
+                logger.error(f'Error writing profile to {self.profile_dir}: {e}')
+        logger.info(f'Profiling finished.')
+
+
+    #------------------------------------------------------------------------------------------------------------------
+    # tracemalloc
+    #
+
+    async def on_memory_top(self, payload:bytes) -> None:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.publish_result('memory', 'tracemalloc started, only allocations from now on are traced. Send memory-top again for results.')
+            return
+        top_n = int(Profiler._payload_number(payload, 25))
+        snapshot = tracemalloc.take_snapshot()
+        (mem_current, mem_peak) = tracemalloc.get_traced_memory()
+        lines = [ f'Traced memory: {mem_current/1024:.1f} KiB (peak {mem_peak/1024:.1f} KiB)' ]
+        lines += [ str(stat) for stat in snapshot.statistics('lineno')[:top_n] ]
+        self.publish_result('memory', '\n'.join(lines))
+
+    async def on_memory_stop(self, payload:bytes) -> None:
+        import tracemalloc
+        tracemalloc.stop()
+        logger.info(f'tracemalloc stopped.')
+
+
+    #------------------------------------------------------------------------------------------------------------------
+    # asyncio tasks
+    #
+
+    async def on_tasks(self, payload:bytes) -> None:
+        self.publish_result('tasks', json.dumps(Profiler.count_tasks()))
+
+    @staticmethod
+    def count_tasks() -> dict:
+        counts = dict()
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            name = getattr(coro, '__qualname__', None) or type(coro).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+    #------------------------------------------------------------------------------------------------------------------
+    # Output
+    #
+
+    def _result_file_name(self, kind:str, extension:str) -> str:
+        return os.path.join(self.profile_dir, f'{kind}-{time.strftime("%Y%m%d-%H%M%S")}.{extension}')
+
+    def publish_result(self, kind:str, result:str) -> None:
+        self.mqtt_client.publish_modbus_diagnostics(kind, result)
+        if self.profile_dir:
+            try:
+                with open(self._result_file_name(kind, 'txt'), 'w') as result_file:
+                    result_file.write(result)
+            except Exception as e:
+                logger.error(f'Error writing {kind} to {self.profile_dir}: {e}')
+
+    def __str__(self):
+        return f'profiler: dir:{self.profile_dir}'
@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import sys
+
+from .modbus_objects import ModbusMaster, ModbusExceptionResponse
+from .globals import logger
+
+
+###################################################################################################################
+#
+# Discovering the register map of undocumented devices
+#
+# Probes register ranges of one or more slaves and suggests a minimal poller layout as yaml.
+# A range answered with "illegal data address" is bisected until the readable parts are found.
+# With Modbus TCP each slave is probed over its own connection, so slaves are scanned concurrently.
+# On a serial bus all probes share the one master and get serialized by its lock.
+#
+# run with:  python -m modbus2mqtt_2.scanner --tcp <host> --slave-id 1 2 3
+#
+
+class RegisterScanner:
+
+    _reg_types = {
+        # reg-type:          (function code, max registers per request)
+        'holding_register':  (3, 123),
+        'input_register':    (4, 123),
+        'coil':              (1, 2000),
+        'input_status':      (2, 2000),
+    }
+
+    def __init__(self, modbus_master:ModbusMaster, slaveid:int, probe_timeout:float):
+        self.modbus_master = modbus_master
+        self.slaveid = slaveid
+        self.probe_timeout = probe_timeout
+        self.probe_cnt = 0
+        self.readable = dict() # reg-type -> sorted list of (start_reg, len_regs) ranges
+        self.errors = dict()   # reg-type -> list of (start_reg, len_regs, error text) for ranges that failed otherwise
+
+
+    async def scan(self, reg_types:list[str], start_reg:int, end_reg:int) -> None:
+        for reg_type in reg_types:
+            (function_code, max_len) = RegisterScanner._reg_types[reg_type]
+            self.readable[reg_type] = list()
+            self.errors[reg_type] = list()
+            try:
+                for chunk_start in range(start_reg, end_reg, max_len):
+                    await self._probe(reg_type, function_code, chunk_start, min(max_len, end_reg-chunk_start))
+            except ModbusExceptionResponse as e:
+                if e.exception_code != ModbusExceptionResponse.ILLEGAL_FUNCTION:
+                    raise
+                logger.info(f'Slave {self.slaveid} does not support {reg_type}.')
+            self.readable[reg_type] = RegisterScanner._merge_ranges(self.readable[reg_type])
+
+
+    async def _probe(self, reg_type:str, function_code:int, start_reg:int, len_regs:int) -> None:
+        self.probe_cnt += 1
+        try:
+            await self.modbus_master.read_from_slave(function_code, start_reg, len_regs, self.slaveid, timeout=self.probe_timeout)
+            self.readable[reg_type].append((start_reg, len_regs))
+            logger.debug(f'Slave {self.slaveid}: {reg_type} {start_reg}..{start_reg+len_regs-1} readable')
+            return
+        except ModbusExceptionResponse as e:
+            if e.exception_code == ModbusExceptionResponse.ILLEGAL_FUNCTION:
+                raise
+            if e.exception_code != ModbusExceptionResponse.ILLEGAL_DATA_ADDRESS and e.exception_code != ModbusExceptionResponse.ILLEGAL_DATA_VALUE:
+                self.errors[reg_type].append((start_reg, len_regs, str(e)))
+                logger.warning(f'Slave {self.slaveid}: {reg_type} {start_reg}..{start_reg+len_regs-1} failed: {e}')
+                return
+        except Exception as e:
+            self.errors[reg_type].append((start_reg, len_regs, str(e) or type(e).__name__))
+            logger.warning(f'Slave {self.slaveid}: {reg_type} {start_reg}..{start_reg+len_regs-1} failed: {str(e) or type(e).__name__}')
+            return
+
+        # Some register in the range does not exist: bisect
+        if len_regs == 1:
+            return
+        half = len_regs // 2
+        await self._probe(reg_type, function_code, start_reg, half)
+        await self._probe(reg_type, function_code, start_reg+half, len_regs-half)
+
+
+    @staticmethod
+    def _merge_ranges(ranges:list[tuple[int,int]]) -> list[tuple[int,int]]:
+        merged = list()
+        for (start_reg, len_regs) in sorted(ranges):
+            if merged and merged[-1][0]+merged[-1][1] == start_reg:
+                merged[-1] = (merged[-1][0], merged[-1][1]+len_regs)
+            else:
+                merged.append((start_reg, len_regs))
+        return merged
+
+
+    def suggest_pollers(self, with_references:bool) -> list[dict]:
+        # Readable ranges can't be joined over dead registers, so the minimal layout is every range split at max request size
+        pollers = list()
+        for reg_type, ranges in self.readable.items():
+            max_len = RegisterScanner._reg_types[reg_type][1]
+            for (range_start, range_len) in ranges:
+                for start_reg in range(range_start, range_start+range_len, max_len):
+                    len_regs = min(max_len, range_start+range_len-start_reg)
+                    poller = { 'start-reg': start_reg, 'len-regs': len_regs, 'reg-type': reg_type }
+                    if with_references:
+                        poller['References'] = [ { 'topic': f'{reg_type}-{reg}', 'start-reg': reg } for reg in range(start_reg, start_reg+len_regs) ]
+                    pollers.append(poller)
+        return pollers
+
+
+    def __str__(self):
+        return f'scanner: slave-id:{self.slaveid}'
+
+
+async def scan_slaves(args) -> list[RegisterScanner]:
+    if args.tcp:
+        # One connection per slave, so slaves can be probed in parallel
+        masters = [ ModbusMaster.new_modbus_tcp_master(args.tcp, args.tcp_port) for slaveid in args.slave_id ]
+    else:
+        masters = [ ModbusMaster.new_modbus_rtu_master(args.rtu, args.rtu_parity, args.rtu_baud, args.timeout) ] * len(args.slave_id)
+    for master in set(masters):
+        await master.master.connect()
+        if not master.master.connected:
+            raise ConnectionError(f'Unable to connect to Modbus ({args.tcp if args.tcp else args.rtu}).')
+
+    scanners = [ RegisterScanner(master, slaveid, args.timeout) for (master, slaveid) in zip(masters, args.slave_id) ]
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for scanner in scanners:
+                tg.create_task(scanner.scan(args.reg_types, args.start_reg, args.end_reg))
+    finally:
+        for master in set(masters):
+            master.master.close()
+    return scanners
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='modbus2mqtt_2.scanner', description='Scan the register map of Modbus slaves and suggest pollers.')
+    connTypeGroup = parser.add_mutually_exclusive_group(required=True)
+    connTypeGroup.add_argument('--rtu', help='pyserial URL (or port name) for RTU serial port')
+    connTypeGroup.add_argument('--tcp', help='Act as a Modbus TCP master, connecting to host TCP')
+    parser.add_argument('--rtu-baud', type=int, default=19200, help='Baud rate for serial port. Default: 19200')
+    parser.add_argument('--rtu-parity', choices=[ 'even', 'odd', 'none'], default='even', help='Parity for serial port. Default: even')
+    parser.add_argument('--tcp-port', type=int, default=502, help='Port for MODBUS TCP. Default: 502')
+    parser.add_argument('--slave-id', type=int, nargs='+', required=True, help='Slave address(es) to scan.')
+    parser.add_argument('--reg-types', nargs='+', choices=list(RegisterScanner._reg_types), default=list(RegisterScanner._reg_types), help='Register types to scan. Default: all')
+    parser.add_argument('--start-reg', type=lambda x: int(x,0), default=0, help='First register to scan. Default: 0')
+    parser.add_argument('--end-reg', type=lambda x: int(x,0), default=10000, help='Scan up to this register (exclusive). Default: 10000')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Time-out for a single probe in seconds. Default: 1.0')
+    parser.add_argument('--references', action='store_true', help='Add a reference for every readable register to the suggested pollers.')
+    parser.add_argument('--verbosity', choices=['debug', 'info', 'warning', 'error', 'critical'], default='info', help='Verbosity level. Default: info')
+    args = parser.parse_args()
+    logger.setLevel(args.verbosity.upper())
+
+    try:
+        scanners = asyncio.run(scan_slaves(args))
+    except Exception as e:
+        logger.error(f'Scan failed: {e}')
+        sys.exit(1)
+
+    import yaml
+    devices = list()
+    for scanner in scanners:
+        logger.info(f'Slave {scanner.slaveid}: {scanner.probe_cnt} probes, {sum(len(ranges) for ranges in scanner.readable.values())} readable ranges.')
+        devices.append({ 'name': f'slave-{scanner.slaveid}', 'slave-id': scanner.slaveid, 'Pollers': scanner.suggest_pollers(args.references) })
+    print(yaml.dump({ 'Devices': devices }, sort_keys=False))
+
+
+if __name__ == '__main__':
+    main()
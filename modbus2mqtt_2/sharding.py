@@ -0,0 +1,287 @@
+import asyncio
+import multiprocessing
+import time
+
+from types import SimpleNamespace
+
+import modbus2mqtt_2.event_loop as event_loop
+
+from .globals import logger, deamon_opts
+from .mqtt_client import MqttClient
+from .modbus_objects import ModbusWriter
+
+
+###################################################################################################################
+#
+# Sharding the devices over worker processes
+#
+# With --workers N, the devices of the configuration are distributed over N worker processes. Each worker polls
+# its devices with its own Modbus TCP connection, decodes the values and sends the resulting publishes in batches
+# through a pipe to the parent process. The parent owns the MQTT connection: it publishes for the workers and
+# routes set requests to the worker owning the device. Daemon commands are handled by the parent.
+#
+# Messages parent -> worker:  ('seed', retained), ('start',), ('set', topic, payload, arrival), ('hass-status', payload), ('stop',)
+# Messages worker -> parent:  ('devices', [names]), ('failed',), ('publish', [(topic, payload, qos, retain, properties)])
+#
+
+_PUBLISH_RESULT = SimpleNamespace(rc=0)
+
+
+class MqttUplink:
+    # Stands in for the paho client in the worker processes. Publishes are collected and sent to the parent
+    # in one batch per event loop iteration.
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.pending = list()
+        self.loop = None
+
+    def publish(self, topic:str, payload=None, qos:int=0, retain:bool=False, properties=None) -> SimpleNamespace:
+        self.pending.append((topic, payload, qos, retain, properties))
+        if len(self.pending) == 1:
+            if self.loop is not None and self.loop.is_running():
+                self.loop.call_soon(self.flush)
+            else:
+                self.flush()
+        return _PUBLISH_RESULT
+
+    def flush(self) -> None:
+        if self.pending:
+            (pending, self.pending) = (self.pending, list())
+            self.conn.send(('publish', pending))
+
+    def is_connected(self) -> bool:
+        # Subscriptions are made by the parent
+        return False
+
+    def subscribe(self, topic:str) -> None:
+        pass
+
+    def unsubscribe(self, topic:str) -> None:
+        pass
+
+
+class ShardedBridge:
+    # Runs in the parent process. Takes the place of the ModbusWriter for the MQTT client and routes the set requests.
+
+    startup_timeout = 120.0
+
+    def __init__(self, mqtt_client:MqttClient, modbus_writer:ModbusWriter, config_file_name:str, worker_cnt:int) -> None:
+        self.mqtt_client = mqtt_client
+        self.modbus_writer = modbus_writer
+        self.config_file_name = config_file_name
+        self.worker_cnt = worker_cnt
+        self.workers = list()           # (process, connection) per worker
+        self.device_workers = dict()    # device name -> worker index
+        self.loop = None
+        self.runtask = None
+
+    def start(self) -> None:
+        # Start the workers and wait until all of them have read their part of the configuration
+        context = multiprocessing.get_context('spawn')
+        opts = { key: value for (key, value) in deamon_opts.items() if key != 'config' } # Without the open config file
+        for worker_idx in range(self.worker_cnt):
+            (parent_conn, worker_conn) = context.Pipe()
+            process = context.Process(target=worker_main, name=f'modbus2mqtt-worker-{worker_idx}', daemon=True,
+                                      args=(worker_conn, worker_idx, self.worker_cnt, self.config_file_name, opts))
+            process.start()
+            worker_conn.close()
+            self.workers.append((process, parent_conn))
+        for (worker_idx, (process, conn)) in enumerate(self.workers):
+            if not conn.poll(self.startup_timeout):
+                raise TimeoutError(f'Worker {worker_idx} did not start within {self.startup_timeout}s')
+            msg = conn.recv()
+            if msg[0] != 'devices':
+                raise RuntimeError(f'Worker {worker_idx} failed reading its configuration')
+            for device_name in msg[1]:
+                self.device_workers[device_name] = worker_idx
+            logger.info(f'Worker {worker_idx} (pid {process.pid}) serves {len(msg[1])} devices.')
+
+    def stop(self) -> None:
+        for (process, conn) in self.workers:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+        for (process, conn) in self.workers:
+            # Publish what the workers send while stopping, e.g. the devices becoming unavailable
+            try:
+                while conn.poll(5.0):
+                    msg = conn.recv()
+                    if msg[0] == 'publish':
+                        self.publish(msg[1])
+            except (EOFError, OSError):
+                pass
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+
+    def add_set_request(self, req_userdata, req_msg) -> None:
+        # Called from within the MQTT client's thread
+        short_topic = str(req_msg.topic).removeprefix(self.mqtt_client.get_topic_base()+'/')
+        worker_idx = self.device_workers.get(short_topic.split('/')[0])
+        if worker_idx is None or self.loop is None:
+            self.modbus_writer.add_set_request(req_userdata, req_msg) # Daemon commands and unknown devices
+            return
+        self.loop.call_soon_threadsafe(self.send_to_worker, worker_idx, ('set', req_msg.topic, req_msg.payload, time.monotonic()))
+
+    def on_hass_status(self, payload:str) -> None:
+        # Called from within the MQTT client's thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send_to_all, ('hass-status', payload))
+
+    def seed_last_values(self, retained:dict) -> None:
+        self.send_to_all(('seed', retained))
+
+    def send_to_worker(self, worker_idx:int, msg:tuple) -> None:
+        (process, conn) = self.workers[worker_idx]
+        try:
+            conn.send(msg)
+        except OSError as e:
+            logger.error(f'Sending to worker {worker_idx} failed: {e}')
+
+    def send_to_all(self, msg:tuple) -> None:
+        for worker_idx in range(len(self.workers)):
+            self.send_to_worker(worker_idx, msg)
+
+    def on_worker_message(self, worker_idx:int) -> None:
+        (process, conn) = self.workers[worker_idx]
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            self.loop.remove_reader(conn.fileno())
+            self.on_worker_died(worker_idx)
+            return
+        if msg[0] == 'publish':
+            self.publish(msg[1])
+        else:
+            logger.warning(f'Unexpected message {msg[0]} from worker {worker_idx}.')
+
+    def publish(self, batch:list) -> None:
+        for (topic, payload, qos, retain, properties) in batch:
+            self.mqtt_client.mqc.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+
+    def on_worker_died(self, worker_idx:int) -> None:
+        device_names = [ name for (name, idx) in self.device_workers.items() if idx == worker_idx ]
+        logger.critical(f'Worker {worker_idx} stopped. Its {len(device_names)} devices are unavailable.')
+        for device_name in device_names:
+            self.mqtt_client.publish_device_availability(device_name, False)
+            del self.device_workers[device_name]
+
+    def run_workloop(self, task_group) -> None:
+        self.loop = asyncio.get_running_loop()
+        for (worker_idx, (process, conn)) in enumerate(self.workers):
+            self.loop.add_reader(conn.fileno(), self.on_worker_message, worker_idx)
+        self.send_to_all(('start',))
+
+    def __str__(self):
+        return f'sharded bridge: {self.worker_cnt} workers'
+
+
+###################################################################################################################
+#
+# The worker process
+#
+
+def worker_main(conn, worker_idx:int, worker_cnt:int, config_file_name:str, opts:dict) -> None:
+    # Entry point of a worker process. Imported here, as main imports this module.
+    import modbus2mqtt_2.config_reader as config_reader
+    from .config_reader import ConfigYaml
+    from .main import DiagnosticsMaster, new_mqtt_client
+    from .modbus_objects import ModbusMaster, Device
+
+    deamon_opts.update(opts)
+    logger.setLevel(deamon_opts['verbosity'].upper())
+
+    mqtt_client = new_mqtt_client()
+    uplink = MqttUplink(conn)
+    mqtt_client.mqc = uplink
+    modbus_master = ModbusMaster.new_modbus_tcp_master(deamon_opts['tcp'], deamon_opts['tcp-port'])
+    modbus_writer = ModbusWriter(mqtt_client)
+    mqtt_client.set_modbus_writer(modbus_writer)
+    diag_master = DiagnosticsMaster(deamon_opts['diagnostics-rate'], mqtt_client, modbus_master)
+    diag_master.stats_topic = f'stats/worker-{worker_idx}'
+
+    with open(config_file_name, 'r') as config_file:
+        ConfigYaml.read_devices(config_file, mqtt_client, modbus_master, shard=(worker_idx, worker_cnt))
+    if config_reader.config_error_count > 0:
+        conn.send(('failed',))
+        return
+    conn.send(('devices', list(Device.all_devices)))
+
+    # Wait for the parent to be connected to the MQTT broker
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if msg[0] == 'seed':
+            seeded = sum(dev.seed_last_values(msg[1]) for dev in Device.all_devices.values())
+            logger.info(f'Seeded {seeded} references from retained values.')
+        elif msg[0] == 'start':
+            break
+        elif msg[0] == 'stop':
+            return
+
+    try:
+        event_loop.run(worker_async_main(conn, uplink, mqtt_client, modbus_writer, modbus_master, diag_master), deamon_opts['event-loop'])
+    except KeyboardInterrupt as e:
+        pass
+    finally:
+        for dev in Device.all_devices.values():
+            dev.disable()
+        try:
+            uplink.flush()
+        except OSError:
+            pass
+    logger.debug(f'Worker {worker_idx} stopped.')
+
+
+async def worker_async_main(conn, uplink:MqttUplink, mqtt_client:MqttClient, modbus_writer:ModbusWriter, modbus_master, diag_master) -> None:
+    from .loop_monitor import LoopMonitor
+    from .modbus_objects import Device, Poller
+
+    loop = asyncio.get_running_loop()
+    uplink.loop = loop
+    main_task = asyncio.current_task()
+    hass_connector = None
+    #...........................................................................................
+    def on_parent_message():
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            msg = ('stop',) # Parent is gone
+        if msg[0] == 'set':
+            (_, topic, payload, arrival) = msg
+            modbus_writer.add_set_request(None, SimpleNamespace(topic=topic, payload=payload), arrival)
+        elif msg[0] == 'hass-status':
+            if hass_connector is not None:
+                hass_connector.on_hass_status(msg[1])
+        elif msg[0] == 'stop':
+            loop.remove_reader(conn.fileno())
+            main_task.cancel()
+    #...........................................................................................
+    loop.add_reader(conn.fileno(), on_parent_message)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            if deamon_opts['add-to-homeassistant']:
+                try:
+                    from .home_assistant import HassConnector
+                    hass_connector = HassConnector(mqtt_client, deamon_opts['hass-discovery-rate'], deamon_opts['hass-birth-topic'])
+                    hass_connector.run_workloop(tg)
+                except Exception as e:
+                    logger.error( f'Error setting up homeassistant autodiscovery: {e}')
+            if deamon_opts['loop-block-threshold'] > 0:
+                loop_monitor = LoopMonitor(mqtt_client, deamon_opts['loop-block-threshold'])
+                loop_monitor.run_workloop(tg)
+                diag_master.loop_monitor = loop_monitor
+            modbus_master.run_workloop(tg)
+            modbus_writer.run_workloop(tg)
+            diag_master.run_workloop(tg)
+            for poller in Poller.all_poller:
+                poller.run_workloop(tg)
+    except Exception as e:
+        logger.critical( f'Fatal error in worker loop: {e}')
+    except asyncio.exceptions.CancelledError as e:
+        pass
@@ -0,0 +1,91 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from .capture import CaptureWriter, ReplayClient, read_capture, STATUS_OK, STATUS_ERROR
+from .globals import deamon_opts
+from .modbus_objects import ModbusExceptionResponse, ModbusMaster
+from .test_support import FakeSlave
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        (handle, self.file_name) = tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+        capture = CaptureWriter(self.file_name)
+        capture.record(3, 1, 100, 3, STATUS_OK, 0.01, [1, 0xffff, -314])
+        capture.record(1, 2, 0, 10, STATUS_OK, 0.01, [True, False] * 5)
+        capture.record(3, 1, 100, 3, 2, 0.01, None)
+        capture.record(4, 1, 0, 1, STATUS_ERROR, 0.5, None)
+        capture.record(6, 1, 7, 1, STATUS_OK, 0.01, 42)
+        capture.close()
+
+    def tearDown(self):
+        os.unlink(self.file_name)
+
+    def test_read_capture(self):
+        records = list(read_capture(self.file_name))
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[0].values, [1, 0xffff, 0xfec6])
+        self.assertEqual(records[1].values, [True, False] * 5)
+        self.assertEqual((records[2].status, records[2].values), (2, []))
+        self.assertEqual((records[4].function_code, records[4].address, records[4].values), (6, 7, [42]))
+
+    def test_replay(self):
+        client = ReplayClient(self.file_name, speed=1000.0)
+        #...........................................................................................
+        async def replay():
+            results = [ await client.read_holding_registers(100, 3, slave=1) for _ in range(3) ]
+            results.append(await client.read_coils(0, 10, slave=2))
+            results.append(await client.read_input_registers(0, 1, slave=1))
+            results.append(await client.read_input_registers(50, 1, slave=1))
+            return results
+        #...........................................................................................
+        results = asyncio.run(replay())
+        self.assertEqual(results[0].registers, [1, 0xffff, 0xfec6])
+        self.assertRaises(ModbusExceptionResponse, ModbusExceptionResponse.raise_for_result, results[1], 'read')
+        self.assertEqual(results[1].exception_code, 2)
+        self.assertEqual(results[2].registers, [1, 0xffff, 0xfec6]) # Cycling through the recording
+        self.assertEqual(results[3].bits, [True, False] * 5)
+        self.assertTrue(results[4].isError())
+        self.assertIsNone(results[4].exception_code)
+        self.assertEqual(results[5].exception_code, ReplayClient.NOT_CAPTURED)
+
+
+class TestCaptureWrites(unittest.TestCase):
+
+    def setUp(self):
+        (handle, self.file_name) = tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+        self.master = ModbusMaster(FakeSlave(), 'test')
+
+    def tearDown(self):
+        self.master.stop_capture()
+        ModbusMaster.all_modbus_master.remove(self.master)
+        deamon_opts['avoid-fc6'] = False
+        os.unlink(self.file_name)
+
+    def test_function_code_on_the_wire(self):
+        self.master.start_capture(self.file_name)
+        #...........................................................................................
+        async def writes():
+            await self.master.write_to_slave(6, 3, 7, 1)
+            await self.master.write_to_slave(6, 3, [7, 8], 1)
+            deamon_opts['avoid-fc6'] = True
+            await self.master.write_to_slave(6, 3, 9, 1)
+        #...........................................................................................
+        asyncio.run(writes())
+        self.master.stop_capture()
+        records = [ (record.function_code, record.count, record.values) for record in read_capture(self.file_name) ]
+        self.assertEqual(records, [ (6, 1, [7]), (16, 2, [7, 8]), (16, 1, [9]) ])
+        self.assertEqual(self.master.master.writes, [ (3, 7), (3, [7, 8]), (3, [9]) ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#
+# run with:  python -m unittest
+#
+
+import os
+import tempfile
+import unittest
+
+import modbus2mqtt_2.globals as globs
+
+from .config_reader import ConfigCache
+
+
+class TestConfigCache(unittest.TestCase):
+
+    config_text = 'Devices:\n  - name: dev\n    slave-id: 1\n'
+    plan = { 'daemon': {}, 'devices': [ { 'name': 'dev', 'slave-id': 1 } ] }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ConfigCache(os.path.join(self.tmp_dir.name, 'config.cache'))
+        self.cache.store(ConfigCache.get_key(self.config_text), self.plan)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit(self):
+        self.assertEqual(self.cache.load(ConfigCache.get_key(self.config_text)), self.plan)
+        if hasattr(os, 'geteuid'):
+            self.assertEqual(os.stat(self.cache.cache_file).st_mode & 0o777, 0o600)
+
+    def test_config_changed(self):
+        self.assertIsNone(self.cache.load(ConfigCache.get_key(self.config_text + '    payload-batch: true\n')))
+
+    def test_version_changed(self):
+        version = globs.__version__
+        try:
+            globs.__version__ = version + '.1'
+            self.assertIsNone(self.cache.load(ConfigCache.get_key(self.config_text)))
+        finally:
+            globs.__version__ = version
+
+    @unittest.skipUnless(hasattr(os, 'geteuid'), 'POSIX permissions only')
+    def test_writable_by_others(self):
+        os.chmod(self.cache.cache_file, 0o666)
+        with self.assertLogs('main-logger', 'WARNING'):
+            self.assertIsNone(self.cache.load(ConfigCache.get_key(self.config_text)))
+
+    def test_missing(self):
+        os.unlink(self.cache.cache_file)
+        self.assertIsNone(self.cache.load(ConfigCache.get_key(self.config_text)))
+
+
+if __name__ == '__main__':
+    unittest.main()
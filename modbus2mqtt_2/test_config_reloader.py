@@ -0,0 +1,201 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+
+from .config_reader import ConfigYaml, ConfigReloader
+from .modbus_objects import ModbusMaster, ModbusWriter, Device, Poller
+from .test_support import FakeTaskGroup, new_mqtt_client
+
+
+CONFIG = """
+Devices:
+  - name: dev-1
+    slave-id: 1
+    Pollers:
+      - start-reg: 0
+        len-regs: 2
+        reg-type: holding_register
+        References:
+          - topic: keep
+            start-reg: 0
+      - start-reg: 10
+        len-regs: 2
+        reg-type: holding_register
+        References:
+          - topic: change
+            start-reg: 10
+  - name: dev-2
+    slave-id: 2
+    Pollers:
+      - start-reg: 0
+        len-regs: 1
+        reg-type: coil
+        References:
+          - topic: switch
+            writeable: true
+"""
+
+PROFILE_CONFIG = """
+Profiles:
+  - name: meter
+    Pollers:
+      - start-reg: 0
+        len-regs: 2
+        reg-type: holding_register
+        References:
+          - topic: power
+            start-reg: 0
+          - topic: energy
+            start-reg: 1
+Devices:
+  - name: meter-1
+    slave-id: 1
+    profile: meter
+  - name: meter-2
+    slave-id: 2
+    profile: meter
+"""
+
+
+class ReloaderTestCase(unittest.TestCase):
+
+    config_text = CONFIG
+
+    def setUp(self):
+        (handle, self.file_name) = tempfile.mkstemp(suffix='.yaml')
+        os.close(handle)
+        self.write_config(self.config_text)
+        self.mqttc = new_mqtt_client()
+        self.master = ModbusMaster(SimpleNamespace(connected=True), 'test')
+        with open(self.file_name, 'r') as yaml_file:
+            ConfigYaml.read_devices(yaml_file, self.mqttc, self.master)
+        self.reloader = ConfigReloader(self.file_name, self.mqttc, self.master, ModbusWriter(self.mqttc))
+        self.reloader.task_group = FakeTaskGroup()
+
+    def tearDown(self):
+        for dev in list(Device.all_devices.values()):
+            dev.remove()
+        ModbusMaster.all_modbus_master.remove(self.master)
+        del ConfigYaml._loaded_plans[self.file_name]
+        os.unlink(self.file_name)
+
+    def write_config(self, text:str) -> None:
+        with open(self.file_name, 'w') as yaml_file:
+            yaml_file.write(text)
+
+    def reload(self, text:str) -> None:
+        self.write_config(text)
+        asyncio.run(self.reloader.reload())
+
+
+class TestConfigReloader(ReloaderTestCase):
+
+    def test_unchanged(self):
+        pollers = list(Device.all_devices['dev-1'].pollers)
+        self.reload(CONFIG)
+        self.assertEqual(Device.all_devices['dev-1'].pollers, pollers)
+        self.assertEqual(self.reloader.task_group.names, [])
+
+    def test_changed_poller(self):
+        dev = Device.all_devices['dev-1']
+        (kept_poller, changed_poller) = dev.pollers
+        self.reload(CONFIG.replace('start-reg: 10\n', 'start-reg: 11\n'))
+        self.assertIs(Device.all_devices['dev-1'], dev)
+        self.assertEqual(len(dev.pollers), 2)
+        self.assertIs(dev.pollers[0], kept_poller)
+        self.assertIsNot(dev.pollers[1], changed_poller)
+        self.assertEqual(dev.references['change'].start_reg, 11)
+        self.assertEqual(self.reloader.task_group.names, [ f'poller:dev-1/{dev.pollers[1].name}' ])
+
+    def test_removed_device(self):
+        topics = { self.mqttc.get_topic_reference_value('dev-2', 'switch'), self.mqttc.get_topic_reference_subsciption('dev-2', 'switch'),
+                   self.mqttc.get_topic_device_availability('dev-2') }
+        registered = lambda: self.mqttc.unique_topic_publish_list | self.mqttc.unique_topic_subscribe_list
+        self.assertTrue(topics <= registered())
+        self.reload(CONFIG[:CONFIG.index('  - name: dev-2')])
+        self.assertEqual(list(Device.all_devices), ['dev-1'])
+        self.assertFalse(topics & registered())
+        self.assertEqual([ dev.name for dev in self.master.devices ], ['dev-1'])
+
+    def test_changed_device(self):
+        dev = Device.all_devices['dev-2']
+        self.reload(CONFIG.replace('slave-id: 2', 'slave-id: 3'))
+        self.assertIsNot(Device.all_devices['dev-2'], dev)
+        self.assertEqual(Device.all_devices['dev-2'].slaveid, 3)
+        self.assertEqual(len(self.reloader.task_group.names), 1)
+
+    def test_config_error_keeps_running_config(self):
+        devices = dict(Device.all_devices)
+        self.reload(CONFIG + '  - name: [broken\n')
+        self.assertEqual(Device.all_devices, devices)
+
+    def test_build_error_keeps_running_config(self):
+        build_errors = {
+            'register out of range':    CONFIG.replace('            start-reg: 10\n', '            start-reg: 11\n            data-type: uint32LE\n')
+                                              .replace('slave-id: 2', 'slave-id: 3'),
+            'history on a string':      CONFIG.replace('topic: keep\n', 'topic: keep\n            data-type: stringBE4\n            history: 10\n')
+                                              .replace('name: dev-2', 'name: dev-3'),
+            'duplicate topic':          CONFIG.replace('topic: change', 'topic: keep'),
+        }
+        for (error, text) in build_errors.items():
+            with self.subTest(error):
+                devices = dict(Device.all_devices)
+                pollers = { name: list(dev.pollers) for (name, dev) in devices.items() }
+                references = { name: dict(dev.references) for (name, dev) in devices.items() }
+                registered = self.mqttc.unique_topic_publish_list | self.mqttc.unique_topic_subscribe_list
+                poller_count = Poller._poller_count
+                with self.assertLogs('main-logger', 'ERROR'):
+                    self.reload(text)
+                self.assertEqual(Device.all_devices, devices)
+                self.assertEqual({ name: dev.pollers for (name, dev) in devices.items() }, pollers)
+                self.assertEqual({ name: dev.references for (name, dev) in devices.items() }, references)
+                self.assertEqual(self.mqttc.unique_topic_publish_list | self.mqttc.unique_topic_subscribe_list, registered)
+                self.assertEqual(self.master.devices, list(devices.values()))
+                self.assertEqual(Poller._poller_count, poller_count)
+                self.assertEqual(self.reloader.task_group.names, [])
+
+        # A valid config is applied afterwards
+        self.reload(CONFIG.replace('slave-id: 2', 'slave-id: 3'))
+        self.assertEqual(Device.all_devices['dev-2'].slaveid, 3)
+
+
+class TestSharedReferenceDefs(ReloaderTestCase):
+
+    config_text = PROFILE_CONFIG
+
+    def assert_shared(self, devices:list[Device]) -> None:
+        for topic in ('power', 'energy'):
+            refs = [ dev.references[topic] for dev in devices ]
+            for ref in refs[1:]:
+                self.assertIs(ref.ref_def, refs[0].ref_def)
+            self.assertEqual(len({ id(ref) for ref in refs }), len(refs))
+
+    def test_profile_devices(self):
+        devices = [ Device.all_devices['meter-1'], Device.all_devices['meter-2'] ]
+        self.assert_shared(devices)
+        # Only the definition is shared, not the state
+        devices[0].references['power'].publish_value([42])
+        self.assertEqual(devices[0].references['power'].last_val, '42')
+        self.assertIsNone(devices[1].references['power'].last_val)
+
+    def test_after_reload(self):
+        old_ref_def = Device.all_devices['meter-1'].references['power'].ref_def
+        self.reload(PROFILE_CONFIG.replace('start-reg: 1', 'start-reg: 1\n            scaling: 0.1')
+                    + '  - name: meter-3\n    slave-id: 3\n    profile: meter\n')
+        devices = [ Device.all_devices['meter-1'], Device.all_devices['meter-2'], Device.all_devices['meter-3'] ]
+        self.assert_shared(devices)
+        self.assertIsNot(devices[0].references['power'].ref_def, old_ref_def)
+        self.assertEqual(devices[2].references['energy'].scale, 0.1)
+        # The cache only holds the definitions of the new plan
+        self.assertEqual(len(ConfigYaml._shared_ref_defs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 import unittest
 import struct 
 from .data_types import DataConverter
+from .data_types_corpus import ROUND_TRIP_CASES, STR2MB_ERROR_CASES
 
 
 class TestDataTypeConversion(unittest.TestCase):
@@ -124,6 +125,39 @@ class TestDataTypeConversion(unittest.TestCase):
         self.assertEqual(list_uint16_conv.str2mb( "0x1234 0x8000 0x4321 0x0192 0xffff"), [0x1234, 0x8000, 0x4321, 0x0192, 0xffff])
         self.assertEqual(list_uint16_conv.mb2py([0x1234, 0x8000, 0x4321, 0x0192, 0xffff]), "4660 32768 17185 402 65535")
 
+    def test_py2mb(self):
+        self.assertEqual(DataConverter("bool").py2mb(True), 1)
+        self.assertEqual(DataConverter("int16").py2mb(-4095), -4095)
+        self.assertEqual(DataConverter("int16").py2mb("0x1234"), 0x1234)
+        self.assertEqual(DataConverter("float32LE").py2mb(3.1415926), [0x4049, 0x0fda])
+        self.assertEqual(DataConverter("list-uint16-3").py2mb([0x1234, 0x8000, 0xffff]), [0x1234, 0x8000, 0xffff])
+        self.assertEqual(DataConverter("list-uint16-3").py2mb("0x1234 0x8000 0xffff"), [0x1234, 0x8000, 0xffff])
+        with self.assertRaises(ValueError):
+            DataConverter("list-uint16-3").py2mb([1, 2])
+
+    def test_corpus(self):
+        for (data_type, string, regs, value) in ROUND_TRIP_CASES:
+            with self.subTest(data_type=data_type, string=string):
+                conv = DataConverter(data_type)
+                written = conv.str2mb(string)
+                if isinstance(written, list):
+                    self.assertEqual([ reg & 0xffff for reg in written ], regs)
+                else:
+                    self.assertEqual(written & 0xffff, regs)
+                result = conv.mb2py(regs if isinstance(regs, list) else [regs])
+                if isinstance(value, float):
+                    self.assertAlmostEqual(result, value, 6)
+                else:
+                    self.assertEqual(result, value)
+        for (data_type, string, exception) in STR2MB_ERROR_CASES:
+            with self.subTest(data_type=data_type, string=string):
+                with self.assertRaises(exception):
+                    DataConverter(data_type).str2mb(string)
+
+    def test_list_32bit(self):
+        self.assertEqual(DataConverter("list-uint32LE-2").py2mb([0x12345678, 0xfedcba98]), [0x1234, 0x5678, 0xfedc, 0xba98])
+        self.assertEqual(DataConverter("list-float32BE-2").reg_cnt, 4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+#
+# run with:  python -m unittest
+#
+
+import json
+import time
+import unittest
+
+from unittest import mock
+
+from .history import HistoryBuffer
+from .modbus_objects import ModbusMaster, Device, Poller, ReferenceDef, Reference
+from .test_support import FakeSlave, new_mqtt_client
+
+
+class TestHistoryBuffer(unittest.TestCase):
+
+    def test_filling(self):
+        history = HistoryBuffer(5)
+        self.assertEqual(history.window(), ([], []))
+        for idx in range(3):
+            history.append(100.0+idx, idx*1.5)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.window(), ([100.0, 101.0, 102.0], [0.0, 1.5, 3.0]))
+
+    def test_wraparound(self):
+        history = HistoryBuffer(4)
+        for idx in range(10):
+            history.append(100.0+idx, idx)
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.window(), ([106.0, 107.0, 108.0, 109.0], [6.0, 7.0, 8.0, 9.0]))
+
+    def test_window(self):
+        history = HistoryBuffer(4)
+        for idx in range(7):
+            history.append(100.0+idx, idx)
+        self.assertEqual(history.window(since=104.5)[1], [5.0, 6.0])
+        self.assertEqual(history.window(since=104.0, until=105.0)[1], [4.0, 5.0])
+        self.assertEqual(history.window(max_samples=3)[1], [4.0, 5.0, 6.0])
+        self.assertEqual(history.window(since=105.0, max_samples=3)[1], [5.0, 6.0])
+        self.assertEqual(history.window(since=200.0), ([], []))
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, HistoryBuffer, 0)
+
+
+class TestHistoryRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.mqttc = new_mqtt_client()
+        self.master = ModbusMaster(FakeSlave(), 'test')
+        self.device = Device('test', self.mqttc, self.master, 'dev', 1)
+        poller = Poller('test', self.device, 0, 1, 'holding_register', 1.0)
+        self.ref = Reference(poller, ReferenceDef('test', poller, 'temp', 0, None, True, False, 'uint16', None, None, history_size=10))
+
+    def tearDown(self):
+        self.device.remove()
+        ModbusMaster.all_modbus_master.remove(self.master)
+
+    def request_history(self, request:dict) -> dict:
+        self.device.publish_history('temp', json.dumps(request).encode())
+        return json.loads(self.mqttc.mqc.published[-1][1])
+
+    def test_clock_step(self):
+        real_time = time.time
+        self.ref.publish_value([1])
+        self.ref.publish_value([2])
+        # The system clock gets set back by an hour, e.g. by NTP
+        with mock.patch('time.time', lambda: real_time()-3600.0):
+            self.ref.publish_value([3])
+            doc = self.request_history({ 'seconds': 60 })
+            self.assertEqual(doc['values'], [1, 2, 3])
+            self.assertEqual(doc['timestamps'], sorted(doc['timestamps']))
+            self.assertAlmostEqual(doc['timestamps'][-1], time.time(), delta=1.0)
+            doc = self.request_history({ 'since': time.time()-60.0, 'max-samples': 2 })
+            self.assertEqual(doc['values'], [2, 3])
+            self.assertEqual(self.request_history({ 'since': time.time()+60.0 })['values'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
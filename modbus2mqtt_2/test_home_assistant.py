@@ -0,0 +1,61 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import unittest
+
+from .home_assistant import HassConnector
+
+
+class FakeMqttClient:
+
+    def __init__(self, retained:dict):
+        self.retained = retained
+        self.published = list()
+
+    def get_topic_hass_autoconfig_base(self) -> str:
+        return 'homeassistant'
+
+    async def collect_retained(self, topic_filter:str, duration:float) -> dict:
+        self.topic_filter = topic_filter
+        return self.retained
+
+    def publish_hass_autodiscovery_entity(self, rel_topic:str, value:str) -> None:
+        self.published.append((rel_topic, value))
+
+
+class TestHassSeeding(unittest.TestCase):
+
+    def test_publish_only_changes(self):
+        payload_cache = {
+            'sensor/dev-1/unchanged/config': '{"name":"unchanged"}',
+            'sensor/dev-1/changed/config':   '{"name":"changed","unit_of_measurement":"W"}',
+            'sensor/dev-1/new/config':       '{"name":"new"}',
+        }
+        mqttc = FakeMqttClient({
+            'homeassistant/sensor/dev-1/unchanged/config': b'{"name":"unchanged"}',
+            'homeassistant/sensor/dev-1/changed/config':   b'{"name":"changed"}',
+            'homeassistant/sensor/dev-1/removed/config':   b'{"name":"removed"}',
+            'homeassistant/sensor/other/foreign/config':   b'{"name":"not ours"}',
+            'homeassistant/sensor/dev-1/deleted/config':   b'',
+        })
+        connector = HassConnector(mqttc, 0, None, seed_time=1.0)
+        connector.payload_cache = { rel_topic: (json_str, HassConnector._digest(json_str.encode('utf-8'))) for (rel_topic, json_str) in payload_cache.items() }
+        #...........................................................................................
+        async def startup():
+            await connector.seed_published_digests()
+            await connector.publish_hass_autodiscovery()
+        #...........................................................................................
+        asyncio.run(startup())
+        self.assertEqual(mqttc.topic_filter, 'homeassistant/+/+/+/config')
+        self.assertEqual(mqttc.published, [
+            ('sensor/dev-1/removed/config', ''),
+            ('sensor/dev-1/changed/config', payload_cache['sensor/dev-1/changed/config']),
+            ('sensor/dev-1/new/config', payload_cache['sensor/dev-1/new/config']),
+        ])
+        self.assertEqual(set(connector.published_digests), set(payload_cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
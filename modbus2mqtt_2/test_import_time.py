@@ -0,0 +1,35 @@
+#
+# run with:  python -m unittest
+#
+# The import time itself is measured by benchmarks/bench_import_time.py
+#
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+class TestImportTime(unittest.TestCase):
+
+    # Optional subsystems which must only get imported on first use
+    lazy_modules = [ 'yaml', 'csv', 'pymodbus', 'modbus2mqtt_2.home_assistant', 'cbor2', 'msgpack', 'uvloop',
+                     'modbus2mqtt_2.sharding', 'multiprocessing', 'modbus2mqtt_2.modbus_server', 'modbus2mqtt_2.loop_monitor',
+                     'modbus2mqtt_2.profiling' ]
+
+    def _imported_modules(self, module:str) -> list[str]:
+        result = subprocess.run([sys.executable, '-c', f'import sys, {module}; print("\\n".join(sys.modules))'],
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                capture_output=True, text=True, check=True)
+        return result.stdout.splitlines()
+
+    def test_lazy_imports(self):
+        imported_modules = self._imported_modules('modbus2mqtt_2.main')
+        self.assertIn('modbus2mqtt_2.main', imported_modules)
+        for lazy_module in self.lazy_modules:
+            imported = [ mod for mod in imported_modules if mod == lazy_module or mod.startswith(lazy_module+'.') ]
+            self.assertEqual(imported, [], f'{lazy_module} must not be imported on startup')
+
+
+if __name__ == '__main__':
+    unittest.main()
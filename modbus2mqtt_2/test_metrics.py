@@ -0,0 +1,98 @@
+#
+# run with:  python -m unittest
+#
+
+import unittest
+
+from modbus2mqtt_2.metrics import Counter, Gauge, Histogram, HistogramChild, Metric, render_metrics
+from modbus2mqtt_2.modbus_objects import ModbusStats, WriteTrace
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        for name in [ name for name in Metric.all_metrics if name.startswith('test_') ]:
+            del Metric.all_metrics[name]
+
+    def test_counter_and_gauge(self):
+        counter = Counter('test_requests', 'Test counter.', ('device',))
+        counter.labels('dev-1').inc()
+        counter.labels('dev-1').inc(2)
+        gauge = Gauge('test_depth', 'Test gauge.', ('queue',))
+        gauge.labels('q').set_function(lambda: 7)
+        text = render_metrics(openmetrics=True)
+        self.assertIn('# TYPE test_requests counter', text)
+        self.assertIn('test_requests_total{device="dev-1"} 3', text)
+        self.assertIn('test_depth{queue="q"} 7', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+        text = render_metrics(openmetrics=False)
+        self.assertIn('# TYPE test_requests_total counter', text)
+        self.assertNotIn('# EOF', text)
+
+    def test_histogram(self):
+        histogram = Histogram('test_duration_seconds', 'Test histogram.', ('fc',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.labels(3).observe(value)
+        text = render_metrics()
+        self.assertIn('test_duration_seconds_bucket{fc="3",le="0.1"} 1', text)
+        self.assertIn('test_duration_seconds_bucket{fc="3",le="1.0"} 3', text)
+        self.assertIn('test_duration_seconds_bucket{fc="3",le="+Inf"} 4', text)
+        self.assertIn('test_duration_seconds_count{fc="3"} 4', text)
+        self.assertRaises(ValueError, histogram.labels, 3, 4)
+
+    def test_remove_all(self):
+        counter = Counter('test_requests', 'Test counter.', ('device', 'poller'))
+        for labels in (('dev-1', 'p-1'), ('dev-1', 'p-2'), ('dev-2', 'p-1')):
+            counter.labels(*labels).inc()
+        counter.remove_all(device='dev-1', poller='p-2')
+        self.assertEqual(set(counter.children), { ('dev-1', 'p-1'), ('dev-2', 'p-1') })
+        counter.remove_all(device='dev-1')
+        self.assertEqual(set(counter.children), { ('dev-2', 'p-1') })
+
+    def test_quantile(self):
+        child = HistogramChild((1.0, 2.0, 4.0, float('inf')))
+        self.assertIsNone(child.quantile(0.5))
+        for value in (0.5, 1.5, 1.5, 3.0):
+            child.observe(value)
+        self.assertAlmostEqual(child.quantile(0.25), 1.0)
+        self.assertAlmostEqual(child.quantile(0.5), 1.5)
+        self.assertAlmostEqual(child.quantile(1.0), 4.0)
+
+
+class TestModbusStats(unittest.TestCase):
+
+    def test_timing_quantiles(self):
+        stats = ModbusStats()
+        for idx in range(100):
+            stats.record_timing(3, 0.0, 0.010)
+        snap = stats.snapshot()
+        for idx in range(100):
+            stats.record_timing(3, 0.0, 0.100 if idx < 50 else 1.0)
+        quantiles = stats.snapshot().diff_stat(snap).get_timing_quantiles()
+        self.assertEqual(quantiles[3]['count'], 100)
+        self.assertAlmostEqual(quantiles[3]['wire']['p50'], 0.100, delta=0.025)
+        self.assertAlmostEqual(quantiles[3]['wire']['p99'], 1.0, delta=0.25)
+        self.assertEqual(stats.get_timing_quantiles()[3]['count'], 200)
+
+
+
+class TestWriteTrace(unittest.TestCase):
+
+    def test_unwrap_value(self):
+        trace = WriteTrace(0.0)
+        self.assertEqual(trace.unwrap_value('17'), '17')
+        self.assertFalse(trace.wants_response())
+        self.assertEqual(trace.unwrap_value('{"value": 42, "request-id": "abc"}'), 42)
+        self.assertEqual(trace.request_id, 'abc')
+        self.assertTrue(trace.wants_response())
+        self.assertEqual(WriteTrace(0.0).unwrap_value({'value': 1.5}), 1.5)
+
+    def test_stages(self):
+        trace = WriteTrace(10.0)
+        trace.add('lock', 0.5)
+        trace.add('wire', 0.25)
+        self.assertEqual(trace.stages, {'lock': 0.5, 'wire': 0.25})
+        self.assertEqual(trace.last_mark, 10.75)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import struct
+import unittest
+
+from types import SimpleNamespace
+
+from .modbus_objects import ModbusMaster, ModbusWriter, Device, Poller, ReferenceDef, Reference
+from .modbus_server import ModbusServer
+from .test_support import FakeSlave, new_mqtt_client
+
+
+class TestModbusServer(unittest.TestCase):
+
+    def setUp(self):
+        self.mqttc = new_mqtt_client()
+        self.slave = FakeSlave()
+        self.master = ModbusMaster(self.slave, 'test')
+        self.device = Device('test', self.mqttc, self.master, 'dev', 7)
+        self.device.enabled = True
+        self.poller = Poller('test', self.device, 0, 10, 'holding_register', 1.0)
+        Reference(self.poller, ReferenceDef('test', self.poller, 'value', 0, None, True, False, 'uint16', None, None))
+        Reference(self.poller, ReferenceDef('test', self.poller, 'setpoint', 5, None, True, True, 'uint16', None, None))
+        self.writer = ModbusWriter(self.mqttc)
+        self.server = ModbusServer(self.writer, 0)
+
+    def tearDown(self):
+        self.device.remove()
+        ModbusMaster.all_modbus_master.remove(self.master)
+
+    def run_requests(self, requests:list[tuple[int,bytes]], poll:bool=True) -> list[bytes]:
+        #...........................................................................................
+        async def run():
+            async with asyncio.TaskGroup() as tg:
+                self.writer.run_workloop(tg)
+                if poll:
+                    await self.poller.poll(tg)
+                responses = [ await self.server.handle_pdu(unit_id, pdu) for (unit_id, pdu) in requests ]
+                self.writer.runtask.cancel()
+            return responses
+        #...........................................................................................
+        return asyncio.run(run())
+
+    def test_read_cached_registers(self):
+        (response,) = self.run_requests([ (7, struct.pack('>BHH', 3, 4, 3)) ])
+        self.assertEqual(response, struct.pack('>BB3H', 3, 6, 104, 105, 106))
+
+    def test_exceptions(self):
+        responses = self.run_requests([
+            (7, struct.pack('>BHH', 3, 8, 5)),      # Beyond the poller
+            (7, struct.pack('>BHH', 4, 0, 1)),      # No input register poller
+            (8, struct.pack('>BHH', 3, 0, 1)),      # No device with this unit ID
+            (7, struct.pack('>BHH', 3, 0, 0)),      # Invalid count
+            (7, bytes([0x2B, 0x0E, 0x01, 0x00])),   # Unsupported function code
+            (7, struct.pack('>BHH', 6, 0, 1)),      # Write to a read only reference
+        ])
+        self.assertEqual(responses, [ bytes([0x83, 2]), bytes([0x84, 2]), bytes([0x83, 0x0A]), bytes([0x83, 3]),
+                                      bytes([0xAB, 1]), bytes([0x86, 2]) ])
+        self.assertEqual(self.slave.writes, [])
+
+    def test_no_current_data(self):
+        (response,) = self.run_requests([ (7, struct.pack('>BHH', 3, 0, 1)) ], poll=False)
+        self.assertEqual(response, bytes([0x83, 0x0B]))
+
+    def test_write_through_writer(self):
+        responses = self.run_requests([ (7, struct.pack('>BHH', 6, 5, 42)), (7, struct.pack('>BHH', 3, 5, 1)) ])
+        self.assertEqual(responses, [ struct.pack('>BHH', 6, 5, 42), struct.pack('>BBH', 3, 2, 42) ])
+        self.assertEqual(self.slave.writes, [(5, 42)])
+
+    def test_mbap_framing(self):
+        #...........................................................................................
+        async def run():
+            async with asyncio.TaskGroup() as tg:
+                self.writer.run_workloop(tg)
+                await self.poller.poll(tg)
+                tcp_server = await asyncio.start_server(self.server.handle_connection, '127.0.0.1', 0)
+                port = tcp_server.sockets[0].getsockname()[1]
+                (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(struct.pack('>HHHBBHH', 0x1234, 0, 6, 7, 3, 0, 2))
+                response = await reader.readexactly(13)
+                writer.close()
+                tcp_server.close()
+                self.writer.runtask.cancel()
+            return response
+        #...........................................................................................
+        self.assertEqual(asyncio.run(run()), struct.pack('>HHHBBB2H', 0x1234, 0, 7, 7, 3, 4, 100, 101))
+
+
+if __name__ == '__main__':
+    unittest.main()
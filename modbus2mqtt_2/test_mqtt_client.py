@@ -0,0 +1,99 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import json
+import unittest
+
+import paho.mqtt.client as mqtt
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCodes
+
+from .history import HistoryBuffer
+from .modbus_objects import ModbusMaster, ModbusWriter, Device, Poller, ReferenceDef, Reference
+from .mqtt_client import MqttClient
+from .test_support import FakeSlave, new_mqtt_client
+
+
+class TestMqttV5(unittest.TestCase):
+
+    def setUp(self):
+        self.mqttc = new_mqtt_client(mqtt_protocol='5')
+        self.slave = FakeSlave()
+        self.master = ModbusMaster(self.slave, 'test')
+        self.device = Device('test', self.mqttc, self.master, 'dev', 1)
+        self.device.enabled = True
+        poller = Poller('test', self.device, 0, 10, 'holding_register', 1.0)
+        self.ref = Reference(poller, ReferenceDef('test', poller, 'out', 3, None, True, True, 'uint16', None, None))
+        self.ref.history = HistoryBuffer(10)
+        self.writer = ModbusWriter(self.mqttc)
+        self.mqttc.set_modbus_writer(self.writer)
+
+    def tearDown(self):
+        self.device.remove()
+        ModbusMaster.all_modbus_master.remove(self.master)
+
+    def v5_message(self, topic:str, payload:bytes, response_topic:str=None, correlation_data:bytes=None) -> mqtt.MQTTMessage:
+        # Like paho delivers a message received on a MQTT v5 connection
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        msg.properties = Properties(PacketTypes.PUBLISH)
+        if response_topic is not None:
+            msg.properties.ResponseTopic = response_topic
+        if correlation_data is not None:
+            msg.properties.CorrelationData = correlation_data
+        return msg
+
+    def deliver(self, messages:list) -> None:
+        #...........................................................................................
+        async def run():
+            async with asyncio.TaskGroup() as tg:
+                self.writer.run_workloop(tg)
+                for msg in messages:
+                    self.mqttc.on_message_callback(self.mqttc.mqc, None, msg)
+                await asyncio.sleep(0.01)
+                await self.writer.set_request_queue.join()
+                self.writer.runtask.cancel()
+        #...........................................................................................
+        asyncio.run(run())
+
+    def test_v5_callbacks(self):
+        # MQTT v5 passes reason codes and properties to the callbacks
+        self.mqttc.on_connect_callback(self.mqttc.mqc, None, dict(), ReasonCodes(PacketTypes.CONNACK, 'Success'), Properties(PacketTypes.CONNACK))
+        self.assertEqual(self.mqttc.mqc.published, [ (self.mqttc.get_topic_daemon_avail(), 'True') ])
+        with self.assertLogs('main-logger', 'ERROR'):
+            self.mqttc.on_connect_callback(self.mqttc.mqc, None, dict(), ReasonCodes(PacketTypes.CONNACK, 'Not authorized'), None)
+        self.mqttc.on_disconnect_callback(self.mqttc.mqc, None, ReasonCodes(PacketTypes.DISCONNECT, 'Normal disconnection'), None)
+
+    def test_write_response(self):
+        self.deliver([ self.v5_message('modbus/dev/set/out', b'7', 'client/responses', b'req-1') ])
+        self.assertEqual(self.slave.writes, [(3, 7)])
+        (response_topic, response) = self.mqttc.mqc.published[-1]
+        self.assertEqual(response_topic, 'client/responses')
+        self.assertTrue(json.loads(response)['success'])
+        self.assertEqual(self.mqttc.mqc.properties['client/responses'].CorrelationData, b'req-1')
+
+    def test_history_response(self):
+        self.ref.history.append(100.0, 5.0)
+        self.deliver([ self.v5_message('modbus/dev/get-history/out', b'', 'client/history', b'req-2'),
+                       self.v5_message('modbus/dev/get-history/out', b'') ])
+        published = dict(self.mqttc.mqc.published)
+        self.assertEqual(json.loads(published['client/history'])['values'], [5])
+        self.assertEqual(self.mqttc.mqc.properties['client/history'].CorrelationData, b'req-2')
+        # Without a response topic, the answer goes to the reference's history topic
+        self.assertIn(self.mqttc.get_topic_reference_history('dev', 'out'), published)
+
+
+class TestMqttProtocol(unittest.TestCase):
+
+    def test_protocol_version(self):
+        for (mqtt_protocol, paho_protocol) in (('3.1.1', mqtt.MQTTv311), ('5', mqtt.MQTTv5), (5, mqtt.MQTTv5)):
+            mqttc = MqttClient('localhost', 1883, 'test', None, '', None, False, None, 'modbus', 'homeassistant', False, 0, mqtt_protocol)
+            self.assertEqual(mqttc.mqc._protocol, paho_protocol)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+#
+# run with:  python -m unittest
+#
+
+import asyncio
+import unittest
+
+from types import SimpleNamespace
+
+from . import metrics
+from .modbus_objects import ModbusMaster, ModbusWriter, Device, Poller, ReferenceDef, Reference, WriteTrace
+from .test_support import FakeSlave, new_mqtt_client, published_values
+
+
+class PollerTestCase(unittest.TestCase):
+
+    def make_poller(self, slave:FakeSlave, len_regs:int=10, ref_regs:tuple=(0,)) -> Poller:
+        self.mqttc = new_mqtt_client()
+        self.master = ModbusMaster(slave, 'test')
+        self.device = Device('test', self.mqttc, self.master, 'dev', 1)
+        self.device.enabled = True
+        poller = Poller('test', self.device, 0, len_regs, 'holding_register', 1.0)
+        for reg in ref_regs:
+            Reference(poller, ReferenceDef('test', poller, f'reg-{reg}', reg, None, True, False, 'uint16', None, None))
+        return poller
+
+    def tearDown(self):
+        self.device.remove()
+        ModbusMaster.all_modbus_master.remove(self.master)
+
+    def published_values(self) -> dict:
+        return published_values(self.mqttc)
+
+
+class TestPollerInFlight(PollerTestCase):
+
+    def test_overlapping_polls(self):
+        slave = FakeSlave(delay=0.05)
+        poller = self.make_poller(slave)
+        #...........................................................................................
+        async def overlap():
+            scheduled = asyncio.create_task(poller.poll(None))
+            await asyncio.sleep(0.01)
+            results = await asyncio.gather(poller.refresh(None, 0.0), poller.refresh(None, 0.0))
+            return (await scheduled, results)
+        #...........................................................................................
+        (scheduled_success, results) = asyncio.run(overlap())
+        self.assertTrue(scheduled_success)
+        self.assertEqual(results, ['read', 'read'])
+        self.assertEqual(len(slave.requests), 1)
+        self.assertIsNone(poller.in_flight)
+        self.assertEqual(poller.stats.polls, 1)
+
+    def test_scheduled_poll_joins_get_read(self):
+        slave = FakeSlave(delay=0.05)
+        poller = self.make_poller(slave)
+        #...........................................................................................
+        async def overlap():
+            get_request = asyncio.create_task(poller.refresh(None, 0.0))
+            await asyncio.sleep(0.01)
+            scheduled_success = await asyncio.wait_for(poller.poll(None), 1.0)
+            return (scheduled_success, await get_request, await poller.refresh(None, 10.0))
+        #...........................................................................................
+        self.assertEqual(asyncio.run(overlap()), (True, 'read', 'cache'))
+        self.assertEqual(len(slave.requests), 1)
+
+
+class TestRangeSplitting(PollerTestCase):
+
+    def test_split_dead_registers(self):
+        slave = FakeSlave(dead_regs={3, 7})
+        poller = self.make_poller(slave, ref_regs=(0, 3, 5, 7, 9))
+        with self.assertLogs('main-logger', 'WARNING') as logs:
+            asyncio.run(poller.poll(None))
+        self.assertEqual(poller.segments, [(0, 3), (4, 3), (8, 2)])
+        self.assertEqual(poller.dead_regs, [3, 7])
+        self.assertEqual(poller.dead_refs, ('reg-3', 'reg-7'))
+        self.assertEqual(len([ line for line in logs.output if 'not publishing' in line ]), 2)
+        self.assertEqual(self.published_values(), { 'reg-0': '100', 'reg-5': '105', 'reg-9': '109' })
+
+        # Later polls read the segments only and don't log the dead references again
+        slave.requests.clear()
+        with self.assertNoLogs('main-logger', 'WARNING'):
+            asyncio.run(poller.poll(None))
+        self.assertEqual(slave.requests, [(0, 3), (4, 3), (8, 2)])
+
+    def test_slave_changes_dead_registers(self):
+        slave = FakeSlave(dead_regs={3, 7})
+        poller = self.make_poller(slave, ref_regs=(0, 3, 5, 7, 9))
+        asyncio.run(poller.poll(None))
+        slave.dead_regs = {5}
+        self.assertRaises(Exception, asyncio.run, poller.poll(None))
+        self.assertIsNone(poller.segments)
+        with self.assertLogs('main-logger', 'INFO') as logs:
+            asyncio.run(poller.poll(None))
+        self.assertEqual(poller.dead_refs, ('reg-5',))
+        self.assertEqual(len([ line for line in logs.output if 'readable again' in line ]), 2)
+        slave.dead_regs = set()
+        poller.segments = None
+        asyncio.run(poller.poll(None))
+        self.assertEqual(poller.dead_refs, ())
+
+    def test_no_readable_register(self):
+        slave = FakeSlave(dead_regs=set(range(10)))
+        poller = self.make_poller(slave)
+        self.assertRaises(Exception, asyncio.run, poller.poll(None))
+        self.assertEqual(len(slave.requests), 20)
+        self.assertEqual(poller.segments, [])
+        self.assertEqual(self.published_values(), {})
+
+        # No bisecting on every poll, the slave isn't asked before the retry time
+        slave.requests.clear()
+        self.assertRaises(Exception, asyncio.run, poller.poll(None))
+        self.assertEqual(slave.requests, [])
+
+        poller.split_retry = 0.0
+        with self.assertNoLogs('main-logger', 'WARNING'):
+            self.assertRaises(Exception, asyncio.run, poller.poll(None))
+        self.assertEqual(len(slave.requests), 20)
+
+        slave.dead_regs = set()
+        poller.split_retry = 0.0
+        asyncio.run(poller.poll(None))
+        self.assertIsNone(poller.segments)
+        self.assertEqual(self.published_values(), { 'reg-0': '100' })
+
+    def test_whole_range_retry(self):
+        slave = FakeSlave(dead_regs={3, 7})
+        poller = self.make_poller(slave, ref_regs=(0, 3, 5, 7, 9))
+        asyncio.run(poller.poll(None))
+
+        # Still refused: split again quietly
+        slave.requests.clear()
+        poller.split_retry = 0.0
+        with self.assertNoLogs('main-logger', 'WARNING'):
+            asyncio.run(poller.poll(None))
+        self.assertEqual(slave.requests[0], (0, 10))
+        self.assertEqual(poller.segments, [(0, 3), (4, 3), (8, 2)])
+
+        # Until the retry time, only the segments are read, even though the slave accepts all registers again
+        slave.dead_regs = set()
+        slave.requests.clear()
+        asyncio.run(poller.poll(None))
+        self.assertEqual(slave.requests, [(0, 3), (4, 3), (8, 2)])
+        self.assertEqual(poller.dead_refs, ('reg-3', 'reg-7'))
+
+        poller.split_retry = 0.0
+        slave.requests.clear()
+        with self.assertLogs('main-logger', 'INFO') as logs:
+            asyncio.run(poller.poll(None))
+        self.assertEqual(slave.requests, [(0, 10)])
+        self.assertIsNone(poller.segments)
+        self.assertEqual(poller.dead_regs, [])
+        self.assertEqual(poller.dead_refs, ())
+        self.assertEqual(len([ line for line in logs.output if 'readable again' in line ]), 3)
+        self.assertEqual(self.published_values()['reg-7'], '107')
+
+    def test_other_exceptions_not_bisected(self):
+        slave = FakeSlave(dead_regs={3}, exception_code=4)
+        poller = self.make_poller(slave)
+        self.assertRaises(Exception, asyncio.run, poller.poll(None))
+        self.assertEqual(slave.requests, [(0, 10)])
+        self.assertIsNone(poller.segments)
+
+
+class TestGetRequests(PollerTestCase):
+
+    def test_published_once(self):
+        slave = FakeSlave()
+        self.make_poller(slave)
+        value_topic = self.mqttc.get_topic_reference_value('dev', 'reg-0')
+        publishes = lambda: len([ topic for (topic, payload) in self.mqttc.mqc.published if topic == value_topic ])
+        # Read through, the poll publishes the new value
+        asyncio.run(self.device.read_on_demand('reg-0', 0.0, None))
+        self.assertEqual(publishes(), 1)
+        # Read through, the value didn't change, so the poll doesn't publish it
+        asyncio.run(self.device.read_on_demand('reg-0', 0.0, None))
+        self.assertEqual(publishes(), 2)
+        # Answered from the cache
+        asyncio.run(self.device.read_on_demand('reg-0', 10.0, None))
+        self.assertEqual(publishes(), 3)
+        self.assertEqual(len(slave.requests), 2)
+
+    def test_batched_device(self):
+        slave = FakeSlave()
+        self.make_poller(slave)
+        self.device.payload_batch = True
+        asyncio.run(self.device.read_on_demand('reg-0', 0.0, None))
+        topics = [ topic for (topic, payload) in self.mqttc.mqc.published ]
+        self.assertEqual(topics, [ self.mqttc.get_topic_device_batch('dev'), self.mqttc.get_topic_reference_value('dev', 'reg-0') ])
+
+
+class TestRequestMetrics(PollerTestCase):
+
+    def test_labelled_by_device_and_poller(self):
+        poller = self.make_poller(FakeSlave())
+        asyncio.run(poller.poll(None))
+        asyncio.run(self.master.read_from_slave(3, 0, 1, 1))
+        self.assertEqual(metrics.modbus_request_duration.children[('test', 'dev', poller.name, 3)].count, 1)
+        self.assertEqual(metrics.modbus_request_duration.children[('test', 'none', 'none', 3)].count, 1)
+        self.device.remove()
+        self.assertNotIn(('test', 'dev', poller.name, 3), metrics.modbus_request_duration.children)
+        self.device = Device('test', self.mqttc, self.master, 'dev', 1) # For tearDown
+        metrics.modbus_request_duration.remove('test', 'none', 'none', 3)
+
+
+class TestModbusMasterLock(PollerTestCase):
+
+    def test_timeout_only_on_wire(self):
+        slave = FakeSlave(delay=0.1)
+        self.make_poller(slave)
+        #...........................................................................................
+        async def queued_reads():
+            first = asyncio.create_task(self.master.read_from_slave(3, 0, 1, 1))
+            await asyncio.sleep(0.01)
+            # Waits 0.09s for the bus, which must not count against its timeout
+            second = await self.master.read_from_slave(3, 1, 1, 1, timeout=0.15)
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.master.read_from_slave(3, 2, 1, 1, timeout=0.05)
+            return (await first, second)
+        #...........................................................................................
+        self.assertEqual(asyncio.run(queued_reads()), ([100], [101]))
+        self.assertFalse(self.master.modbuslock.locked())
+
+    def test_cancelled_waiter_keeps_lock(self):
+        slave = FakeSlave(delay=0.1)
+        self.make_poller(slave)
+        #...........................................................................................
+        async def cancel_waiter():
+            first = asyncio.create_task(self.master.read_from_slave(3, 0, 1, 1))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.create_task(self.master.read_from_slave(3, 1, 1, 1))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            await asyncio.sleep(0.01)
+            still_locked = self.master.modbuslock.locked()
+            await first
+            return still_locked
+        #...........................................................................................
+        self.assertTrue(asyncio.run(cancel_waiter()))
+        self.assertEqual(slave.requests, [(0, 1)])
+
+
+class TestSetRequests(PollerTestCase):
+
+    def test_value_echo_not_written(self):
+        slave = FakeSlave()
+        poller = self.make_poller(slave, ref_regs=())
+        Reference(poller, ReferenceDef('test', poller, 'out', 3, None, True, True, 'uint16', None, None))
+        writer = ModbusWriter(self.mqttc)
+        #...........................................................................................
+        async def requests():
+            for topic in ('modbus/dev/value/out', 'modbus/dev/out', 'modbus/dev/set/out/x', 'modbus/dev/set/out'):
+                await writer.handle_set_request(SimpleNamespace(topic=topic, payload=b'7'), WriteTrace(0.0))
+        #...........................................................................................
+        asyncio.run(requests())
+        self.assertEqual(slave.writes, [(3, 7)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#
+# run with:  python -m unittest
+#
+
+import collections
+import unittest
+
+from .config_reader import ConfigYaml
+
+
+def device_plan(name:str, ref_cnt:int, bus:str=None) -> dict:
+    return { 'opts': { 'name': name, 'bus': bus }, 'hass': {}, 'pollers': [ { 'opts': {}, 'references': [ {} ] * ref_cnt } ] }
+
+
+class TestShardDevicePlans(unittest.TestCase):
+
+    def shard_names(self, dev_plans:list, shard_cnt:int) -> list[list[str]]:
+        shards = ConfigYaml.shard_device_plans(dev_plans, shard_cnt)
+        self.assertEqual(len(shards), shard_cnt)
+        return [ [ dev_plan['opts']['name'] for dev_plan in shard ] for shard in shards ]
+
+    def test_every_device_once(self):
+        dev_plans = [ device_plan(f'dev-{idx}', 1 + (idx*7) % 5) for idx in range(23) ]
+        for shard_cnt in (1, 2, 3, 8, 30):
+            with self.subTest(shard_cnt=shard_cnt):
+                shards = self.shard_names(dev_plans, shard_cnt)
+                counts = collections.Counter(name for shard in shards for name in shard)
+                self.assertEqual(counts, collections.Counter(dev_plan['opts']['name'] for dev_plan in dev_plans))
+                self.assertEqual(shards, self.shard_names(dev_plans, shard_cnt)) # Same in every worker
+
+    def test_balanced(self):
+        dev_plans = [ device_plan(f'dev-{idx}', 1 + (idx*7) % 5) for idx in range(23) ]
+        loads = [ sum(len(dev_plan['pollers'][0]['references']) for dev_plan in shard)
+                  for shard in ConfigYaml.shard_device_plans(dev_plans, 4) ]
+        self.assertLessEqual(max(loads)-min(loads), 5)
+
+    def test_bus_kept_together(self):
+        dev_plans = [ device_plan(f'dev-{idx}', 3, bus=('rs485-1', 'rs485-2', None)[idx % 3]) for idx in range(12) ]
+        shards = self.shard_names(dev_plans, 3)
+        shard_of = { name: shard_idx for (shard_idx, shard) in enumerate(shards) for name in shard }
+        for bus in ('rs485-1', 'rs485-2'):
+            bus_shards = { shard_of[dev_plan['opts']['name']] for dev_plan in dev_plans if dev_plan['opts']['bus'] == bus }
+            self.assertEqual(len(bus_shards), 1, f'Devices of {bus} split over shards {bus_shards}')
+        self.assertEqual(sum(len(shard) for shard in shards), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
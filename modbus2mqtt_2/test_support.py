@@ -0,0 +1,84 @@
+#
+# Fakes shared by the unittests: an MQTT client without broker, a Modbus slave in memory and a task group that
+# doesn't run its tasks.
+#
+
+import asyncio
+
+from types import SimpleNamespace
+
+from .mqtt_client import MqttClient
+
+
+class FakeMqc:
+    # Stands in for the paho client. Records the publishes, and the MQTT v5 properties of the last publish per topic.
+
+    def __init__(self):
+        self.published = list()
+        self.properties = dict()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, payload))
+        if properties is not None:
+            self.properties[topic] = properties
+        return SimpleNamespace(rc=0)
+
+    def is_connected(self) -> bool:
+        return False
+
+    def subscribe(self, topic) -> None:
+        pass
+
+    def unsubscribe(self, topic) -> None:
+        pass
+
+
+def new_mqtt_client(topic_base:str='modbus', mqtt_protocol:str='3.1.1') -> MqttClient:
+    mqttc = MqttClient('localhost', 1883, 'test', None, '', None, False, None, topic_base, 'homeassistant', False, 0, mqtt_protocol)
+    mqttc.mqc = FakeMqc()
+    return mqttc
+
+
+def published_values(mqttc:MqttClient) -> dict:
+    # Last published payload per reference topic
+    return { topic.split('/')[-1]: payload for (topic, payload) in mqttc.mqc.published if '/value/' in topic }
+
+
+class FakeSlave:
+    # Stands in for the pymodbus client. Holding registers with value 100+address. Requests touching a register
+    # in dead_regs get the exception response exception_code, by default "illegal data address".
+
+    def __init__(self, delay:float=0.0, dead_regs:set=frozenset(), exception_code:int=2):
+        self.connected = True
+        self.delay = delay
+        self.dead_regs = dead_regs
+        self.exception_code = exception_code
+        self.requests = list()
+        self.writes = list()
+
+    async def read_holding_registers(self, address, count, slave=1):
+        self.requests.append((address, count))
+        await asyncio.sleep(self.delay)
+        if self.dead_regs.intersection(range(address, address+count)):
+            return SimpleNamespace(function_code=0x83, exception_code=self.exception_code, isError=lambda: True)
+        return SimpleNamespace(function_code=3, registers=[ 100+reg for reg in range(address, address+count) ], isError=lambda: False)
+
+    async def write_register(self, address, value, slave=1):
+        self.writes.append((address, value))
+        return SimpleNamespace(function_code=6, isError=lambda: False)
+
+    async def write_registers(self, address, values, slave=1):
+        self.writes.append((address, values))
+        return SimpleNamespace(function_code=16, isError=lambda: False)
+
+
+class FakeTaskGroup:
+    # Records the started tasks without running them
+
+    def __init__(self):
+        self.names = list()
+
+    def create_task(self, coro, name=None):
+        coro.close()
+        self.names.append(name)
+        return SimpleNamespace(cancel=lambda: None)